@@ -0,0 +1,308 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+import cv2 as cv
+from threading import Thread
+from healer import WindowCapture, X11Capture, ArraySource, Detection, RemoteDetector, StatusChannel, Vision, PartyDetector, GlyphDecoder, win32gui
+
+# client sizes of the detection benchmark
+RESOLUTIONS = {'720p': (1280, 720), '1080p': (1920, 1080), '1440p': (2560, 1440), '4k': (3840, 2160)}
+BASELINE = 'benchmark_baseline.json'
+
+# capture backends that can run on this platform
+def capture_backends():
+    if win32gui is not None:
+        return [WindowCapture]
+    return [X11Capture]
+
+def bench_capture(args):
+    # on linux this runs fine under Xvfb: xvfb-run python benchmark.py capture
+    for backend in capture_backends():
+        capture = backend(args.window)
+        try:
+            fps = capture.measure_fps(args.seconds)
+        finally:
+            capture.release()
+        print(f'{capture.backend:>6} {capture.w}x{capture.h}: {fps:8.1f} grabs/s')
+
+# mean time of a call in microseconds
+def time_call(func, repeat):
+    t_start = time.perf_counter()
+    for i in range(repeat):
+        func()
+    return (time.perf_counter() - t_start) / repeat * 1e6
+
+def bench_vision(args):
+    rng = np.random.default_rng(0)
+    for needle_path in ('hast.png', 'food.jpg'):
+        vision = Vision(needle_path)
+        # noisy frame with the needle inside a 107x14 icon strip
+        frame = rng.integers(0, 256, (args.height, args.width, 3), dtype='uint8')
+        strip = (args.width - 200, 300, 107, 14)
+        x, y = strip[0] + 40, strip[1] + 2
+        frame[y:y + vision.needle_h, x:x + vision.needle_w] = vision.needle_img[..., :3]
+        full = time_call(lambda: vision.find(frame), args.repeat)
+        def cold():
+            vision.last_loc = None
+            return vision.find_in(frame, strip)
+        coarse = time_call(cold, args.repeat)
+        warm = time_call(lambda: vision.find_in(frame, strip), args.repeat)
+        found = vision.find_in(frame, strip)
+        print(f'{needle_path:>9} {args.width}x{args.height}: full frame {full:9.1f} us, '
+              f'region cold {coarse:7.1f} us, region last hit {warm:7.1f} us, found {found}')
+
+# client frame with the life icon, both bars and the icon strip drawn in the
+# side panel, laid out the way Detection expects them
+def synthetic_frame(w, h, life_pct, mana_pct, icons=('hast.png', 'food.jpg'), seed=0):
+    rng = np.random.default_rng(seed)
+    frame = rng.integers(0, 120, (h, w, 3), dtype='uint8')
+    life = cv.imread('life.jpg', cv.IMREAD_COLOR)
+    lx, ly = w - 180, 40
+    frame[ly:ly + life.shape[0], lx:lx + life.shape[1]] = life
+    # same offsets as Detection.__init__
+    x, y = lx + life.shape[1] // 2 + 8, ly + life.shape[0] // 2
+    width = Detection.BAR_WIDTH + 1
+    frame[y, x:x + width] = (40, 40, 40)
+    frame[y, x:x + int(width * life_pct / 100)] = (0, 0, 255)
+    frame[y + 14, x + 8:x + 8 + width] = (40, 40, 40)
+    frame[y + 14, x + 8:x + 8 + int(width * mana_pct / 100)] = (255, 60, 95)
+    # icons on the strip, one slot of 11 pixels each
+    sx, sy = x - 6, y + 167
+    frame[sy:sy + 14, sx:sx + 108] = (30, 30, 30)
+    for i, path in enumerate(icons):
+        icon = cv.imread(path, cv.IMREAD_COLOR)
+        frame[sy + 2:sy + 2 + icon.shape[0], sx + 2 + i * 11:sx + 2 + i * 11 + icon.shape[1]] = icon
+    return frame
+
+# durations of the calls in seconds, after a short warm up
+def sample(func, repeat):
+    for i in range(min(repeat, 10)):
+        func()
+    durations = np.empty(repeat)
+    for i in range(repeat):
+        t_start = time.perf_counter()
+        func()
+        durations[i] = time.perf_counter() - t_start
+    return durations
+
+def report(durations):
+    return {'ops_per_sec': 1 / durations.mean(),
+            'p50_us': np.percentile(durations, 50) * 1e6,
+            'p90_us': np.percentile(durations, 90) * 1e6,
+            'p99_us': np.percentile(durations, 99) * 1e6}
+
+def bench_detection(args):
+    # keep the synthetic anchors out of the real calibration cache
+    Detection.CALIBRATION_FILE = os.path.join(tempfile.gettempdir(), 'healer_bench_calibration.json')
+    results = {}
+    for name in args.resolutions:
+        w, h = RESOLUTIONS[name]
+        # a few fill levels so the bar reader does not see the same row every call
+        frames = [synthetic_frame(w, h, pct, 100 - pct, seed=i) for i, pct in enumerate((95, 70, 40, 15))]
+        source = ArraySource(frames[0])
+        detector = Detection('bench', StatusChannel(), 20, 50, 90, 20, capture=source)
+        if detector.state is None:
+            raise Exception(f'{name}: the synthetic life icon was not found')
+        life = Vision('life.jpg')
+        food = Vision('food.jpg')
+        full = frames[0]
+        cases = {}
+        # the full frame searches are slow, run less of them on big frames
+        repeat = max(args.repeat * 1280 * 720 // (w * h) // 10, 5)
+        cases['findLoc'] = sample(lambda: life.findLoc(full, 0.95), repeat)
+        cases['find'] = sample(lambda: food.find(full), repeat)
+        # the rest runs on the region of interest like the live pipeline
+        source.grab()
+        detector.update(source.frames.latest().img)
+        cases['bar_percent'] = sample(lambda: detector.bar_percent('life'), args.repeat)
+        state = {'i': 0}
+        def step():
+            state['i'] += 1
+            source.set_frame(frames[state['i'] % len(frames)])
+            source.grab()
+            detector.step(source.frames.latest())
+        detector.incremental = False
+        cases['step'] = sample(step, args.repeat)
+        detector.incremental = True
+        cases['step_incremental'] = sample(step, args.repeat)
+        for case, durations in cases.items():
+            results[f'{name}/{case}'] = report(durations)
+    return results
+
+class CyclingSource(ArraySource):
+
+    # a different frame on every grab so the states keep changing
+    def __init__(self, frames):
+        super().__init__(frames[0])
+        self.cycle = frames
+        self.i = 0
+
+    def grab_into(self, frame, rect):
+        self.i += 1
+        self.img = self.cycle[self.i % len(self.cycle)]
+        super().grab_into(frame, rect)
+
+# capture of the ipc benchmark, also called inside the detection process
+def ipc_source():
+    Detection.CALIBRATION_FILE = os.path.join(tempfile.gettempdir(), 'healer_bench_calibration.json')
+    # life goes between the green and the red tier every frame
+    return CyclingSource([synthetic_frame(1280, 720, pct, 50, seed=i) for i, pct in enumerate((95, 15))])
+
+# age of the frame each time the decision loop wakes up on a state change
+def wake_ages(detector, seconds):
+    ages = []
+    seq = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        new_seq = detector.wait_state(seq, 0.5)
+        if new_seq != seq:
+            ages.append(time.perf_counter() - detector.frame_ts)
+        seq = new_seq
+    return np.array(ages)
+
+def bench_ipc(args):
+    # the busy thread stands in for the Tk main loop holding the GIL
+    load = {'on': False}
+    def busy():
+        while load['on']:
+            sum(range(1000))
+    print(f'{"mode":<10}{"gui load":>10}{"wakes":>8}{"p50 us":>12}{"p99 us":>12}{"jitter us":>12}')
+    for mode in ('thread', 'process'):
+        for loaded in (False, True):
+            if mode == 'thread':
+                detector = Detection('bench', StatusChannel(), 20, 50, 90, 20, capture=ipc_source())
+                detector.start()
+            else:
+                detector = RemoteDetector('bench', StatusChannel(), 20, 50, 90, 20, capture_factory=ipc_source)
+            load['on'] = loaded
+            busy_threads = [Thread(target=busy) for i in range(args.load_threads if loaded else 0)]
+            for t in busy_threads:
+                t.start()
+            try:
+                ages = wake_ages(detector, args.seconds)
+            finally:
+                load['on'] = False
+                for t in busy_threads:
+                    t.join()
+                if detector.wincap is not None:
+                    detector.wincap.stop()
+                detector.stop()
+            if ages.size == 0:
+                print(f'{mode:<10}{str(loaded):>10}{0:>8}')
+                continue
+            # jitter is the standard deviation of the frame age at wake up
+            print(f'{mode:<10}{str(loaded):>10}{ages.size:>8}{np.percentile(ages, 50) * 1e6:12.1f}'
+                  f'{np.percentile(ages, 99) * 1e6:12.1f}{ages.std() * 1e6:12.1f}')
+
+# party panel with rows bars at pitch pixels, each filled to one of the pcts
+def party_frame(w, h, x, y, pcts, pitch=22, width=130):
+    frame = np.full((h, w, 3), 70, dtype='uint8')
+    for i, pct in enumerate(pcts):
+        row = y + i * pitch
+        frame[row, x - 1] = (0, 0, 0)
+        frame[row, x:x + width] = (20, 20, 20)
+        frame[row, x:x + int(width * pct / 100)] = (0, 192, 0)
+    return frame
+
+def bench_party(args):
+    rng = np.random.default_rng(0)
+    print(f'{"rows":>6}{"read us":>12}{"us per row":>12}')
+    for rows in args.rows:
+        party = PartyDetector(40, 30, rows)
+        frame = party_frame(200, 30 + rows * 22 + 10, 40, 30, rng.integers(0, 101, rows))
+        durations = sample(lambda: party.read(frame, (0, 0)), args.repeat)
+        p50 = np.percentile(durations, 50) * 1e6
+        print(f'{rows:>6}{p50:12.1f}{p50 / rows:12.2f}')
+
+# font atlas of random 6x9 glyphs, the decoder only needs them to differ
+def synthetic_atlas(path, seed=0):
+    rng = np.random.default_rng(seed)
+    glyphs = rng.random((9, 60)) > 0.5
+    atlas = np.zeros((9, 60, 3), dtype='uint8')
+    atlas[glyphs] = 220
+    cv.imwrite(path, atlas)
+    return atlas
+
+def bench_digits(args):
+    path = os.path.join(tempfile.gettempdir(), 'bench-digits.png')
+    atlas = synthetic_atlas(path)
+    print(f'{"cells":>6}{"decode us":>12}{"us per cell":>12}')
+    for cells in args.cells:
+        decoder = GlyphDecoder(path, cells)
+        frame = np.zeros((9, cells * 6, 3), dtype='uint8')
+        for i in range(cells):
+            digit = (i * 7 + 1) % 10
+            frame[:, i * 6:(i + 1) * 6] = atlas[:, digit * 6:(digit + 1) * 6]
+        durations = sample(lambda: decoder.decode(frame, 0, 0), args.repeat)
+        p50 = np.percentile(durations, 50) * 1e6
+        print(f'{cells:>6}{p50:12.1f}{p50 / cells:12.2f}')
+    os.remove(path)
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        limit = baseline[key]['p50_us'] * (1 + tolerance)
+        if result['p50_us'] > limit:
+            regressions.append(f'{key}: p50 {result["p50_us"]:.1f} us > {limit:.1f} us')
+    return regressions
+
+def bench_suite(args):
+    results = bench_detection(args)
+    print(f'{"case":<28}{"ops/s":>12}{"p50 us":>12}{"p90 us":>12}{"p99 us":>12}')
+    for key, r in results.items():
+        print(f'{key:<28}{r["ops_per_sec"]:12.1f}{r["p50_us"]:12.1f}{r["p90_us"]:12.1f}{r["p99_us"]:12.1f}')
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=1)
+        print(f'baseline saved to {args.baseline}')
+        return 0
+    if not os.path.exists(args.baseline):
+        return 0
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f), args.tolerance)
+    for line in regressions:
+        print('REGRESSION', line)
+    return 1 if regressions else 0
+
+def main():
+    parser = argparse.ArgumentParser(description='Healer benchmarks')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p_capture = sub.add_parser('capture', help='grabs per second of the capture backends')
+    p_capture.add_argument('--window', default=None, help='window title, default is the whole screen')
+    p_capture.add_argument('--seconds', type=float, default=2)
+    p_capture.set_defaults(func=bench_capture)
+    p_vision = sub.add_parser('vision', help='full frame find against find_in on the icon strip')
+    p_vision.add_argument('--width', type=int, default=1920)
+    p_vision.add_argument('--height', type=int, default=1080)
+    p_vision.add_argument('--repeat', type=int, default=50)
+    p_vision.set_defaults(func=bench_vision)
+    p_suite = sub.add_parser('detection', help='detection hot path on synthetic frames, fails on regressions')
+    p_suite.add_argument('--resolutions', nargs='+', choices=list(RESOLUTIONS), default=list(RESOLUTIONS))
+    p_suite.add_argument('--repeat', type=int, default=200)
+    p_suite.add_argument('--baseline', default=BASELINE)
+    p_suite.add_argument('--save-baseline', action='store_true')
+    p_suite.add_argument('--tolerance', type=float, default=0.25, help='allowed p50 slowdown, 0.25 is 25%%')
+    p_suite.set_defaults(func=bench_suite)
+    p_party = sub.add_parser('party', help='cost of reading the whole party panel against its size')
+    p_party.add_argument('--rows', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32])
+    p_party.add_argument('--repeat', type=int, default=2000)
+    p_party.set_defaults(func=bench_party)
+    p_digits = sub.add_parser('digits', help='cost of decoding a number field against its length')
+    p_digits.add_argument('--cells', type=int, nargs='+', default=[3, 5, 7])
+    p_digits.add_argument('--repeat', type=int, default=2000)
+    p_digits.set_defaults(func=bench_digits)
+    p_ipc = sub.add_parser('ipc', help='frame age at wake up, detection thread against detection process')
+    p_ipc.add_argument('--seconds', type=float, default=3)
+    p_ipc.add_argument('--load-threads', type=int, default=2, help='busy threads that simulate the gui')
+    p_ipc.set_defaults(func=bench_ipc)
+    args = parser.parse_args()
+    return args.func(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
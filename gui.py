@@ -0,0 +1,278 @@
+import time
+import tkinter as tk
+from tkinter import ttk
+from healer import Healer, MultiHealer, MetricsExporter, StatusChannel, Profiler, register_profile_hotkey, metrics, METRICS_FILE, METRICS_PORT
+
+class App(tk.Tk):
+    # ms between two ui updates
+    UI_INTERVAL = 100
+    healer = None
+    def __init__(self):
+        super().__init__()
+        #setup
+        self.title('Healer')
+        self.iconbitmap(r'logo.ico')
+        self.geometry("300x300")
+        self.wm_attributes("-topmost", True)
+        #widgets
+        self.Tabs = Notebook(self)
+        self.nameMenu = Menu(self.Tabs.tab1)
+        self.healerSetup = HealerSetup(self.Tabs.tab1)
+        self.buttonMenu = ButtonMenu(self.Tabs.tab1, self.start, self.stop, self.profile)
+        self.textMenu = TextMenu(self.Tabs.tab1)
+        self.statusPanel = StatusPanel(self.Tabs.tab1)
+        self.suportSetup = SuportSetup(self.Tabs.tab2)
+        self.stopped_macro = False
+        # the worker threads write here, never to the widgets
+        self.status = StatusChannel()
+        self.last_steps = (0, time.perf_counter())
+        self.after(self.UI_INTERVAL, self.drain)
+        # the profiler runs from the button or the hotkey
+        self.profiler = Profiler(label_text=self.status)
+        register_profile_hotkey(self.profiler)
+        # export the metrics when asked to
+        self.exporter = MetricsExporter(metrics, METRICS_FILE, METRICS_PORT)
+        if METRICS_FILE is not None or METRICS_PORT is not None:
+            self.exporter.start()
+        #run
+        self.mainloop()
+
+    def start(self):
+
+        # several characters separated by commas run in one MultiHealer
+        names = [name.strip() for name in self.nameMenu.e_0.get().split(',') if name.strip()]
+        healers = [Healer(name, self.healerSetup.e_3.get(), self.healerSetup.e_2.get(), self.healerSetup.e_1.get(),
+        self.healerSetup.e_4.get(), self.status, self.healerSetup.e_3_1.get(), self.healerSetup.e_2_1.get(), self.healerSetup.e_1_1.get(), self.healerSetup.e_4_1.get(), self.suportSetup.e_hk_food.get(), self.suportSetup.cb_food_var, self.suportSetup.e_hk_hast.get(), self.suportSetup.cb_hast_var, self.suportSetup.cb_predict_var.get() == 1, self.suportSetup.cb_isolate_var.get() == 1)
+        for name in names]
+        if len(healers) == 1:
+            self.healer = healers[0]
+        else:
+            self.healer = MultiHealer(healers)
+        self.healer.start()
+
+    def stop(self):
+        self.status['text'] = f"Macro Parado"
+        self.healer.stop()
+
+    def profile(self):
+        self.profiler.toggle()
+
+    # show what the threads wrote since the last tick, a label text and a few
+    # numbers, so the cost does not grow with how often they change
+    def drain(self):
+        changes = self.status.changes()
+        if 'text' in changes:
+            self.textMenu.l_5['text'] = changes['text']
+        values = self.healer.telemetry() if self.healer is not None else None
+        if values is not None:
+            t_now = time.perf_counter()
+            steps, t_last = self.last_steps
+            rate = (values['steps'] - steps) / (t_now - t_last) if values['steps'] >= steps else 0
+            self.last_steps = (values['steps'], t_now)
+            self.statusPanel.show(rate, values['life'], values['mana'], values['latency'], values['cpu'],
+                                  values['life_value'], values['mana_value'], values['life_eta'])
+        self.after(self.UI_INTERVAL, self.drain)
+
+class Notebook(ttk.Notebook):
+    def __init__(self, parent):
+        super().__init__(parent)
+
+        self.tab1 = ttk.Frame(self)
+        self.tab2 = ttk.Frame(self)
+        self.add(self.tab1, text = 'Healer Setup')
+        self.add(self.tab2, text = 'Suport Setup')
+        self.pack(fill = 'both', expand = True, padx = 5, pady = 5)
+
+class Menu(ttk.Frame):
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.pack(fill = 'both', expand = True, padx = 5, pady = 5)
+        self.create_widgets()
+
+    def create_widgets(self):
+        #Texto nome do char
+        self.l_0 = ttk.Label(self, text="Nome do Char:")
+        self.l_0.pack(side = 'left', fill = 'both', expand = True)
+        #Entrada do char
+        self.e_0 = ttk.Entry(self, width = 20)
+        self.e_0.insert(0,'Royal John')
+        self.e_0.pack(side = 'left', fill = 'x', expand = True)
+
+class HealerSetup(ttk.Frame):
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.pack(fill = 'both', expand = True, padx = 5, pady = 0)
+        self.cura_maior_frame = ttk.Frame(self)
+        self.cura_maior_frame.pack(fill = 'both', expand = True, padx = 5, pady = 0)
+        self.cura_media_frame = ttk.Frame(self)
+        self.cura_media_frame.pack(fill = 'both', expand = True, padx = 5, pady = 0)
+        self.cura_menor_frame = ttk.Frame(self)
+        self.cura_menor_frame.pack(fill = 'both', expand = True, padx = 5, pady = 0)
+        self.cura_mana_frame = ttk.Frame(self)
+        self.cura_mana_frame.pack(fill = 'both', expand = True, padx = 5, pady = 0)
+        self.create_widgets()
+
+    def create_widgets(self):
+        #Texto cura maior ----------------------------------------------
+        self.l_1 = ttk.Label(self.cura_maior_frame, text="Curar Maior:")
+        self.l_1.pack(side = 'left', fill = 'x', expand = False)
+        #Entrada cura maior
+        self.e_1 = ttk.Entry(self.cura_maior_frame, width = 6)
+        self.e_1.pack(side = 'left', fill = 'x', expand = False)
+        self.e_1.insert(0,'20')
+        #Texto porcentagem
+        self.l_1_1 = ttk.Label(self.cura_maior_frame, text="%")
+        self.l_1_1.pack(side = 'left', fill = 'x', expand = False)
+        #Texto hotkey
+        self.l_1_2 = ttk.Label(self.cura_maior_frame, text="HotKey:")
+        self.l_1_2.pack(side = 'left', fill = 'x', expand = False)
+        #Entrada hotkey cura maior
+        self.e_1_1 = ttk.Entry(self.cura_maior_frame, width = 2)
+        self.e_1_1.pack(side = 'left', fill = 'x', expand = False)
+        self.e_1_1.insert(0,'f4')
+        #Texto cura media ----------------------------------------------
+        self.label_text = ttk.Label(self.cura_media_frame, text="Curar Media:")
+        self.label_text.pack(side = 'left', fill = 'x', expand = False)
+        #Entrada cura media
+        self.e_2 = ttk.Entry(self.cura_media_frame, width = 6)
+        self.e_2.pack(side = 'left', fill = 'x', expand = False)
+        self.e_2.insert(0,'50')
+        #Texto porcentagem media
+        self.label_text_1 = ttk.Label(self.cura_media_frame, text="%")
+        self.label_text_1.pack(side = 'left', fill = 'x', expand = False)
+        #Texto hotkey
+        self.label_text_2 = ttk.Label(self.cura_media_frame, text="HotKey:")
+        self.label_text_2.pack(side = 'left', fill = 'x', expand = False)
+        #Entrada hotkey cura maior
+        self.e_2_1 = ttk.Entry(self.cura_media_frame, width = 2)
+        self.e_2_1.pack(side = 'left', fill = 'x', expand = False)
+        self.e_2_1.insert(0,'f3')
+        #Texto cura menor ----------------------------------------------
+        self.l_3 = ttk.Label(self.cura_menor_frame,text="Curar Menor:")
+        self.l_3.pack(side = 'left', fill = 'x', expand = False)
+        #Entrada cura menor
+        self.e_3 = ttk.Entry(self.cura_menor_frame, width = 6)
+        self.e_3.pack(side = 'left', fill = 'x', expand = False)
+        self.e_3.insert(0,'90')
+        #Texto porcentagem
+        self.l_3_1 = ttk.Label(self.cura_menor_frame,text="%")
+        self.l_3_1.pack(side = 'left', fill = 'x', expand = False)
+        #Texto hotkey
+        self.l_3_2 = ttk.Label(self.cura_menor_frame, text="HotKey:")
+        self.l_3_2.pack(side = 'left', fill = 'x', expand = False)
+        #Entrada hotkey cura maior
+        self.e_3_1 = ttk.Entry(self.cura_menor_frame, width = 2)
+        self.e_3_1.pack(side = 'left', fill = 'x', expand = False)
+        self.e_3_1.insert(0,'f1')
+        #Texto cura mana ----------------------------------------------
+        self.l_4 = ttk.Label(self.cura_mana_frame,text="Curar Mana:")
+        self.l_4.pack(side = 'left', fill = 'x', expand = False)
+        #Entrada cura mana
+        self.e_4 = ttk.Entry(self.cura_mana_frame, width = 6)
+        self.e_4.pack(side = 'left', fill = 'x', expand = False)
+        self.e_4.insert(0,'20')
+        #Texto porcentagem
+        self.l_4_1 = ttk.Label(self.cura_mana_frame, text="%")
+        self.l_4_1.pack(side = 'left', fill = 'x', expand = False)
+        #Texto hotkey
+        self.l_4_2 = ttk.Label(self.cura_mana_frame, text="HotKey:")
+        self.l_4_2.pack(side = 'left', fill = 'x', expand = False)
+        #Entrada hotkey cura maior
+        self.e_4_1 = ttk.Entry(self.cura_mana_frame, width = 2)
+        self.e_4_1.pack(side = 'left', fill = 'x', expand = False)
+        self.e_4_1.insert(0,'f2')
+
+class ButtonMenu(ttk.Frame):
+    def __init__(self, parent, bt1_func, bt2_func, bt3_func):
+        super().__init__(parent)
+        self.pack(fill = 'both', expand = True, padx = 5, pady = 0)
+        self.create_widgets(bt1_func, bt2_func, bt3_func)
+
+    def create_widgets(self,bt1_func, bt2_func, bt3_func):
+        #Cria botão Iniciar
+        self.b_1 = ttk.Button(self, text="Iniciar Macro", command = bt1_func)
+        self.b_1.pack(side = 'left', fill = 'x', expand = True)
+        #Cria botão Parar
+        self.b_2 = ttk.Button(self, text="Parar Macro", command = bt2_func)
+        self.b_2.pack(side = 'left', fill = 'x', expand = True)
+        #Cria botão Perfil
+        self.b_3 = ttk.Button(self, text="Perfil", command = bt3_func)
+        self.b_3.pack(side = 'left', fill = 'x', expand = True)
+
+class TextMenu(ttk.Frame):
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.pack(fill = 'both', expand = True, padx = 5, pady = 5)
+        self.create_widgets()
+
+
+    def create_widgets(self):
+        self.l_5 = ttk.Label(self,text=" Bem vindo ao macro!")
+        self.l_5.pack(side = 'left', fill = 'x', expand = True)
+
+class StatusPanel(ttk.Frame):
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.pack(fill = 'both', expand = True, padx = 5, pady = 0)
+        self.create_widgets()
+
+    def create_widgets(self):
+        #Texto taxa, vida, mana e latencia
+        self.l_panel = ttk.Label(self, text="")
+        self.l_panel.pack(side = 'left', fill = 'x', expand = True)
+
+    def show(self, rate, life, mana, latency, cpu, life_value=None, mana_value=None, life_eta=None):
+        # os pontos lidos dos numeros quando tem o digits.png
+        hp = f"{life_value}" if life_value is not None else f"{life:3.0f}%"
+        mp = f"{mana_value}" if mana_value is not None else f"{mana:3.0f}%"
+        # tempo ate a cura forte enquanto a vida cai
+        if life_eta is not None:
+            hp += f" ({life_eta:.1f}s)"
+        self.l_panel['text'] = f"{rate:3.0f} fps HP {hp} MP {mp} {latency * 1000:3.0f} ms cpu {cpu * 100:2.0f}%"
+
+class SuportSetup(ttk.Frame):
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.pack(fill = 'both', expand = True, padx = 5, pady = 5)
+        self.create_widgets()
+
+    def create_widgets(self):
+        #Texto Hast -------------------------------------------------
+        self.l_hast = ttk.Label(self, text="Hast:")
+        self.l_hast.pack(side = 'left', fill = 'x')
+        #Entrada hotkey hast
+        self.e_hk_hast = ttk.Entry(self, width = 2)
+        self.e_hk_hast.pack(side = 'left', fill = 'x', expand = False)
+        self.e_hk_hast.insert(0,'f6')
+        #check box
+        self.cb_hast_var = tk.IntVar()
+        self.cb_hast = tk.Checkbutton(self, variable = self.cb_hast_var, onvalue=1, offvalue=0)
+        self.cb_hast.pack(side = 'left')
+        #Texto Food -------------------------------------------------
+        self.l_food = ttk.Label(self, text="Food:")
+        self.l_food.pack(side = 'left', fill = 'x')
+        #Entrada hotkey food
+        self.e_hk_food = ttk.Entry(self, width = 2)
+        self.e_hk_food.pack(side = 'left', fill = 'x', expand = False)
+        self.e_hk_food.insert(0,'f5')
+        #check box
+        self.cb_food_var = tk.IntVar()
+        self.cb_food = tk.Checkbutton(self, variable = self.cb_food_var, onvalue=1, offvalue=0)
+        self.cb_food.pack(side = 'left')
+        #Texto Prever -----------------------------------------------
+        self.l_predict = ttk.Label(self, text="Prever:")
+        self.l_predict.pack(side = 'left', fill = 'x')
+        #check box, cura antes pela queda da vida
+        self.cb_predict_var = tk.IntVar()
+        self.cb_predict = tk.Checkbutton(self, variable = self.cb_predict_var, onvalue=1, offvalue=0)
+        self.cb_predict.pack(side = 'left')
+        #Texto Processo ---------------------------------------------
+        self.l_isolate = ttk.Label(self, text="Processo:")
+        self.l_isolate.pack(side = 'left', fill = 'x')
+        #check box, captura e detecção em outro processo
+        self.cb_isolate_var = tk.IntVar()
+        self.cb_isolate = tk.Checkbutton(self, variable = self.cb_isolate_var, onvalue=1, offvalue=0)
+        self.cb_isolate.pack(side = 'left')
+
+if __name__ == '__main__':
+    App()
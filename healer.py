@@ -1,94 +1,708 @@
-import cv2 as cv
-import numpy as np
-import os
-import pyautogui
 import time
-import keyboard
-import tkinter as tk
-from threading import Thread, Lock
-from PIL import Image, ImageOps
-import win32gui, win32ui, win32con
-from tkinter import ttk
+# the start-up report counts from here
+T_START = time.perf_counter()
+import os
+import sys
+import zlib
+import json
+import heapq
+import struct
+import mmap
+import argparse
+import tempfile
+import importlib
+import importlib.util
+import itertools
+import threading
+import multiprocessing
+import ctypes
+import ctypes.util
+from threading import Thread, Lock, RLock, Condition
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+class StartupReport:
+
+    # constructor
+    def __init__(self):
+        # seconds since T_START of each step of the start-up
+        self.marks = {}
+        # seconds each lazy module took to import
+        self.imports = {}
+        # seconds of the other slow steps, like the calibration
+        self.durations = {}
+
+    def mark(self, name):
+        if name not in self.marks:
+            self.marks[name] = time.perf_counter() - T_START
+
+    def lines(self):
+        lines = [f'{name + " at":<24}{value * 1000:10.1f} ms' for name, value in self.marks.items()]
+        lines += [f'{name:<24}{value * 1000:10.1f} ms' for name, value in self.durations.items()]
+        lines += [f'{"import " + name:<24}{value * 1000:10.1f} ms' for name, value in self.imports.items()]
+        return lines
+
+startup = StartupReport()
+
+class LazyModule:
+
+    # stands in for a module and imports it on the first attribute access,
+    # so a run only pays for the backends it uses
+    def __init__(self, name):
+        self.__dict__['name'] = name
+        self.__dict__['module'] = None
+
+    def load(self):
+        if self.module is None:
+            t_start = time.perf_counter()
+            self.__dict__['module'] = importlib.import_module(self.name)
+            startup.imports[self.name] = time.perf_counter() - t_start
+        return self.module
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self.load(), attr, value)
+
+# None when the module is not installed, like a failed import
+def optional_module(name):
+    if importlib.util.find_spec(name) is None:
+        return None
+    return LazyModule(name)
+
+cv = LazyModule('cv2')
+np = LazyModule('numpy')
+pyautogui = LazyModule('pyautogui')
+keyboard = LazyModule('keyboard')
+http_server = LazyModule('http.server')
+# win32 is only available on windows, the X11 capture is used elsewhere
+win32gui = optional_module('win32gui')
+win32ui = optional_module('win32ui')
+win32con = optional_module('win32con')
+
+class Histogram:
+
+    # log-linear buckets like HdrHistogram: values are kept in microseconds,
+    # exact below 2**SUB and with 2**(SUB-1) buckets per power of two above
+    SUB = 5
+    SIZE = 2 ** 5 + 32 * 2 ** 4
+
+    # constructor
+    def __init__(self):
+        self.counts = [0] * self.SIZE
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def index(self, value):
+        if value < 2 ** self.SUB:
+            return value
+        e = value.bit_length() - self.SUB
+        index = 2 ** self.SUB + (e - 1) * 2 ** (self.SUB - 1) + (value >> e) - 2 ** (self.SUB - 1)
+        return min(index, self.SIZE - 1)
+
+    # highest value of a bucket
+    def value(self, index):
+        if index < 2 ** self.SUB:
+            return index
+        k = index - 2 ** self.SUB
+        e = k // 2 ** (self.SUB - 1) + 1
+        m = k % 2 ** (self.SUB - 1) + 2 ** (self.SUB - 1)
+        return ((m + 1) << e) - 1
+
+    def record(self, seconds):
+        value = max(int(seconds * 1e6), 0)
+        self.counts[self.index(value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    # value in seconds below which p % of the records are
+    def percentile(self, p):
+        if self.count == 0:
+            return 0
+        rank = p / 100 * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(self.value(index), self.max) / 1e6
+        return self.max / 1e6
+
+    def summary(self):
+        return {'count': self.count,
+                'mean': self.total / self.count / 1e6 if self.count else 0,
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99),
+                'max': self.max / 1e6}
+
+class Metrics:
+
+    # properties
+    lock = None
+
+    # constructor
+    def __init__(self):
+        self.lock = Lock()
+        # stage name -> Histogram of its durations in seconds
+        self.histograms = {}
+        # name -> last value of things that are not durations, like the cpu use
+        self.gauges = {}
+
+    def record(self, stage, seconds):
+        self.lock.acquire()
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = Histogram()
+        histogram.record(seconds)
+        self.lock.release()
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def summary(self):
+        self.lock.acquire()
+        summary = {stage: histogram.summary() for stage, histogram in self.histograms.items()}
+        self.lock.release()
+        return summary
+
+    # prometheus text format, one summary per stage. A stage named
+    # 'name:key' is the stage name with a key label
+    def prometheus(self):
+        lines = ['# TYPE healer_stage_seconds summary']
+        for stage, s in sorted(self.summary().items()):
+            name, _, key = stage.partition(':')
+            labels = f'stage="{name}",key="{key}"' if key else f'stage="{name}"'
+            for q, quantile in (('p50', '0.5'), ('p90', '0.9'), ('p99', '0.99')):
+                lines.append(f'healer_stage_seconds{{{labels},quantile="{quantile}"}} {s[q]:.6f}')
+            lines.append(f'healer_stage_seconds_sum{{{labels}}} {s["mean"] * s["count"]:.6f}')
+            lines.append(f'healer_stage_seconds_count{{{labels}}} {s["count"]}')
+        lines.append('# TYPE healer_gauge gauge')
+        for name, value in sorted(self.gauges.items()):
+            lines.append(f'healer_gauge{{name="{name}"}} {value:.6f}')
+        return '\n'.join(lines) + '\n'
+
+    # one line per stage
+    def csv(self):
+        lines = ['stage,count,mean,p50,p90,p99,max']
+        for stage, s in sorted(self.summary().items()):
+            lines.append(f'{stage},{s["count"]},{s["mean"]:.6f},{s["p50"]:.6f},{s["p90"]:.6f},{s["p99"]:.6f},{s["max"]:.6f}')
+        return '\n'.join(lines) + '\n'
+
+# metrics of every stage of the pipeline
+metrics = Metrics()
+# set HEALER_METRICS_FILE (.json or .csv) and/or HEALER_METRICS_PORT to export them
+METRICS_FILE = os.environ.get('HEALER_METRICS_FILE')
+METRICS_PORT = int(os.environ['HEALER_METRICS_PORT']) if os.environ.get('HEALER_METRICS_PORT') else None
+
+class MetricsExporter:
+
+    # threading properties
+    stopped = True
+
+    # constructor
+    def __init__(self, metrics, path=None, port=None, interval=5):
+        self.metrics = metrics
+        # file rewritten every interval seconds, .csv or json
+        self.path = path
+        self.interval = interval
+        # prometheus endpoint on localhost
+        self.port = port
+        self.server = None
+
+    def flush(self):
+        if self.path.endswith('.csv'):
+            text = self.metrics.csv()
+        else:
+            text = json.dumps({'stages': self.metrics.summary(), 'gauges': dict(self.metrics.gauges)}, indent=1)
+        # write and rename so readers never see half a file
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, self.path)
+
+    def start(self):
+        self.stopped = False
+        if self.port is not None:
+            exporter = self
+            class Handler(http_server.BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = exporter.metrics.prometheus().encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                def log_message(self, *args):
+                    pass
+            self.server = http_server.ThreadingHTTPServer(('127.0.0.1', self.port), Handler)
+            Thread(target=self.server.serve_forever, daemon=True).start()
+        if self.path is not None:
+            t = Thread(target=self.run, daemon=True)
+            t.start()
+
+    def stop(self):
+        self.stopped = True
+        if self.server is not None:
+            self.server.shutdown()
+            self.server = None
+
+    def run(self):
+        while not self.stopped:
+            time.sleep(self.interval)
+            self.flush()
+
+class CpuMeter:
+
+    # cpu time of the thread that created it and of the whole process, as a
+    # fraction of one core over the last interval
+    def __init__(self):
+        self.t_wall = time.perf_counter()
+        self.t_thread = time.thread_time()
+        self.t_process = time.process_time()
+        self.thread = 0
+        self.process = 0
+
+    # called from the same thread, returns True when the values were updated
+    def update(self, interval=1):
+        t_wall = time.perf_counter()
+        if t_wall - self.t_wall < interval:
+            return False
+        t_thread = time.thread_time()
+        t_process = time.process_time()
+        self.thread = (t_thread - self.t_thread) / (t_wall - self.t_wall)
+        self.process = (t_process - self.t_process) / (t_wall - self.t_wall)
+        self.t_wall, self.t_thread, self.t_process = t_wall, t_thread, t_process
+        return True
+
+class StatusChannel:
+
+    # latest value of each slot. Any thread may replace a value, a single
+    # replacement of a dict item needs no lock. The ui reads the slots at its
+    # own pace, so a state flapping around a threshold costs at most one
+    # widget update per ui tick
+    def __init__(self):
+        self.slots = {}
+        # values the reader has already shown
+        self.seen = {}
+
+    def __setitem__(self, key, value):
+        self.slots[key] = value
+
+    def __getitem__(self, key):
+        return self.slots[key]
+
+    def get(self, key, default=None):
+        return self.slots.get(key, default)
+
+    # slots that changed since the last call, only one reader
+    def changes(self):
+        changed = {}
+        for key, value in list(self.slots.items()):
+            if self.seen.get(key) != value:
+                changed[key] = value
+                self.seen[key] = value
+        return changed
+
+# default hotkey that starts and stops the profiler
+PROFILE_HOTKEY = 'ctrl+alt+p'
+
+class Profiler:
+
+    # threads sampled, by the start of their names
+    THREADS = ('capture', 'detection', 'healer', 'input', 'tick', 'multihealer', 'reanchor')
+
+    # properties
+    running = False
+    stopped = True
+
+    # constructor, samples every interval seconds for at most seconds
+    def __init__(self, seconds=10, interval=0.001, directory='.', label_text=None):
+        self.seconds = seconds
+        self.interval = interval
+        self.directory = directory
+        self.label_text = label_text
+        # paths of the last dump
+        self.paths = None
+
+    def toggle(self):
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    # nothing is sampled nor hooked while it is not running
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.stopped = False
+        t = Thread(target=self.run, name='profiler', daemon=True)
+        t.start()
+
+    def stop(self):
+        self.stopped = True
+
+    # name of a function, with its class from python 3.11 on
+    def function(self, code):
+        return getattr(code, 'co_qualname', code.co_name)
+
+    # caller;callee stack of a frame, the leaf keeps its line so the C call
+    # it is blocked in (matchTemplate, BitBlt...) can be told apart
+    def stack(self, frame):
+        names = [f'{self.function(frame.f_code)} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})']
+        frame = frame.f_back
+        while frame is not None:
+            names.append(self.function(frame.f_code))
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def run(self):
+        if self.label_text is not None:
+            self.label_text['text'] = f'Perfil: gravando {self.seconds}s'
+        # (thread name, stack) -> samples
+        counts = {}
+        names = {}
+        samples = 0
+        deadline = time.perf_counter() + self.seconds
+        while not self.stopped and time.perf_counter() < deadline:
+            # thread names only change when threads start, refresh them now and then
+            if samples % 100 == 0:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                name = names.get(ident)
+                if name is None or not name.startswith(self.THREADS):
+                    continue
+                key = (name, self.stack(frame))
+                counts[key] = counts.get(key, 0) + 1
+            samples += 1
+            time.sleep(self.interval)
+        self.paths = self.dump(counts)
+        self.running = False
+        if self.label_text is not None:
+            self.label_text['text'] = f'Perfil salvo: {self.paths[0]}'
+
+    # write the collapsed stacks (flamegraph.pl, speedscope) and the call
+    # tree of each thread, returns both paths
+    def dump(self, counts):
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        collapsed = os.path.join(self.directory, f'profile-{stamp}.collapsed')
+        with open(collapsed, 'w') as f:
+            for (name, stack), count in sorted(counts.items()):
+                f.write(f'{name};{stack} {count}\n')
+        # thread -> nested {function: [samples, children]}
+        trees = {}
+        for (name, stack), count in counts.items():
+            node = trees.setdefault(name, [0, {}])
+            node[0] += count
+            for function in stack.split(';'):
+                node = node[1].setdefault(function, [0, {}])
+                node[0] += count
+        report = os.path.join(self.directory, f'profile-{stamp}.txt')
+        with open(report, 'w') as f:
+            for name, (total, children) in sorted(trees.items()):
+                f.write(f'{name}: {total} samples\n')
+                self.write_tree(f, children, total, 1)
+        return collapsed, report
+
+    # one line per call with its share of the thread samples, calls under 1% are left out
+    def write_tree(self, f, children, total, depth):
+        for function, (count, grandchildren) in sorted(children.items(), key=lambda item: -item[1][0]):
+            if count * 100 < total:
+                continue
+            f.write(f'{"  " * depth}{100 * count / total:5.1f}% {count:6d} {function}\n')
+            self.write_tree(f, grandchildren, total, depth + 1)
+
+# start and stop the profiler with a global hotkey, False when the keyboard
+# module can not hook the keys (not installed, or not root on linux)
+def register_profile_hotkey(profiler, hotkey=PROFILE_HOTKEY):
+    try:
+        keyboard.add_hotkey(hotkey, profiler.toggle)
+    except (ImportError, OSError):
+        return False
+    return True
+
+class Frame:
+
+    # properties
+    buf = None
+    img = None
+    seq = 0
+    ts = 0
+    # rectangle of the window the image was grabbed from
+    rect = None
+    # position of the buffer in the pool of the frame source, and of the
+    # pixels inside it for the parts of a frame
+    index = 0
+    offset = 0
+    # name -> (image, rect) of the small regions grabbed with the frame
+    regions = {}
+
+    # constructor
+    def __init__(self, buf, index=0):
+        # preallocated BGRA pixels, the image is a view over it
+        self.buf = buf
+        self.index = index
+        # name -> Frame over the buffer after the main image, one per region
+        self.parts = {}
+
+class FrameBuffer:
+
+    # properties
+    seq = 0
+    lock = None
+
+    # constructor
+    def __init__(self, buffers):
+        # create a thread lock object, readers wait on it for new frames
+        self.lock = Lock()
+        self.new_frame = Condition(self.lock)
+        # triple buffer: the writer fills the back frame, publish swaps it with
+        # the ready one and the reader swaps ready with front, so nobody
+        # writes a frame while it is being read
+        self.frames = [Frame(buf, i) for i, buf in enumerate(buffers)]
+        self.back = 0
+        self.ready = 1
+        self.front = 2
+        self.fresh = False
+
+    # swap in bigger buffers, frames already handed out stay valid
+    def replace(self, buffers):
+        self.lock.acquire()
+        self.frames = [Frame(buf, i) for i, buf in enumerate(buffers)]
+        self.fresh = False
+        self.lock.release()
+
+    # frame the writer must fill
+    def back_frame(self):
+        return self.frames[self.back]
+
+    def publish(self, ts, rect):
+        frame = self.frames[self.back]
+        frame.ts = ts
+        frame.rect = rect
+        self.lock.acquire()
+        self.seq += 1
+        frame.seq = self.seq
+        self.back, self.ready = self.ready, self.back
+        self.fresh = True
+        self.new_frame.notify_all()
+        self.lock.release()
+
+    # newest published frame, it stays valid until the next call
+    # (there must be only one reader)
+    def latest(self):
+        self.lock.acquire()
+        if self.fresh:
+            self.front, self.ready = self.ready, self.front
+            self.fresh = False
+        frame = self.frames[self.front]
+        self.lock.release()
+        if frame.seq == 0:
+            return None
+        return frame
 
-class WindowCapture:
+    # block until a frame newer than seq is published and return the newest one,
+    # the frames in between are dropped. Returns None on timeout
+    def wait(self, seq, timeout=None):
+        self.lock.acquire()
+        fresh = self.new_frame.wait_for(lambda: self.seq > seq, timeout)
+        self.lock.release()
+        if not fresh:
+            return None
+        return self.latest()
+
+class FrameSource:
 
     # properties
     w = 0
     h = 0
-    hwnd = None
-    screenshot = None
-    cropped_x = 0
-    cropped_y = 0
     offset_x = 0
     offset_y = 0
+    frames = None
+    # threading properties
+    stopped = True
+    lock = None
+    # grabs per second of the running thread and its share of a core
+    fps = 0
+    cpu = 0
+    # the game is polled at most this many times per second
+    max_fps = 60
+    backend = None
+    # region of interest (x, y, w, h) in window coordinates, None grabs the whole window
+    roi = None
+    # small rectangles away from it grabbed with every frame, name -> (x, y, w, h)
+    # in window coordinates, so the region of interest doesn't grow to them
+    regions = {}
+    # the window position and size are checked this often in seconds
+    geometry_interval = 0.5
+    geometry_checked = 0
+    # time stamp of the frames, a replay puts the recorded times here
+    clock = time.perf_counter
 
     # constructor
-    def __init__(self, window_name=None):
+    def __init__(self):
         # create a thread lock object
         self.lock = Lock()
-        # find the handle for the window we want to capture.
-        # if no window name is given, capture the entire screen
-        if window_name is None:
-            self.hwnd = win32gui.GetDesktopWindow()
-        else:
-            self.hwnd = win32gui.FindWindow(None, window_name)
-            if not self.hwnd:
-                raise Exception('Window not found: {}'.format(window_name))
 
-        # get the window size
-        window_rect = win32gui.GetWindowRect(self.hwnd)
-        self.w = window_rect[2] - window_rect[0]
-        self.h = window_rect[3] - window_rect[1]
+    # allocate the frame pool once the window size is known, plus a spare
+    # buffer for the one-off grabs of the whole window
+    def create_buffers(self):
+        return [np.empty(self.w * self.h * 4, dtype='uint8') for i in range(4)]
 
-        # account for the window border and titlebar and cut them off
-        border_pixels = 8
-        titlebar_pixels = 8
-        self.w = self.w - (border_pixels * 2)
-        self.h = self.h - titlebar_pixels - border_pixels
-        self.cropped_x = border_pixels
-        self.cropped_y = titlebar_pixels
+    def create_frames(self):
+        buffers = self.create_buffers()
+        self.spare = Frame(buffers[3], 3)
+        if self.frames is None:
+            self.frames = FrameBuffer(buffers[:3])
+        else:
+            self.frames.replace(buffers[:3])
 
-        # set the cropped coordinates offset so we can translate screenshot
-        # images into actual screen positions
-        self.offset_x = window_rect[0] + self.cropped_x
-        self.offset_y = window_rect[1] + self.cropped_y
+    # (offset_x, offset_y, w, h) of the window right now
+    def window_geometry(self):
+        return (self.offset_x, self.offset_y, self.w, self.h)
 
-    def get_screenshot(self):
+    # follow the window when it moves or is resized
+    def update_geometry(self):
+        geometry = self.window_geometry()
+        if geometry == (self.offset_x, self.offset_y, self.w, self.h):
+            return False
+        self.lock.acquire()
+        self.offset_x, self.offset_y, self.w, self.h = geometry
+        # the pool only grows when the window does not fit anymore
+        if self.w * self.h * 4 > self.spare.buf.size:
+            self.create_frames()
+        if self.roi is not None:
+            self.roi = self.clamp(self.roi)
+        self.regions = {name: self.clamp(rect) for name, rect in self.regions.items()}
+        self.lock.release()
+        return True
+
+    # cheap check of the window position and size, at most once every
+    # geometry_interval. Whoever drives the grabs calls it before them
+    def poll_geometry(self, now):
+        if now - self.geometry_checked < self.geometry_interval:
+            return False
+        self.geometry_checked = now
+        return self.update_geometry()
+
+    # grab the whole window into the spare buffer, it does not touch the
+    # region of interest nor the frames of the pool. The image is valid
+    # until the next call, None when the window can't be read right now
+    def grab_full(self):
+        self.lock.acquire()
+        rect = (0, 0, self.w, self.h)
+        grabbed = self.grab_into(self.spare, rect) is not False
+        self.spare.rect = rect
+        self.spare.ts = self.clock()
+        self.lock.release()
+        return self.spare if grabbed else None
 
-        # get the window image data
-        wDC = win32gui.GetWindowDC(self.hwnd)
-        dcObj = win32ui.CreateDCFromHandle(wDC)
-        cDC = dcObj.CreateCompatibleDC()
-        dataBitMap = win32ui.CreateBitmap()
-        dataBitMap.CreateCompatibleBitmap(dcObj, self.w, self.h)
-        cDC.SelectObject(dataBitMap)
-        cDC.BitBlt((0, 0), (self.w, self.h), dcObj, (self.cropped_x, self.cropped_y), win32con.SRCCOPY)
+    # BGRA view of the first w * h pixels of a preallocated buffer
+    def buffer_view(self, buf, w, h):
+        return buf[:w * h * 4].reshape(h, w, 4)
 
-        # convert the raw data into a format opencv can read
-        signedIntsArray = dataBitMap.GetBitmapBits(True)
-        img = np.frombuffer(signedIntsArray, dtype='uint8')
-        img.shape = (self.h, self.w, 4)
+    # grab the rectangle of the window into the frame in place. A backend
+    # returns False when the rectangle can't be read right now
+    def grab_into(self, frame, rect):
+        raise NotImplementedError
 
-        # free resources
-        dcObj.DeleteDC()
-        cDC.DeleteDC()
-        win32gui.ReleaseDC(self.hwnd, wDC)
-        win32gui.DeleteObject(dataBitMap.GetHandle())
+    # grab and publish one frame, a frame that can't be read is skipped and
+    # the last one stays the latest
+    def grab(self):
+        frame = self.frames.back_frame()
+        self.lock.acquire()
+        rect = self.grab_rect()
+        t_start = time.perf_counter()
+        if self.grab_into(frame, rect) is False:
+            self.lock.release()
+            return
+        self.grab_regions(frame, rect)
+        metrics.record('capture', time.perf_counter() - t_start)
+        self.lock.release()
+        self.frames.publish(self.clock(), rect)
+
+    # grab the regions into the frame buffer after the pixels of the main
+    # rectangle, the ones that don't fit anymore are left out
+    def grab_regions(self, frame, rect):
+        frame.regions = {}
+        offset = rect[2] * rect[3] * 4
+        for name, region in self.regions.items():
+            size = region[2] * region[3] * 4
+            if offset + size > frame.buf.size:
+                continue
+            part = frame.parts.get(name)
+            if part is None or part.offset != offset:
+                part = Frame(frame.buf[offset:], frame.index)
+                part.offset = offset
+                frame.parts[name] = part
+            if self.grab_into(part, region) is not False:
+                frame.regions[name] = (part.img, region)
+            offset += size
+
+    # return the current image of the window as a BGR numpy array
+    def get_screenshot(self):
+        self.grab()
+        return self.frames.latest().img
+
+    def get_screen_position(self, pos):
+        x, y = self.roi_origin()
+        return (pos[0] + x + self.offset_x, pos[1] + y + self.offset_y)
 
-        # drop the alpha channel
-        img = img[...,:3]
+    # limit the capture to a rectangle of the window, None goes back to the whole window
+    def set_roi(self, roi):
+        self.lock.acquire()
+        if roi is not None:
+            roi = self.clamp(roi)
+        self.roi = roi
+        self.lock.release()
 
-        # make image C_CONTIGUOUS to avoid errors that look like:
-        img = np.ascontiguousarray(img)
+    # grab these rectangles too, {} for none
+    def set_regions(self, regions):
+        self.lock.acquire()
+        self.regions = {name: self.clamp(rect) for name, rect in regions.items()}
+        self.lock.release()
 
-        return img
+    # keep the rectangle inside the window
+    def clamp(self, rect):
+        x, y, w, h = rect
+        x = max(0, min(x, self.w - 1))
+        y = max(0, min(y, self.h - 1))
+        w = max(1, min(w, self.w - x))
+        h = max(1, min(h, self.h - y))
+        return (x, y, w, h)
+
+    def roi_origin(self):
+        if self.roi is None:
+            return (0, 0)
+        return (self.roi[0], self.roi[1])
+
+    # rectangle grabbed by get_screenshot in window coordinates
+    def grab_rect(self):
+        if self.roi is None:
+            return (0, 0, self.w, self.h)
+        return self.roi
+
+    # free the backend resources
+    def release(self):
+        pass
+
+    # grab frames for some seconds and return the grabs per second
+    def measure_fps(self, seconds=2):
+        grabs = 0
+        t_start = time.perf_counter()
+        while time.perf_counter() - t_start < seconds:
+            self.grab()
+            grabs += 1
+        return grabs / (time.perf_counter() - t_start)
 
-    def get_screen_position(self, pos):
-        return (pos[0] + self.offset_x, pos[1] + self.offset_y)
     # threading methods
     def start(self):
         self.stopped = False
-        t = Thread(target=self.run)
+        t = Thread(target=self.run, name='capture')
         t.start()
 
     def stop(self):
@@ -96,13 +710,365 @@ class WindowCapture:
 
     def run(self):
 
+        grabs = 0
+        meter = CpuMeter()
+        t_fps = time.perf_counter()
+        t_next = t_fps
+        self.geometry_checked = t_fps
         while not self.stopped:
+            self.poll_geometry(t_next)
             # get an updated image of the game
-            screenshot = self.get_screenshot()
-            # lock the thread while updating the results
-            self.lock.acquire()
-            self.screenshot = screenshot
-            self.lock.release()
+            self.grab()
+            # update the grabs per second once a second
+            grabs += 1
+            t_now = time.perf_counter()
+            if t_now - t_fps >= 1:
+                self.fps = grabs / (t_now - t_fps)
+                grabs = 0
+                t_fps = t_now
+                meter.update(0)
+                self.cpu = meter.thread
+                metrics.gauge('cpu_capture', self.cpu)
+                metrics.gauge('capture_fps', self.fps)
+            # sleep until the next capture tick instead of spinning
+            t_next += 1 / self.max_fps
+            delay = t_next - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                t_next = time.perf_counter()
+        self.release()
+
+class ArraySource(FrameSource):
+
+    # frames come from a numpy image instead of a window,
+    # used to run the detection on synthetic or recorded frames
+    backend = 'array'
+
+    # constructor
+    def __init__(self, img):
+        super().__init__()
+        self.img = img
+        self.h, self.w = img.shape[:2]
+        self.create_frames()
+
+    # image returned by the next grabs
+    def set_frame(self, img):
+        self.img = img
+
+    def window_geometry(self):
+        return (0, 0, self.img.shape[1], self.img.shape[0])
+
+    def grab_into(self, frame, rect):
+        x, y, w, h = rect
+        bgra = self.buffer_view(frame.buf, w, h)
+        bgra[..., :3] = self.img[y:y+h, x:x+w]
+        frame.img = bgra[..., :3]
+
+class BITMAPINFOHEADER(ctypes.Structure):
+    _fields_ = [('biSize', ctypes.c_uint32), ('biWidth', ctypes.c_int32), ('biHeight', ctypes.c_int32),
+                ('biPlanes', ctypes.c_uint16), ('biBitCount', ctypes.c_uint16), ('biCompression', ctypes.c_uint32),
+                ('biSizeImage', ctypes.c_uint32), ('biXPelsPerMeter', ctypes.c_int32), ('biYPelsPerMeter', ctypes.c_int32),
+                ('biClrUsed', ctypes.c_uint32), ('biClrImportant', ctypes.c_uint32)]
+
+class WindowCapture(FrameSource):
+
+    # properties
+    hwnd = None
+    cropped_x = 0
+    cropped_y = 0
+    backend = 'gdi'
+    # gdi objects, created once and reused for every grab
+    wDC = None
+    dcObj = None
+    cDC = None
+    dataBitMap = None
+    bitmap_size = None
+
+    # constructor
+    def __init__(self, window_name=None):
+        super().__init__()
+        if win32gui is None:
+            raise Exception('GDI capture needs pywin32')
+        # find the handle for the window we want to capture.
+        # if no window name is given, capture the entire screen
+        if window_name is None:
+            self.hwnd = win32gui.GetDesktopWindow()
+        else:
+            self.hwnd = win32gui.FindWindow(None, window_name)
+            if not self.hwnd:
+                raise Exception('Window not found: {}'.format(window_name))
+
+        # account for the window border and titlebar and cut them off
+        border_pixels = 8
+        titlebar_pixels = 8
+        self.cropped_x = border_pixels
+        self.cropped_y = titlebar_pixels
+        self.offset_x, self.offset_y, self.w, self.h = self.window_geometry()
+
+        self.gdi32 = ctypes.windll.gdi32
+        self.gdi32.GetDIBits.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint, ctypes.c_uint,
+                                         ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint]
+        self.create_frames()
+
+    def window_geometry(self):
+        # get the window size
+        window_rect = win32gui.GetWindowRect(self.hwnd)
+        w = window_rect[2] - window_rect[0] - self.cropped_x * 2
+        h = window_rect[3] - window_rect[1] - self.cropped_y - self.cropped_x
+        # set the cropped coordinates offset so we can translate screenshot
+        # images into actual screen positions
+        return (window_rect[0] + self.cropped_x, window_rect[1] + self.cropped_y, w, h)
+
+    # (re)create the device contexts and a bitmap of the grabbed size
+    def create_bitmap(self, w, h):
+        self.free_bitmap()
+        self.wDC = win32gui.GetWindowDC(self.hwnd)
+        self.dcObj = win32ui.CreateDCFromHandle(self.wDC)
+        self.cDC = self.dcObj.CreateCompatibleDC()
+        self.dataBitMap = win32ui.CreateBitmap()
+        self.dataBitMap.CreateCompatibleBitmap(self.dcObj, w, h)
+        self.cDC.SelectObject(self.dataBitMap)
+        # top-down 32 bits DIB, so the rows come out in the numpy order
+        self.bmi = BITMAPINFOHEADER()
+        self.bmi.biSize = ctypes.sizeof(BITMAPINFOHEADER)
+        self.bmi.biWidth = w
+        self.bmi.biHeight = -h
+        self.bmi.biPlanes = 1
+        self.bmi.biBitCount = 32
+        self.bitmap_size = (w, h)
+
+    def free_bitmap(self):
+        if self.dataBitMap is None:
+            return
+        self.dcObj.DeleteDC()
+        self.cDC.DeleteDC()
+        win32gui.ReleaseDC(self.hwnd, self.wDC)
+        win32gui.DeleteObject(self.dataBitMap.GetHandle())
+        self.dataBitMap = None
+
+    def grab_into(self, frame, rect):
+        x, y, w, h = rect
+        if self.bitmap_size != (w, h):
+            self.create_bitmap(w, h)
+        # get the window image data
+        self.cDC.BitBlt((0, 0), (w, h), self.dcObj, (self.cropped_x + x, self.cropped_y + y), win32con.SRCCOPY)
+        # copy the pixels straight into the preallocated frame
+        bgra = self.buffer_view(frame.buf, w, h)
+        self.gdi32.GetDIBits(self.cDC.GetSafeHdc(), self.dataBitMap.GetHandle(), 0, h,
+                             bgra.ctypes.data_as(ctypes.c_void_p), ctypes.byref(self.bmi), 0)
+        # drop the alpha channel, it is just a view
+        frame.img = bgra[..., :3]
+
+    def release(self):
+        self.free_bitmap()
+
+class XImage(ctypes.Structure):
+    # only the leading fields of the Xlib XImage struct are needed
+    _fields_ = [('width', ctypes.c_int), ('height', ctypes.c_int), ('xoffset', ctypes.c_int),
+                ('format', ctypes.c_int), ('data', ctypes.c_void_p), ('byte_order', ctypes.c_int),
+                ('bitmap_unit', ctypes.c_int), ('bitmap_bit_order', ctypes.c_int), ('bitmap_pad', ctypes.c_int),
+                ('depth', ctypes.c_int), ('bytes_per_line', ctypes.c_int), ('bits_per_pixel', ctypes.c_int)]
+
+class XShmSegmentInfo(ctypes.Structure):
+    _fields_ = [('shmseg', ctypes.c_ulong), ('shmid', ctypes.c_int),
+                ('shmaddr', ctypes.c_void_p), ('readOnly', ctypes.c_int)]
+
+class X11Capture(FrameSource):
+
+    # properties
+    display = None
+    window = None
+    root = None
+    # size of the root window, the grabs must stay inside it
+    root_w = 0
+    root_h = 0
+    backend = 'xshm'
+    # xlib constants
+    ZPixmap = 2
+    AllPlanes = 0xFFFFFFFF
+    IPC_PRIVATE = 0
+    IPC_CREAT = 0o1000
+    IPC_RMID = 0
+
+    # constructor
+    def __init__(self, window_name=None):
+        super().__init__()
+        self.load_libs()
+        self.xlib.XInitThreads()
+        self.display = self.xlib.XOpenDisplay(None)
+        if not self.display:
+            raise Exception('Could not open the X display: {}'.format(os.environ.get('DISPLAY')))
+        if not self.xext.XShmQueryExtension(self.display):
+            raise Exception('X server has no MIT-SHM extension')
+        screen = self.xlib.XDefaultScreen(self.display)
+        self.root = self.xlib.XRootWindow(self.display, screen)
+        # find the window we want to capture.
+        # if no window name is given, capture the entire screen
+        if window_name is None:
+            self.window = self.root
+        else:
+            self.window = self.find_window(self.root, window_name.encode())
+            if not self.window:
+                raise Exception('Window not found: {}'.format(window_name))
+        self.offset_x, self.offset_y, self.w, self.h = self.window_geometry()
+        self.visual = self.xlib.XDefaultVisual(self.display, screen)
+        self.depth = self.xlib.XDefaultDepth(self.display, screen)
+        self.segments = []
+        self.images = {}
+        self.create_frames()
+
+    def window_geometry(self):
+        # the window manager draws the border and titlebar outside of the
+        # client window, so there is nothing to crop here
+        root_ret = ctypes.c_ulong()
+        x, y = ctypes.c_int(), ctypes.c_int()
+        w, h = ctypes.c_uint(), ctypes.c_uint()
+        border, depth = ctypes.c_uint(), ctypes.c_uint()
+        self.xlib.XGetGeometry(self.display, self.root, ctypes.byref(root_ret), ctypes.byref(x), ctypes.byref(y),
+                               ctypes.byref(w), ctypes.byref(h), ctypes.byref(border), ctypes.byref(depth))
+        self.root_w, self.root_h = w.value, h.value
+        self.xlib.XGetGeometry(self.display, self.window, ctypes.byref(root_ret), ctypes.byref(x), ctypes.byref(y),
+                               ctypes.byref(w), ctypes.byref(h), ctypes.byref(border), ctypes.byref(depth))
+        # the image is read from the root window so the client visual does not matter
+        child = ctypes.c_ulong()
+        tx, ty = ctypes.c_int(), ctypes.c_int()
+        self.xlib.XTranslateCoordinates(self.display, self.window, self.root, 0, 0,
+                                        ctypes.byref(tx), ctypes.byref(ty), ctypes.byref(child))
+        return (tx.value, ty.value, w.value, h.value)
+
+    # the frame pool lives in shared memory segments attached to the X server,
+    # so XShmGetImage writes straight into the frames. Segments of an older
+    # pool stay attached until release, frames may still point to them
+    def create_buffers(self):
+        first = len(self.segments)
+        buffers = []
+        for i in range(4):
+            shminfo = XShmSegmentInfo()
+            size = self.w * self.h * 4
+            shminfo.shmid = self.libc.shmget(self.IPC_PRIVATE, size, self.IPC_CREAT | 0o600)
+            if shminfo.shmid < 0:
+                raise Exception('shmget failed')
+            shminfo.shmaddr = self.libc.shmat(shminfo.shmid, None, 0)
+            shminfo.readOnly = 0
+            self.xext.XShmAttach(self.display, ctypes.byref(shminfo))
+            self.xlib.XSync(self.display, 0)
+            # mark the segment to be removed once everybody detached from it
+            self.libc.shmctl(shminfo.shmid, self.IPC_RMID, None)
+            self.segments.append(shminfo)
+            buf = ctypes.cast(shminfo.shmaddr, ctypes.POINTER(ctypes.c_ubyte))
+            buffers.append(np.ctypeslib.as_array(buf, shape=(size,)))
+        # frame index -> segment of the current pool
+        self.pool = list(range(first, first + 4))
+        return buffers
+
+    # XImage header of the grabbed size over one of the segments, offset
+    # bytes into it. Only the headers change with the region of interest
+    def get_image(self, index, w, h, offset=0):
+        image = self.images.get((index, w, h, offset))
+        if image is None:
+            image = self.xext.XShmCreateImage(self.display, self.visual, self.depth, self.ZPixmap, None,
+                                              ctypes.byref(self.segments[index]), w, h)
+            if not image:
+                raise Exception('XShmCreateImage failed')
+            if image.contents.bits_per_pixel != 32 or image.contents.bytes_per_line != w * 4:
+                raise Exception('Unsupported X visual: {} bits per pixel'.format(image.contents.bits_per_pixel))
+            # the server writes at data minus the address of the segment
+            image.contents.data = self.segments[index].shmaddr + offset
+            self.images[(index, w, h, offset)] = image
+        return image
+
+    def load_libs(self):
+        self.xlib = ctypes.CDLL(ctypes.util.find_library('X11'))
+        self.xext = ctypes.CDLL(ctypes.util.find_library('Xext'))
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.xlib.XOpenDisplay.restype = ctypes.c_void_p
+        self.xlib.XOpenDisplay.argtypes = [ctypes.c_char_p]
+        self.xlib.XDefaultScreen.argtypes = [ctypes.c_void_p]
+        self.xlib.XRootWindow.restype = ctypes.c_ulong
+        self.xlib.XRootWindow.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        self.xlib.XDefaultVisual.restype = ctypes.c_void_p
+        self.xlib.XDefaultVisual.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        self.xlib.XDefaultDepth.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        self.xlib.XGetGeometry.argtypes = [ctypes.c_void_p, ctypes.c_ulong] + [ctypes.c_void_p] * 7
+        self.xlib.XTranslateCoordinates.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.c_ulong,
+                                                    ctypes.c_int, ctypes.c_int] + [ctypes.c_void_p] * 3
+        self.xlib.XQueryTree.argtypes = [ctypes.c_void_p, ctypes.c_ulong] + [ctypes.c_void_p] * 4
+        self.xlib.XFetchName.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.c_void_p]
+        self.xlib.XFree.argtypes = [ctypes.c_void_p]
+        self.xlib.XSync.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        self.xlib.XCloseDisplay.argtypes = [ctypes.c_void_p]
+        self.xext.XShmQueryExtension.argtypes = [ctypes.c_void_p]
+        self.xext.XShmCreateImage.restype = ctypes.POINTER(XImage)
+        self.xext.XShmCreateImage.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int,
+                                              ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint, ctypes.c_uint]
+        self.xext.XShmAttach.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+        self.xext.XShmDetach.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+        self.xext.XShmGetImage.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(XImage),
+                                           ctypes.c_int, ctypes.c_int, ctypes.c_ulong]
+        self.libc.shmget.argtypes = [ctypes.c_int, ctypes.c_size_t, ctypes.c_int]
+        self.libc.shmat.restype = ctypes.c_void_p
+        self.libc.shmat.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int]
+        self.libc.shmdt.argtypes = [ctypes.c_void_p]
+        self.libc.shmctl.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p]
+
+    # depth first search for a window with the given WM_NAME
+    def find_window(self, window, name):
+        title = ctypes.c_char_p()
+        if self.xlib.XFetchName(self.display, window, ctypes.byref(title)) and title.value is not None:
+            found = title.value == name
+            self.xlib.XFree(title)
+            if found:
+                return window
+        root_ret, parent = ctypes.c_ulong(), ctypes.c_ulong()
+        children = ctypes.POINTER(ctypes.c_ulong)()
+        n = ctypes.c_uint()
+        if not self.xlib.XQueryTree(self.display, window, ctypes.byref(root_ret), ctypes.byref(parent),
+                                    ctypes.byref(children), ctypes.byref(n)):
+            return None
+        try:
+            for i in range(n.value):
+                found = self.find_window(children[i], name)
+                if found:
+                    return found
+        finally:
+            if children:
+                self.xlib.XFree(children)
+        return None
+
+    def grab_into(self, frame, rect):
+        x, y, w, h = rect
+        # the grab is read from the root window, a part of the client moved
+        # off the screen is a BadMatch and the default handler of Xlib exits
+        x += self.offset_x
+        y += self.offset_y
+        if x < 0 or y < 0 or x + w > self.root_w or y + h > self.root_h:
+            return False
+        # X copies the pixels into the shared segment, no new buffer is created
+        self.xext.XShmGetImage(self.display, self.root, self.get_image(self.pool[frame.index], w, h, frame.offset),
+                               x, y, self.AllPlanes)
+        # drop the alpha channel, it is just a view
+        frame.img = self.buffer_view(frame.buf, w, h)[..., :3]
+
+    def release(self):
+        if self.display is None:
+            return
+        for shminfo in self.segments:
+            self.xext.XShmDetach(self.display, ctypes.byref(shminfo))
+        self.xlib.XSync(self.display, 0)
+        for image in self.images.values():
+            self.xlib.XFree(image)
+        self.images = {}
+        # the numpy views keep pointing to the segments, so they are only
+        # detached when the frames are no longer used
+        self.xlib.XCloseDisplay(self.display)
+        self.display = None
+
+# pick the capture backend of the running platform
+def create_capture(window_name=None):
+    if sys.platform == 'win32':
+        return WindowCapture(window_name)
+    return X11Capture(window_name)
 
 class Vision:
 
@@ -111,15 +1077,22 @@ class Vision:
     needle_w = 0
     needle_h = 0
     method = None
+    # half size needle for the coarse search, None if it would be too small
+    needle_small = None
+    # top left corner of the last match inside a region
+    last_loc = None
 
     # constructor
-    def __init__(self, needle_img_path, method=cv.TM_CCOEFF_NORMED):
+    def __init__(self, needle_img_path, method=None):
         # load the image we're trying to match
         self.needle_img = cv.imread(needle_img_path, cv.IMREAD_UNCHANGED)
         # Save the dimensions of the needle image
         self.needle_w = self.needle_img.shape[1]
         self.needle_h = self.needle_img.shape[0]
-        self.method = method
+        # the default is looked up here, cv2 is only imported when it is used
+        self.method = cv.TM_CCOEFF_NORMED if method is None else method
+        if min(self.needle_w, self.needle_h) >= 8:
+            self.needle_small = cv.pyrDown(self.needle_img)
 
     def findLoc(self, haystack_img, threshold=0.5):
         # run the OpenCV algorithm
@@ -143,6 +1116,181 @@ class Vision:
         else:
             return 1
 
+    # best score and top left corner of the needle inside a rectangle of the haystack
+    def match_in(self, haystack_img, rect):
+        x, y, w, h = rect
+        x0 = max(x, 0)
+        y0 = max(y, 0)
+        x1 = min(x + w, haystack_img.shape[1])
+        y1 = min(y + h, haystack_img.shape[0])
+        if x1 - x0 < self.needle_w or y1 - y0 < self.needle_h:
+            return -1, None
+        result = cv.matchTemplate(haystack_img[y0:y1, x0:x1], self.needle_img, self.method)
+        min_val, max_val, min_loc, max_loc = cv.minMaxLoc(result)
+        return max_val, (x0 + max_loc[0], y0 + max_loc[1])
+
+    # coarse search on a half size copy of the region, refined at full size
+    def find_coarse(self, haystack_img, region, threshold):
+        x, y, w, h = region
+        small = cv.pyrDown(np.ascontiguousarray(haystack_img[y:y+h, x:x+w]))
+        if small.shape[0] < self.needle_small.shape[0] or small.shape[1] < self.needle_small.shape[1]:
+            return None
+        result = cv.matchTemplate(small, self.needle_small, self.method)
+        min_val, max_val, min_loc, max_loc = cv.minMaxLoc(result)
+        # the candidate is only trusted after the full size match
+        cx = x + max_loc[0] * 2
+        cy = y + max_loc[1] * 2
+        score, loc = self.match_in(haystack_img, (cx - 2, cy - 2, self.needle_w + 4, self.needle_h + 4))
+        if score > threshold:
+            return loc
+        return None
+
+    # like find but only inside region (x, y, w, h). The neighbourhood of the
+    # last hit is tried first, then a coarse pass and only then the whole region.
+    # Returns the top left corner of the match or None
+    def find_in(self, haystack_img, region=None, threshold=0.5, margin=4):
+        if region is None:
+            region = (0, 0, haystack_img.shape[1], haystack_img.shape[0])
+        if self.last_loc is not None:
+            rect = (self.last_loc[0] - margin, self.last_loc[1] - margin,
+                    self.needle_w + margin * 2, self.needle_h + margin * 2)
+            score, loc = self.match_in(haystack_img, rect)
+            if score > threshold:
+                self.last_loc = loc
+                return loc
+        loc = None
+        if self.needle_small is not None:
+            loc = self.find_coarse(haystack_img, region, threshold)
+        if loc is None:
+            score, loc = self.match_in(haystack_img, region)
+            if score <= threshold:
+                loc = None
+        self.last_loc = loc
+        return loc
+
+class ConditionClassifier:
+
+    # properties
+    names = None
+    # slot grid of the icon strip, the offset is found by align()
+    pitch = 11
+    offset = None
+    # size of the part of each slot that is compared
+    core_w = 0
+    core_h = 0
+    threshold = 0.8
+    # hash of a slot -> condition name (None for unknown icons)
+    table = None
+    # the memo of unknown hashes is cleared when it gets this big
+    max_table = 4096
+    # strips in a row with only unknown icons before the grid is dropped,
+    # a wrong grid cuts every icon in two
+    max_misses = 5
+    misses = 0
+
+    # constructor
+    def __init__(self, icons, pitch=11, threshold=0.8):
+        # icons is a dict name -> image path, missing images are skipped
+        self.pitch = pitch
+        self.threshold = threshold
+        images = {}
+        for name, path in icons.items():
+            if os.path.exists(path):
+                images[name] = cv.imread(path, cv.IMREAD_COLOR)
+        self.names = list(images)
+        # every icon is cut to the size of the smallest one
+        self.core_h = min(img.shape[0] for img in images.values())
+        self.core_w = min(img.shape[1] for img in images.values())
+        cores = np.stack([img[:self.core_h, :self.core_w] for img in images.values()])
+        # zero mean, unit length atlas for the correlation
+        self.atlas = self.normalize(cores)
+        # exact hashes of the atlas, icons sharing a hash are a tie and
+        # are left out so the correlation decides between them
+        self.atlas_table = {}
+        ties = set()
+        for name, key in zip(self.names, self.hashes(cores)):
+            if key in self.atlas_table:
+                ties.add(key)
+            self.atlas_table[key] = name
+        for key in ties:
+            del self.atlas_table[key]
+        self.table = dict(self.atlas_table)
+
+    # position of one icon inside the strip sets the grid of the slots
+    def align(self, loc):
+        self.offset = (loc[0] % self.pitch, loc[1])
+        self.misses = 0
+
+    def aligned(self):
+        return self.offset is not None
+
+    # average hash of every slot: one bit per pixel brighter than the slot mean
+    def hashes(self, slots):
+        gray = slots.mean(axis=3)
+        bits = gray > gray.mean(axis=(1, 2), keepdims=True)
+        packed = np.packbits(bits.reshape(len(slots), -1), axis=1)
+        return [row.tobytes() for row in packed]
+
+    def normalize(self, slots):
+        flat = slots.reshape(len(slots), -1).astype('float32')
+        flat -= flat.mean(axis=1, keepdims=True)
+        norm = np.linalg.norm(flat, axis=1, keepdims=True)
+        norm[norm == 0] = 1
+        return flat / norm
+
+    # all the slots of the strip as one (n, core_h, core_w, 3) view
+    def slots(self, strip_img):
+        x, y = self.offset
+        rows = strip_img[y:y + self.core_h]
+        if rows.shape[0] < self.core_h or rows.shape[1] < x + self.core_w:
+            return rows[:0, :0]
+        windows = np.lib.stride_tricks.sliding_window_view(rows, (self.core_h, self.core_w, 3))
+        return windows[0, x::self.pitch, 0][:(rows.shape[1] - x - self.core_w) // self.pitch + 1]
+
+    # set of the conditions shown on the strip
+    def classify(self, strip_img):
+        slots = self.slots(strip_img)
+        if len(slots) == 0:
+            return frozenset()
+        # empty slots are flat, skip them
+        busy = slots.reshape(len(slots), -1).std(axis=1) > 8
+        if not busy.any():
+            return frozenset()
+        slots = slots[busy]
+        keys = self.hashes(slots)
+        found = set()
+        unknown = []
+        known = 0
+        for i, key in enumerate(keys):
+            if key in self.table:
+                if self.table[key] is not None:
+                    found.add(self.table[key])
+                    known += 1
+            else:
+                unknown.append(i)
+        if unknown:
+            # correlate the unknown slots against the whole atlas at once
+            # and remember the answer for their hashes
+            scores = self.normalize(slots[unknown]) @ self.atlas.T
+            best = scores.argmax(axis=1)
+            if len(self.table) > self.max_table:
+                self.table = dict(self.atlas_table)
+            for k, i in enumerate(unknown):
+                name = self.names[best[k]] if scores[k, best[k]] > self.threshold else None
+                self.table[keys[i]] = name
+                if name is not None:
+                    found.add(name)
+                    known += 1
+        # nothing but unknown icons for a while, look for the grid again
+        if known:
+            self.misses = 0
+        else:
+            self.misses += 1
+            if self.misses >= self.max_misses:
+                self.offset = None
+                self.misses = 0
+        return frozenset(found)
+
 class BotState:
 
     # set states of the char
@@ -157,166 +1305,1516 @@ class BotState:
     FOOD_LOW = 8
     NO_HAST = 9
     HASTED = 10
+    PARTY_OK = 11
+    PARTY_LOW = 12
+
+class Trend:
+
+    # readings kept, enough for a second at the capture rate
+    SIZE = 64
+    # seconds of readings the slope is fitted on
+    WINDOW = 1.0
+
+    # constructor
+    def __init__(self):
+        # ring buffer of (time, value), index is where the next one goes
+        self.ts = np.zeros(self.SIZE)
+        self.values = np.zeros(self.SIZE)
+        self.count = 0
+        self.index = 0
+
+    def add(self, ts, value):
+        self.ts[self.index] = ts
+        self.values[self.index] = value
+        self.index = (self.index + 1) % self.SIZE
+        self.count = min(self.count + 1, self.SIZE)
+
+    def last(self):
+        return self.values[self.index - 1]
+
+    # least squares slope of the last WINDOW seconds in units per second,
+    # 0 with less than three readings
+    def slope(self):
+        if self.count < 3:
+            return 0.0
+        ts = self.ts[:self.count]
+        recent = ts >= self.ts[self.index - 1] - self.WINDOW
+        if np.count_nonzero(recent) < 3:
+            return 0.0
+        t = ts[recent]
+        v = self.values[:self.count][recent]
+        t = t - t.mean()
+        var = np.dot(t, t)
+        if var == 0:
+            return 0.0
+        return float(np.dot(t, v - v.mean()) / var)
+
+    # highest minus lowest reading of the last seconds, 0 when it held still
+    def spread(self, seconds):
+        if self.count == 0:
+            return 0.0
+        ts = self.ts[:self.count]
+        recent = self.values[:self.count][ts >= self.ts[self.index - 1] - seconds]
+        return float(recent.max() - recent.min())
+
+    # seconds until the value falls to the threshold, None if it is not falling
+    def time_to(self, threshold):
+        slope = self.slope()
+        if slope >= 0:
+            return None
+        return max((self.last() - threshold) / -slope, 0.0)
+
+    # value expected lead seconds from the last reading. Only a falling value
+    # is projected, so a heal can come earlier but never later
+    def predict(self, lead):
+        value = self.last()
+        if lead <= 0 or self.count == 0:
+            return value
+        return min(value, value + self.slope() * lead)
+
+class PartyDetector:
+
+    # a pixel of a bar is filled when its brightest channel is above this,
+    # the bars change color with the health but the empty part stays dark
+    FILLED = 60
+    # the frame on the left of a bar is darker than this, an empty slot of
+    # the panel shows the lighter background there
+    BORDER = 30
+
+    # constructor. (x, y) is the first pixel of the first bar in window
+    # coordinates, or None to find the panel with the needle image at
+    # (dx, dy) from its center. The other bars are pitch pixels below
+    def __init__(self, x=None, y=None, rows=5, pitch=22, width=130, threshold=70, needle=None, dx=0, dy=0):
+        self.x = x
+        self.y = y
+        self.rows = rows
+        self.pitch = pitch
+        self.width = width
+        # % of the most hurt member that asks for a heal
+        self.threshold = threshold
+        self.needle = needle
+        self.dx = dx
+        self.dy = dy
+        # % of each row, True for the rows with a member and the rows from
+        # the most to the least hurt member
+        self.pct = np.full(rows, 100.0)
+        self.present = np.zeros(rows, dtype=bool)
+        self.order = np.arange(rows)
+
+    # find the panel on a whole window frame, False if it is not there
+    def anchor(self, img):
+        if self.needle is None:
+            return self.x is not None
+        loc = Vision(self.needle).findLoc(img, 0.9)
+        if loc[0] == -1:
+            return False
+        self.x, self.y = loc[0] + self.dx, loc[1] + self.dy
+        return True
+
+    # window coordinates of the corners of the panel, it is grabbed as its own region
+    def points(self):
+        return [[self.x - 1, self.y], [self.x + self.width - 1, self.y + (self.rows - 1) * self.pitch]]
+
+    # read the bars of every member at once, origin is the window position of img
+    def read(self, img, origin):
+        x, y = self.x - origin[0], self.y - origin[1]
+        # one row of pixels per member: a strided 2-D view, nothing is copied
+        bars = img[y:y + self.rows * self.pitch:self.pitch, x:x + self.width]
+        filled = bars.max(axis=2) > self.FILLED
+        # index of the first empty pixel of each row, the width for the full ones
+        length = np.argmin(filled, axis=1)
+        length[filled.all(axis=1)] = self.width
+        self.pct = 100 * length / self.width
+        self.present = img[y:y + self.rows * self.pitch:self.pitch, x - 1].max(axis=1) < self.BORDER
+        self.order = np.argsort(np.where(self.present, self.pct, np.inf), kind='stable')
+
+    # (row, %) of the members from the most to the least hurt
+    def most_hurt(self):
+        return [(int(row), float(self.pct[row])) for row in self.order if self.present[row]]
+
+    def state(self):
+        row = self.order[0]
+        if self.present[row] and self.pct[row] <= self.threshold:
+            return BotState.PARTY_LOW
+        return BotState.PARTY_OK
+
+    # row of the most hurt member below the threshold, None if nobody is
+    def target(self):
+        for row, pct in self.most_hurt()[:1]:
+            if pct <= self.threshold:
+                return row
+        return None
+
+class CooldownDetector:
+
+    # a pixel is under the cooldown overlay when it is this much darker than
+    # the brightest it was seen
+    DIM = 0.6
+    # pixels that are never brighter than this are left out, the overlay
+    # can't darken them
+    MIN_BRIGHT = 60
+    # share of dimmed pixels still taken as ready, noise of the icon
+    READY = 0.05
+
+    # constructor. slots is group -> [x, y] of the top left corner of its icon
+    # in window coordinates: the group cooldown icon of the spells or the
+    # action bar slot of a potion. cooldowns is group -> seconds of a whole
+    # cooldown, the groups without one are left out
+    def __init__(self, slots, cooldowns, size=20):
+        self.groups = [group for group in slots if group in cooldowns]
+        self.cooldowns = np.array([cooldowns[group] for group in self.groups], dtype=float)
+        self.xy = np.array([slots[group] for group in self.groups]).reshape(-1, 2)
+        self.size = size
+        # index grids that gather every icon in one read, (groups, size, size)
+        steps = np.arange(size)
+        self.rows = self.xy[:, 1, None, None] + steps[None, :, None]
+        self.cols = self.xy[:, 0, None, None] + steps[None, None, :]
+        # brightest value of each pixel seen so far, the icon without the overlay
+        self.reference = np.zeros((len(self.groups), size, size), dtype=np.uint8)
+        # share of each icon under the overlay and group -> time it is ready
+        self.fraction = np.zeros(len(self.groups))
+        self.ready_at = {}
+
+    # window coordinates of the corners of the icons, they are grabbed as one region
+    def points(self):
+        return [self.xy.min(axis=0).tolist(), (self.xy.max(axis=0) + self.size - 1).tolist()]
+
+    # read every icon at once, origin is the window position of img and ts
+    # the capture time of the frame
+    def read(self, img, origin, ts):
+        icons = img[self.rows - origin[1], self.cols - origin[0]].max(axis=3)
+        np.maximum(self.reference, icons, out=self.reference)
+        lit = self.reference > self.MIN_BRIGHT
+        dimmed = lit & (icons < self.reference * self.DIM)
+        self.fraction = dimmed.sum(axis=(1, 2)) / np.maximum(lit.sum(axis=(1, 2)), 1)
+        # the overlay shrinks with the time left of the cooldown
+        left = np.where(self.fraction > self.READY, self.fraction * self.cooldowns, 0)
+        self.ready_at = dict(zip(self.groups, (ts + left).tolist()))
+
+    # groups the client accepts right now
+    def ready(self):
+        return frozenset(group for group, fraction in zip(self.groups, self.fraction) if fraction <= self.READY)
+
+class GlyphDecoder:
+
+    # a pixel of a digit is brighter than this on its brightest channel,
+    # the numbers are drawn light over the dark panel
+    THRESHOLD = 120
+
+    # constructor. The atlas is one row with the glyphs 0 to 9 side by side,
+    # all of the same width, cut from the client font. Numbers up to cells
+    # digits long are read, right aligned in the field like the client draws them
+    def __init__(self, path, cells=5, threshold=THRESHOLD):
+        atlas = cv.imread(path, cv.IMREAD_COLOR)
+        self.cell_h = atlas.shape[0]
+        self.cell_w = atlas.shape[1] // 10
+        self.cells = cells
+        self.threshold = threshold
+        glyphs = atlas[:, :self.cell_w * 10].reshape(self.cell_h, 10, self.cell_w, 3).transpose(1, 0, 2, 3)
+        # binarized glyph -> digit, a blank cell is the padding of a short number
+        self.table = {key: str(digit) for digit, key in enumerate(self.hashes(glyphs))}
+        self.table[self.hashes(np.zeros((1, self.cell_h, self.cell_w, 3), np.uint8))[0]] = ''
+
+    # width and height of the field
+    def size(self):
+        return self.cells * self.cell_w, self.cell_h
+
+    # one bit per lit pixel of every cell, packed to bytes
+    def hashes(self, cells):
+        bits = cells.max(axis=3) > self.threshold
+        packed = np.packbits(bits.reshape(len(cells), -1), axis=1)
+        return [row.tobytes() for row in packed]
+
+    # number of the field with its top left corner at (x, y), None when a
+    # cell is not a glyph of the atlas or the field is blank
+    def decode(self, img, x, y):
+        w, h = self.size()
+        field = img[y:y + h, x:x + w]
+        if field.shape[:2] != (h, w):
+            return None
+        # every cell of the field at once, one dict lookup each
+        cells = field.reshape(h, self.cells, self.cell_w, 3).transpose(1, 0, 2, 3)
+        text = ''
+        for key in self.hashes(cells):
+            digit = self.table.get(key)
+            # blanks only go before the number
+            if digit is None or (digit == '' and text):
+                return None
+            text += digit
+        return int(text) if text else None
+
+# a threshold is a % or a number of points ending in hp or mp, like 20 or
+# '1200hp'. Returns (number, True for points)
+def parse_threshold(value):
+    text = str(value).strip().lower()
+    if text.endswith(('hp', 'mp')):
+        return int(text[:-2]), True
+    return int(text), False
+
+# text of a threshold for the messages
+def threshold_label(value):
+    number, absolute = parse_threshold(value)
+    return f'{number} {str(value).strip().lower()[-2:]}' if absolute else f'{number} %'
+
+class RateController:
+
+    # conditions that keep the rate up even with the bars full
+    HARMFUL = frozenset(('poison', 'paralyze', 'burning', 'drunk'))
+
+    # constructor, floor and ceiling in frames per second
+    def __init__(self, floor=5, ceiling=60, settle=3):
+        self.floor = floor
+        self.ceiling = ceiling
+        # seconds of full and still bars before going down to the floor
+        self.settle = settle
+        # it starts at the ceiling like after a change
+        self.t_busy = None
+        self.fps = ceiling
+
+    # rate for the next frames. Anything but full and still bars goes to the
+    # ceiling at once, the floor only comes after settle calm seconds
+    def update(self, detector, now):
+        calm = (detector.state_life == BotState.life_FULL and detector.state_mana == BotState.MANA_FULL
+                and not detector.conditions & self.HARMFUL
+                and detector.life_trend.spread(self.settle) == 0 and detector.mana_trend.spread(self.settle) == 0
+                and all(ready_at <= now for ready_at in detector.cooldown_ready.values()))
+        if not calm or self.t_busy is None:
+            self.t_busy = now
+        self.fps = self.floor if now - self.t_busy >= self.settle else self.ceiling
+        return self.fps
 
 class Detection:
 
     # threading properties
     stopped = True
     lock = None
+    thread = None
     # properties
     state = None
     state_life = None
     state_mana = None
     state_food = None
     state_hast = None
+    state_party = None
     screenshot = None
+    # sequence number and capture time of the frame being analysed
+    frame_seq = 0
+    frame_ts = 0
+    # bumped every time one of the states changes
+    state_seq = 0
     loc_life = []
     porcentagem = 0
+    # the bars are 93 pixels wide on the default client
+    BAR_WIDTH = 93
+    # anchors of the last calibrations, keyed by character and window size
+    CALIBRATION_FILE = 'calibration.json'
+    # how far (sum of the BGR differences) a sample pixel may drift
+    SAMPLE_TOLERANCE = 30
+    samples = []
+    # the life icon is first searched this many pixels around its old position
+    REANCHOR_MARGIN = 48
+    # seconds between two searches while the icon is not found
+    REANCHOR_INTERVAL = 1
+    reanchoring = False
+    t_reanchor = 0
+    # (center of the life icon, samples) found by reanchor
+    pending_anchors = None
+    window_anchors = None
+    bar_width = BAR_WIDTH
+    # last reading of the bars in %
+    life_pct = 100
+    mana_pct = 100
+    # conditions shown on the status strip
+    conditions = frozenset()
+    # snapshot in shared memory when the detection runs in its own process
+    shared = None
+    shared_changed = None
+    shared_seq = 0
+    # frames analysed, the ui shows the rate
+    steps = 0
+    # the skipped share of the region reads is exported every this many frames
+    FINGERPRINT_GAUGES = 60
+    # session recorder of the frames and states, None records nothing
+    recorder = None
+    # RateController of the capture, None keeps it at its max_fps
+    rate = None
+    # share of a core used by the detection thread
+    cpu = 0
+    # seconds ahead the tiers are read from the trend of the bars, 0 uses
+    # the current reading. Set by a predictive Healer
+    lead = 0
+    # shared double the lead comes through when the detection runs in its
+    # own process
+    shared_lead = None
+    # font atlas of the client digits, without it only the bars are read
+    DIGITS = 'digits.png'
+    # the numbers start this many pixels after the end of their bar
+    VALUE_GAP = 4
+    digits = None
+    # points read from the numbers next to the bars, None when not decoded
+    life_value = None
+    mana_value = None
+    # seconds until the life falls to the strong heal at the rate it is
+    # falling, None while it is not falling or the heal is in points
+    life_eta = None
+    # group -> time the client accepts it again, read from the cooldown icons
+    cooldown_ready = {}
+    # party row the heal goes to, None when nobody needs it
+    party_target = None
+    # match score an icon needs to set the slot grid of the strip
+    ALIGN_THRESHOLD = 0.9
+    # condition icons we know, the ones without an image are skipped
+    CONDITIONS = {'hast': 'hast.png', 'food': 'food.jpg', 'poison': 'poison.png',
+                  'paralyze': 'paralyze.png', 'burning': 'burning.png', 'drunk': 'drunk.png'}
 
     # constructor
-    def __init__(self, char_name, label_text, p_strong_heal, p_medium_heal, p_low_heal, p_mana):
-        # create a thread lock object
+    def __init__(self, char_name, label_text, p_strong_heal, p_medium_heal, p_low_heal, p_mana, capture=None, incremental=True, party=None, cooldowns=None):
+        # create a thread lock object, the healer waits on it for new states
         self.lock = Lock()
-        # % of life to use high heal
-        self.p_strong_heal = (int(p_strong_heal))
-        # % of life to use medium heal
-        self.p_medium_heal = (int(p_medium_heal))
-        # % of life to use low heal
-        self.p_low_heal = (int(p_low_heal))
-        # % of life to use mana potion
-        self.p_mana = (int(p_mana))
-        #pixel to check life
-        self.plx_strong_heal = (int(93/100 * self.p_strong_heal))
-        self.plx_medium_heal = (int(93/100 * self.p_medium_heal))
-        self.plx_low_heal = (int(93/100 * self.p_low_heal))
-        #pixel to check mana
-        self.plx_mana = (int(93/100 * self.p_mana))
+        self.new_state = Condition(self.lock)
+        self.last_states = None
+        # only analyse the regions whose fingerprint changed
+        self.incremental = incremental
+        self.fingerprints = {}
+        self.fp_hits = {'life': 0, 'mana': 0, 'strip': 0}
+        self.fp_misses = {'life': 0, 'mana': 0, 'strip': 0}
+        # % or points of life to use high heal
+        self.p_strong_heal = parse_threshold(p_strong_heal)
+        # % or points of life to use medium heal
+        self.p_medium_heal = parse_threshold(p_medium_heal)
+        # % or points of life to use low heal
+        self.p_low_heal = parse_threshold(p_low_heal)
+        # % or points of mana to use mana potion
+        self.p_mana = parse_threshold(p_mana)
+        # heal tiers as (threshold, in points, state) from the most severe,
+        # each one checked against its own reading
+        self.life_tiers = [self.p_strong_heal + (BotState.life_RED,),
+                           self.p_medium_heal + (BotState.life_YELLOW,),
+                           self.p_low_heal + (BotState.life_GREEN,)]
+        self.mana_tiers = [self.p_mana + (BotState.MANA_LOW,)]
+        # readings of the bars to follow how fast they fall
+        self.life_trend = Trend()
+        self.mana_trend = Trend()
         #img
         self.life = Vision('life.jpg')
-        self.food = Vision('food.jpg')
-        self.hast = Vision('hast.png')
+        # condition icons of the status strip
+        self.conditions_icons = {name: Vision(path) for name, path in self.CONDITIONS.items() if os.path.exists(path)}
+        self.classifier = ConditionClassifier(self.CONDITIONS)
+        # PartyDetector of the party or battle list panel, None watches only us
+        self.party = party
+        # CooldownDetector of the cooldown icons, None leaves them to the timers
+        self.cooldowns = cooldowns
 
         self.label_text = label_text
         self.char_name = char_name
-        # start WindowCapture
-        self.wincap = WindowCapture(f'Tibia - {self.char_name}')
+        # start the frame source
+        if capture is None:
+            capture = create_capture(f'Tibia - {self.char_name}')
+        self.wincap = capture
+        # the exact numbers need the atlas, thresholds in points can't work without it
+        if os.path.exists(self.DIGITS):
+            self.digits = GlyphDecoder(self.DIGITS)
+            self.fp_hits.update(life_value=0, mana_value=0)
+            self.fp_misses.update(life_value=0, mana_value=0)
+        elif any(absolute for _, absolute, _ in self.life_tiers + self.mana_tiers):
+            self.label_text['text'] = f'Erro: Falta o {self.DIGITS} para curar por pontos'
+            return
+        # the anchors of the last run are used if they still match the window
+        if self.load_calibration():
+            self.label_text['text'] = f'Está no jogo'
+            self.state = BotState.INICIADO
+            return
         # take a screenshot
         self.screenshot = self.wincap.get_screenshot()
         # take coordenates of life pxl and check
         self.loc_life = self.life.findLoc(self.screenshot, 0.95)
         if self.loc_life[0] == -1:
             self.label_text['text'] = f'Erro: Não achou as barras de status'
+        elif self.party is not None and not self.party.anchor(self.screenshot):
+            self.label_text['text'] = f'Erro: Não achou a lista da party'
         else:
             self.label_text['text'] = f'Está no jogo'
-            # take the life bar coordenates and ajust to mana
-            self.loc_life = [self.loc_life[0]+8, self.loc_life[1]]
-            self.loc_mana = [self.loc_life[0]+8, self.loc_life[1]+14]
-            self.loc_barra_top = [self.loc_life[0]-6, self.loc_life[1]+167]
-            self.loc_barra_bot = [self.loc_life[0]+101, self.loc_life[1]+180]
+            self.set_anchors(self.loc_life)
+            # measure the bar while the whole frame is still around
+            self.bar_width = self.measure_bar()
+            self.samples = self.anchor_samples(self.screenshot, self.loc_life)
+            self.save_calibration()
+            # from now on only grab the bars and the icon strip
+            self.set_roi()
             self.state = BotState.INICIADO
+
+    # all the coordenates come from the center of the life icon
+    def set_anchors(self, loc):
+        # take the life bar coordenates and ajust to mana
+        self.loc_life = [loc[0]+8, loc[1]]
+        self.loc_mana = [self.loc_life[0]+8, self.loc_life[1]+14]
+        self.loc_barra_top = [self.loc_life[0]-6, self.loc_life[1]+167]
+        self.loc_barra_bot = [self.loc_life[0]+101, self.loc_life[1]+180]
+
+    def calibration_key(self):
+        return f'{self.char_name}|{self.wincap.w}x{self.wincap.h}'
+
+    # a few pixels of the life icon, [x, y, b, g, r] in window coordinates
+    def anchor_samples(self, img, loc_life):
+        x, y = loc_life[0] - 8, loc_life[1]
+        points = [(x, y), (x - 3, y - 3), (x + 3, y - 3), (x - 3, y + 3), (x + 3, y + 3)]
+        return [[px, py] + [int(c) for c in img[py, px]] for px, py in points]
+
+    # True if the life icon is still where the samples say
+    def check_samples(self, rect=None):
+        if rect is None:
+            rect = self.wincap.grab_rect()
+        x0, y0 = rect[0], rect[1]
+        h, w = self.screenshot.shape[:2]
+        for x, y, b, g, r in self.samples:
+            x, y = x - x0, y - y0
+            if not (0 <= x < w and 0 <= y < h):
+                return False
+            pb, pg, pr = self.screenshot[y, x]
+            if abs(int(pb) - b) + abs(int(pg) - g) + abs(int(pr) - r) > self.SAMPLE_TOLERANCE:
+                return False
+        return True
+
+    def save_calibration(self):
+        try:
+            with open(self.CALIBRATION_FILE) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+        data[self.calibration_key()] = {'loc_life': self.loc_life, 'loc_mana': self.loc_mana,
+                                        'loc_barra_top': self.loc_barra_top, 'loc_barra_bot': self.loc_barra_bot,
+                                        'bar_width': self.bar_width, 'samples': self.samples}
+        if self.party is not None:
+            data[self.calibration_key()]['party'] = [self.party.x, self.party.y]
+        tmp = self.CALIBRATION_FILE + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent=1)
+        os.replace(tmp, self.CALIBRATION_FILE)
+
+    # load the cached anchors and check them on a frame of the region of
+    # interest, so no full frame search is needed. False if they don't match
+    def load_calibration(self):
+        try:
+            with open(self.CALIBRATION_FILE) as f:
+                data = json.load(f)[self.calibration_key()]
+        except (OSError, ValueError, KeyError):
+            return False
+        self.loc_life = data['loc_life']
+        self.loc_mana = data['loc_mana']
+        self.loc_barra_top = data['loc_barra_top']
+        self.loc_barra_bot = data['loc_barra_bot']
+        self.bar_width = data['bar_width']
+        self.samples = data['samples']
+        # a party panel that was not calibrated needs the whole window
+        if self.party is not None:
+            if 'party' not in data:
+                return False
+            self.party.x, self.party.y = data['party']
+        self.set_roi()
+        self.screenshot = self.wincap.get_screenshot()
+        if self.check_samples():
+            return True
+        # the client changed, go back to the whole window
+        self.wincap.set_roi(None)
+        return False
+    # shrink the capture to the bounding box of the bars and the icon strip
+    # and move the coordenates to the new image
+    def set_roi(self):
+        # the life icon is kept in the region to check the anchors
+        icon = [self.loc_life[0] - 13, self.loc_life[1] - 5]
+        points = [icon, self.loc_life, self.loc_mana, self.loc_barra_top, self.loc_barra_bot]
+        if self.digits is not None:
+            points += self.value_points(self.loc_life) + self.value_points(self.loc_mana)
+        x = min(p[0] for p in points)
+        y = min(p[1] for p in points)
+        w = max(max(p[0] for p in points), self.loc_mana[0] + self.bar_width) - x + 1
+        h = max(p[1] for p in points) - y + 1
+        self.wincap.set_roi((x, y, w, h))
+        # the panels away from the bars are grabbed on their own
+        regions = {}
+        if self.party is not None:
+            regions['party'] = self.bounding_rect(self.party.points())
+        if self.cooldowns is not None:
+            regions['cooldowns'] = self.bounding_rect(self.cooldowns.points())
+        self.wincap.set_regions(regions)
+        # keep the window coordenates for the next calibration
+        self.window_anchors = (self.loc_life, self.loc_mana, self.loc_barra_top, self.loc_barra_bot)
+        x, y = self.wincap.roi_origin()
+        self.loc_life = [self.loc_life[0] - x, self.loc_life[1] - y]
+        self.loc_mana = [self.loc_mana[0] - x, self.loc_mana[1] - y]
+        self.loc_barra_top = [self.loc_barra_top[0] - x, self.loc_barra_top[1] - y]
+        self.loc_barra_bot = [self.loc_barra_bot[0] - x, self.loc_barra_bot[1] - y]
+
+    # (x, y, w, h) around the points
+    def bounding_rect(self, points):
+        x = min(p[0] for p in points)
+        y = min(p[1] for p in points)
+        return (x, y, max(p[0] for p in points) - x + 1, max(p[1] for p in points) - y + 1)
+
+    # look for the life icon again on a whole window grab, first around the
+    # old position and then everywhere. Runs in its own thread, the new
+    # anchors are swapped in by the detection thread between two frames
+    def reanchor(self):
+        try:
+            frame = self.wincap.grab_full()
+            if frame is None:
+                return
+            x, y = self.window_anchors[0]
+            # top left corner of the icon at the old position
+            self.life.last_loc = (x - 8 - self.life.needle_w // 2, y - self.life.needle_h // 2)
+            loc = self.life.find_in(frame.img, None, 0.95, self.REANCHOR_MARGIN)
+            if loc is not None:
+                center = [loc[0] + self.life.needle_w // 2, loc[1] + self.life.needle_h // 2]
+                self.pending_anchors = (center, self.anchor_samples(frame.img, [center[0] + 8, center[1]]))
+        finally:
+            self.reanchoring = False
+
+    def start_reanchor(self):
+        # a failed search is only retried after a while
+        if self.reanchoring or time.perf_counter() - self.t_reanchor < self.REANCHOR_INTERVAL:
+            return
+        self.reanchoring = True
+        self.t_reanchor = time.perf_counter()
+        self.label_text['text'] = f'Procurando as barras de status'
+        t = Thread(target=self.reanchor, name='reanchor')
+        t.start()
+
+    # swap in the anchors found by reanchor
+    def apply_anchors(self):
+        center, samples = self.pending_anchors
+        self.pending_anchors = None
+        self.set_anchors(center)
+        self.samples = samples
+        self.save_calibration()
+        self.set_roi()
+        # every region has to be read again
+        self.fingerprints = {}
+        self.label_text['text'] = f'Está no jogo'
+
     # update screenshot
     def update(self, screenshot):
         self.lock.acquire()
         self.screenshot = screenshot
         self.lock.release()
-    # check if for life and mana pxl
-    def bar_state(self, porcentagem, barra):
-        result = False
+    # filled length of a bar row from the start, the red channel of a filled
+    # pixel is 255 on the life bar and 95 on the mana bar
+    def filled_length(self, barra, width):
         if barra == "life":
-            b, g, r = self.screenshot[self.loc_life[1], self.loc_life[0]+ porcentagem]
-            if r != 255:
-                result = True
-            else:
-                 result = False
+            x, y = self.loc_life
+            row = self.screenshot[y, x:x + width, 2]
+            filled = row == 255
+        else:
+            x, y = self.loc_mana
+            row = self.screenshot[y, x:x + width, 2]
+            filled = row == 95
+        if filled.size == 0:
+            return 0
+        # index of the first empty pixel, the whole row if there is none
+        length = int(np.argmin(filled))
+        if filled[length]:
+            length = filled.size
+        return length
+
+    # measure the bar width on the calibration frame, it only works with the
+    # life bar full, otherwise keep the width of the default client
+    def measure_bar(self):
+        width = self.filled_length("life", self.screenshot.shape[1])
+        return max(width, self.BAR_WIDTH)
+
+    # % of the bar filled, read from the whole row at once
+    def bar_percent(self, barra):
+        return 100 * self.filled_length(barra, self.bar_width) / self.bar_width
+
+    # top left corner of the number next to the bar starting at loc
+    def value_origin(self, loc):
+        return loc[0] + self.bar_width + self.VALUE_GAP, loc[1] - self.digits.cell_h // 2
+
+    # corners of the number field, the region of interest grows to them
+    def value_points(self, loc):
+        x, y = self.value_origin(loc)
+        w, h = self.digits.size()
+        return [[x, y], [x + w - 1, y + h - 1]]
+
+    # seconds ahead the tiers are read
+    def set_lead(self, lead):
+        self.lead = lead
+
+    # state of the first tier the reading is in, the tiers go from the most
+    # severe. The tiers in points read the decoded number and are skipped
+    # while there is none
+    def tier(self, pct, value, tiers, default):
+        for threshold, absolute, state in tiers:
+            reading = value if absolute else pct
+            if reading is not None and reading <= threshold:
+                return state
+        return default
+    # pixels each part of the detection reads
+    def region(self, name):
+        if name == "life":
+            x, y = self.loc_life
+            return self.screenshot[y, x:x + self.bar_width]
+        if name == "mana":
+            x, y = self.loc_mana
+            return self.screenshot[y, x:x + self.bar_width]
+        if name in ("life_value", "mana_value"):
+            x, y = self.value_origin(self.loc_life if name == "life_value" else self.loc_mana)
+            w, h = self.digits.size()
+            return self.screenshot[y:y+h, x:x+w]
+        x, y, w, h = self.strip_rect()
+        return self.screenshot[y:y+h, x:x+w]
+
+    # True if the region is different from the last frame, the check is a
+    # crc32 of its pixels
+    def region_changed(self, name):
+        if not self.incremental:
+            return True
+        region = self.region(name)
+        if not region.flags.c_contiguous:
+            region = region.tobytes()
+        fingerprint = zlib.crc32(region)
+        if self.fingerprints.get(name) == fingerprint:
+            self.fp_hits[name] += 1
+            return False
+        self.fingerprints[name] = fingerprint
+        self.fp_misses[name] += 1
+        return True
+
+    # share of the reads of each region skipped because it did not change
+    def gauge_fingerprints(self):
+        for name, hits in self.fp_hits.items():
+            total = hits + self.fp_misses[name]
+            if total:
+                metrics.gauge(f'skipped_{name}', hits / total)
+
+    # rectangle of the icon strip
+    def strip_rect(self):
+        x, y = self.loc_barra_top
+        return (x, y, self.loc_barra_bot[0] - x + 1, self.loc_barra_bot[1] - y + 1)
+
+    # read the condition icons of the strip
+    def update_conditions(self):
+        x, y, w, h = self.strip_rect()
+        if self.classifier.aligned():
+            self.conditions = self.classifier.classify(self.screenshot[y:y+h, x:x+w])
+            return
+        # until an icon shows the slot grid, look for every icon on its own.
+        # Only a close match sets the grid, it is kept for the next frames
+        found = set()
+        for name, vision in self.conditions_icons.items():
+            loc = vision.find_in(self.screenshot, (x, y, w, h))
+            if loc is not None:
+                found.add(name)
+                score, _ = vision.match_in(self.screenshot, (loc[0], loc[1], vision.needle_w, vision.needle_h))
+                if score >= self.ALIGN_THRESHOLD:
+                    self.classifier.align((loc[0] - x, loc[1] - y))
+        self.conditions = frozenset(found)
 
-        elif barra == "mana":
-            b, g, r = self.screenshot[self.loc_mana[1], self.loc_mana[0]+ porcentagem]
-            if r != 95:
-                result = True
-            else:
-                result = False
-        return result
     # check for imagens on status bar
     def status_state(self, status):
-        result = False
-        if status == "food":
-            check_food = self.food.find(self.screenshot)
-            if check_food == 0:
-                result = True
-            else:
-                result = False
+        return status in self.conditions
+    # publish the states, waking up the healer only when one of them changed
+    def publish(self):
+        states = (self.state_life, self.state_mana, self.state_food, self.state_hast, self.state_party, self.party_target,
+                  self.cooldowns.ready() if self.cooldowns is not None else None)
+        if states == self.last_states:
+            return
+        self.lock.acquire()
+        self.last_states = states
+        self.state_seq += 1
+        self.new_state.notify_all()
+        self.lock.release()
 
-        if status == "hast":
-            check_hast = self.hast.find(self.screenshot)
-            if check_hast == 0:
-                result = True
-            else:
-                result = False
+    # block until the states change after seq or the timeout ends,
+    # returns the current state sequence number
+    def wait_state(self, seq, timeout=None):
+        self.lock.acquire()
+        self.new_state.wait_for(lambda: self.state_seq != seq or self.stopped, timeout)
+        seq = self.state_seq
+        self.lock.release()
+        return seq
 
-        return result
     # start the thread
     def start(self):
         self.stopped = False
-        t = Thread(target=self.run)
-        t.start()
+        self.thread = Thread(target=self.run, name='detection')
+        self.thread.start()
 
     # stop the thread
     def stop(self):
 
+        self.lock.acquire()
         self.stopped = True
+        self.new_state.notify_all()
+        self.lock.release()
+
+    # analyse one frame
+    def step(self, frame):
+        t_start = time.perf_counter()
+        # new anchors are swapped in between two frames
+        if self.pending_anchors is not None:
+            self.apply_anchors()
+        # give the frame to detection
+        self.frame_seq = frame.seq
+        self.frame_ts = frame.ts
+        if self.recorder is not None:
+            self.recorder.frame(frame, (self.wincap.w, self.wincap.h))
+        # frames grabbed before the region of interest moved are dropped
+        if frame.rect != self.wincap.grab_rect():
+            return
+        # updade screenshot
+        self.update(frame.img)
+        # while the life icon is not under the samples the coordenates are
+        # wrong, keep the last states until reanchor finds it again
+        if not self.check_samples(frame.rect):
+            self.start_reanchor()
+            return
+        #check life
+        if self.region_changed("life"):
+            t_bar = time.perf_counter()
+            self.life_pct = self.bar_percent("life")
+            metrics.record('bars', time.perf_counter() - t_bar)
+        #check mana
+        if self.region_changed("mana"):
+            t_bar = time.perf_counter()
+            self.mana_pct = self.bar_percent("mana")
+            metrics.record('bars', time.perf_counter() - t_bar)
+        #check the numbers next to the bars
+        if self.digits is not None:
+            t_digits = time.perf_counter()
+            if self.region_changed("life_value"):
+                self.life_value = self.digits.decode(self.screenshot, *self.value_origin(self.loc_life))
+            if self.region_changed("mana_value"):
+                self.mana_value = self.digits.decode(self.screenshot, *self.value_origin(self.loc_mana))
+            metrics.record('digits', time.perf_counter() - t_digits)
+        # an unchanged bar is a reading too, the trend needs the time axis.
+        # Only the % is projected ahead, the points are the current number
+        self.life_trend.add(frame.ts, self.life_pct)
+        self.mana_trend.add(frame.ts, self.mana_pct)
+        if self.shared_lead is not None:
+            self.lead = self.shared_lead.value
+        self.state_life = self.tier(self.life_trend.predict(self.lead), self.life_value, self.life_tiers, BotState.life_FULL)
+        self.state_mana = self.tier(self.mana_trend.predict(self.lead), self.mana_value, self.mana_tiers, BotState.MANA_FULL)
+        strong, absolute = self.p_strong_heal
+        self.life_eta = None if absolute else self.life_trend.time_to(strong)
+        #check the condition icons
+        if self.region_changed("strip"):
+            t_icons = time.perf_counter()
+            self.update_conditions()
+            metrics.record('conditions', time.perf_counter() - t_icons)
+        #check food
+        estado_food = self.status_state("food")
+        if estado_food:
+            self.state_food = BotState.FOOD_LOW
+        else:
+            self.state_food = BotState.FOOD_FULL
+        #check hast
+        estado_hast = self.status_state("hast")
+        if estado_hast:
+            self.state_hast = BotState.HASTED
+        else:
+            self.state_hast = BotState.NO_HAST
+        #check the party, every member in one pass
+        if self.party is not None and 'party' in frame.regions:
+            img, rect = frame.regions['party']
+            self.party.read(img, rect)
+            self.state_party = self.party.state()
+            self.party_target = self.party.target()
+        #check the cooldown icons, a group getting ready wakes the healer
+        if self.cooldowns is not None and 'cooldowns' in frame.regions:
+            img, rect = frame.regions['cooldowns']
+            self.cooldowns.read(img, rect, frame.ts)
+            self.cooldown_ready = self.cooldowns.ready_at
+        self.steps += 1
+        if self.steps == 1:
+            startup.mark('first_frame')
+        if self.steps % self.FINGERPRINT_GAUGES == 0:
+            self.gauge_fingerprints()
+        metrics.record('detection', time.perf_counter() - t_start)
+        self.publish()
+        if self.shared is not None:
+            self.share(frame)
+        if self.recorder is not None:
+            self.recorder.state(self)
+        if self.rate is not None:
+            self.wincap.max_fps = self.rate.update(self, frame.ts)
+
+    # copy the states to the shared memory, the frames stay in this process.
+    # The reader is woken up only when the states changed
+    def share(self, frame):
+        self.shared.write({'state_seq': self.state_seq, 'frame_seq': frame.seq, 'steps': self.steps,
+                           'cpu': self.cpu + self.wincap.cpu, 'frame_ts': frame.ts,
+                           'life_pct': self.life_pct, 'mana_pct': self.mana_pct,
+                           'life_value': encode_state(self.life_value), 'mana_value': encode_state(self.mana_value),
+                           'life_eta': encode_state(self.life_eta),
+                           **{f'ready_{group}': self.cooldown_ready.get(group, -1) for group in SharedSnapshot.GROUPS},
+                           'state_life': encode_state(self.state_life), 'state_mana': encode_state(self.state_mana),
+                           'state_food': encode_state(self.state_food), 'state_hast': encode_state(self.state_hast),
+                           'state_party': encode_state(self.state_party), 'party_target': encode_state(self.party_target)})
+        if self.state_seq != self.shared_seq:
+            self.shared_seq = self.state_seq
+            self.shared_changed.set()
 
     def run(self):
 
         # start to take screenshot
         self.wincap.start()
-        # main loop
+        meter = CpuMeter()
+        # main loop, nothing to do without the status bars
+        while not self.stopped and self.state == BotState.INICIADO:
+            if meter.update():
+                self.cpu = meter.thread
+                metrics.gauge('cpu_detection', self.cpu)
+                metrics.gauge('cpu_process', meter.process)
+            # sleep until capture publishes a frame we did not see yet,
+            # only the newest one is analysed
+            frame = self.wincap.frames.wait(self.frame_seq, 0.5)
+            if frame is None:
+                continue
+            self.step(frame)
+
+class SharedSnapshot:
+
+    # float64 slots of the header, slot 0 is the seqlock counter: odd while
+    # the writer is in the middle of an update
+    FIELDS = ('state', 'state_seq', 'frame_seq', 'steps', 'cpu', 'frame_ts', 'life_pct', 'mana_pct',
+              'state_life', 'state_mana', 'state_food', 'state_hast', 'state_party',
+              'life_value', 'mana_value', 'ready_potion', 'ready_skill', 'ready_hast', 'party_target', 'window', 'life_eta')
+    # cooldown groups with a ready_ field
+    GROUPS = ('potion', 'skill', 'hast')
+    HEADER = 32 * 8
+
+    # constructor, creates the block if no name is given
+    def __init__(self, name=None):
+        self.owner = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=self.HEADER)
+        self.name = self.shm.name
+        self.seq = np.ndarray((1,), dtype=np.uint64, buffer=self.shm.buf)
+        self.header = np.ndarray((self.HEADER // 8,), dtype=np.float64, buffer=self.shm.buf)
+        self.slots = {field: i + 1 for i, field in enumerate(self.FIELDS)}
+
+    # only one process may write
+    def write(self, values):
+        self.seq[0] += 1
+        for field, value in values.items():
+            self.header[self.slots[field]] = value
+        self.seq[0] += 1
+
+    # consistent copy of the header as {field: value}, retried while a write
+    # is running or happened during the read
+    def read(self):
+        while True:
+            seq = int(self.seq[0])
+            if seq & 1:
+                time.sleep(0)
+                continue
+            header = self.header.copy()
+            if int(self.seq[0]) == seq:
+                return seq, {field: header[i] for field, i in self.slots.items()}
+
+    def close(self):
+        # the views have to go before the mapping can be closed
+        self.seq = self.header = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+# states are shared as numbers, -1 is None
+def encode_state(state):
+    return -1 if state is None else state
+
+def decode_state(value):
+    return None if value < 0 else int(value)
+
+# entry point of the detection process: calibrate, then capture and detect
+# until told to quit, sharing the states of every analysed frame
+def detection_process(name, changed, stop, char_name, p_strong_heal, p_medium_heal, p_low_heal, p_mana, capture_factory=None, rate=None, party=None, cooldowns=None, max_fps=None, lead=None):
+    shared = SharedSnapshot(name)
+    capture = capture_factory() if capture_factory is not None else None
+    detector = Detection(char_name, StatusChannel(), p_strong_heal, p_medium_heal, p_low_heal, p_mana, capture=capture, party=party, cooldowns=cooldowns)
+    detector.rate = rate
+    if max_fps is not None:
+        detector.wincap.max_fps = max_fps
+    # the keys of a background healer go to the window found here
+    window = getattr(detector.wincap, 'hwnd', None) or getattr(detector.wincap, 'window', None)
+    shared.write({'state': encode_state(detector.state), 'window': window or 0})
+    changed.set()
+    if detector.state == BotState.INICIADO:
+        detector.shared = shared
+        detector.shared_changed = changed
+        detector.shared_lead = lead
+        detector.start()
+        stop.wait()
+        detector.wincap.stop()
+        detector.stop()
+    detector.wincap.release()
+    shared.close()
+
+class RemoteDetector:
+
+    # properties read by the Healer, the same as Detection
+    state = None
+    state_life = None
+    state_mana = None
+    state_food = None
+    state_hast = None
+    state_party = None
+    life_pct = 100
+    mana_pct = 100
+    life_value = None
+    mana_value = None
+    life_eta = None
+    cooldown_ready = {}
+    party_target = None
+    frame_seq = 0
+    frame_ts = 0
+    state_seq = 0
+    steps = 0
+    # share of a core used by capture and detection in the other process
+    cpu = 0
+    # the capture lives in the other process, the handle of its window
+    # comes with the calibration
+    wincap = None
+    window = None
+    stopped = False
+    # the detection thread runs in the other process
+    thread = None
+    # seconds the process has to find the status bars
+    START_TIMEOUT = 30
+    # a fork would copy the locks the exporter, ui and profiler threads
+    # hold, the process starts clean like it does on Windows
+    context = multiprocessing.get_context('spawn')
+
+    # constructor, starts the detection process and waits for its calibration
+    def __init__(self, char_name, label_text, p_strong_heal, p_medium_heal, p_low_heal, p_mana, capture_factory=None, rate=None, party=None, cooldowns=None, max_fps=None):
+        self.lock = Lock()
+        self.label_text = label_text
+        self.shared = SharedSnapshot()
+        self.shared.write({'state': -1})
+        # set by the process when the states change, the values go through the shared memory
+        self.changed = self.context.Event()
+        self.quit = self.context.Event()
+        # the lead of a predictive Healer, read by the process every frame
+        self.lead = self.context.Value('d', 0, lock=False)
+        self.process = self.context.Process(target=detection_process, name='detection', daemon=True,
+                                            args=(self.shared.name, self.changed, self.quit, char_name, p_strong_heal,
+                                                  p_medium_heal, p_low_heal, p_mana, capture_factory, rate, party, cooldowns, max_fps, self.lead))
+        self.process.start()
+        deadline = time.perf_counter() + self.START_TIMEOUT
+        while self.process.is_alive() and time.perf_counter() < deadline:
+            if self.changed.wait(0.1):
+                break
+        self.read()
+        if self.state == BotState.INICIADO:
+            self.label_text['text'] = f'Está no jogo'
+        else:
+            self.label_text['text'] = f'Erro: Não achou as barras de status'
+
+    # copy the shared values to the attributes
+    def read(self):
+        self.lock.acquire()
+        if self.shared is not None:
+            seq, values = self.shared.read()
+            self.state = decode_state(values['state'])
+            self.window = int(values['window']) or None
+            self.state_life = decode_state(values['state_life'])
+            self.state_mana = decode_state(values['state_mana'])
+            self.state_food = decode_state(values['state_food'])
+            self.state_hast = decode_state(values['state_hast'])
+            self.state_party = decode_state(values['state_party'])
+            self.party_target = decode_state(values['party_target'])
+            self.life_pct = values['life_pct']
+            self.mana_pct = values['mana_pct']
+            self.life_value = decode_state(values['life_value'])
+            self.life_eta = None if values['life_eta'] < 0 else values['life_eta']
+            self.mana_value = decode_state(values['mana_value'])
+            self.cooldown_ready = {group: values[f'ready_{group}'] for group in SharedSnapshot.GROUPS
+                                   if values[f'ready_{group}'] >= 0}
+            self.frame_seq = int(values['frame_seq'])
+            self.steps = int(values['steps'])
+            self.cpu = values['cpu']
+            if self.steps and 'first_frame' not in startup.marks:
+                startup.mark('first_frame')
+            self.frame_ts = values['frame_ts']
+            self.state_seq = int(values['state_seq'])
+        self.lock.release()
+
+    # block until the states change after seq or the timeout ends,
+    # returns the current state sequence number
+    def wait_state(self, seq, timeout=None):
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while True:
+            self.read()
+            if self.state_seq != seq or self.stopped:
+                return self.state_seq
+            remaining = None if deadline is None else deadline - time.perf_counter()
+            if remaining is not None and remaining <= 0:
+                return self.state_seq
+            # cleared before the next read, so a change after it wakes the wait
+            if self.changed.wait(remaining):
+                self.changed.clear()
+
+    # seconds ahead the process reads the tiers
+    def set_lead(self, lead):
+        self.lead.value = lead
+
+    # the process detects since it started
+    def start(self):
+        pass
+
+    def stop(self):
+        self.stopped = True
+        self.quit.set()
+        self.changed.set()
+        self.process.join(1)
+        self.lock.acquire()
+        if self.shared is not None:
+            self.shared.close()
+            self.shared = None
+        self.lock.release()
+
+class HealRule:
+
+    # properties
+    name = None
+    # hotkey pressed, None for rules that only show a message
+    key = None
+    # rules of the same group share one cooldown
+    group = None
+    # the highest priority of a group wins
+    priority = 0
+    label = None
+    # detection attribute -> accepted states
+    states = None
+
+    # constructor
+    def __init__(self, name, key, group, priority, label=None, **states):
+        self.name = name
+        self.key = key
+        self.group = group
+        self.priority = priority
+        self.label = label
+        self.states = {attr: frozenset(values if isinstance(values, (tuple, list, set, frozenset)) else (values,))
+                       for attr, values in states.items()}
+
+    def matches(self, state):
+        for attr, values in self.states.items():
+            if state[RuleTable.ATTRS.index(attr)] not in values:
+                return False
+        return True
+
+class RuleTable:
+
+    # detection states a rule can look at, in the order of the decision key
+    ATTRS = ('state_life', 'state_mana', 'state_food', 'state_hast', 'state_party')
+    DOMAINS = ((None, BotState.life_FULL, BotState.life_GREEN, BotState.life_YELLOW, BotState.life_RED),
+               (None, BotState.MANA_FULL, BotState.MANA_LOW),
+               (None, BotState.FOOD_FULL, BotState.FOOD_LOW),
+               (None, BotState.NO_HAST, BotState.HASTED),
+               (None, BotState.PARTY_OK, BotState.PARTY_LOW))
+
+    # constructor
+    def __init__(self, rules):
+        self.rules = sorted(rules, key=lambda rule: -rule.priority)
+        self.order = {rule.name: i for i, rule in enumerate(rules)}
+        self.labels = {rule.name: rule.label for rule in rules}
+        # every combination of states is decided once here:
+        # key -> (best rule of each group that presses a key, names of all matching rules)
+        self.table = {}
+        for state in itertools.product(*self.DOMAINS):
+            matching = [rule for rule in self.rules if rule.matches(state)]
+            actions = []
+            groups = set()
+            for rule in matching:
+                if rule.key is not None and rule.group not in groups:
+                    groups.add(rule.group)
+                    actions.append(rule)
+            self.table[state] = (tuple(actions), frozenset(rule.name for rule in matching))
+
+    # decision key of a detector
+    def key(self, detector):
+        return (detector.state_life, detector.state_mana, detector.state_food, detector.state_hast, detector.state_party)
+
+    def decide(self, key):
+        return self.table[key]
+
+class CooldownScheduler:
+
+    # constructor
+    def __init__(self, cooldowns):
+        # group -> cooldown in seconds
+        self.cooldowns = cooldowns
+        # group -> time it can be used again
+        self.ready_at = {group: 0 for group in cooldowns}
+        # heap of (expiry, group) of the cooldowns running
+        self.expiries = []
+        # group -> time of the last use, and True once the screen showed
+        # the cooldown that use started
+        self.used_at = {group: 0 for group in cooldowns}
+        self.seen = {group: False for group in cooldowns}
+
+    def ready(self, group, now):
+        return now >= self.ready_at[group]
+
+    def use(self, group, now):
+        self.ready_at[group] = now + self.cooldowns[group]
+        self.used_at[group] = now
+        self.seen[group] = False
+        heapq.heappush(self.expiries, (self.ready_at[group], group))
+
+    # time the group is ready as read on a frame taken at frame_ts. Frames
+    # from before the last use are stale, and a ready reading only counts
+    # once the cooldown of that use was seen, the client takes a round trip
+    # to show it
+    def observe(self, group, ready_at, frame_ts):
+        if group not in self.ready_at or frame_ts < self.used_at[group]:
+            return
+        if ready_at > frame_ts:
+            self.seen[group] = True
+        elif not self.seen[group]:
+            return
+        if ready_at != self.ready_at[group]:
+            self.ready_at[group] = ready_at
+            heapq.heappush(self.expiries, (ready_at, group))
+
+    # seconds until the next cooldown ends, None if none is running
+    def next_wakeup(self, now):
+        # drop the expiries that passed or were replaced by a newer use
+        while self.expiries and (self.expiries[0][0] <= now or self.expiries[0][0] != self.ready_at[self.expiries[0][1]]):
+            heapq.heappop(self.expiries)
+        if not self.expiries:
+            return None
+        return self.expiries[0][0] - now
+
+class InputBackend:
+
+    # name shown in the metrics and logs
+    name = None
+
+    # send one keypress, down and up
+    def press(self, key):
+        raise NotImplementedError
+
+    def release(self):
+        pass
+
+class PyAutoGuiInput(InputBackend):
+
+    name = 'pyautogui'
+
+    # constructor
+    def __init__(self):
+        # pyautogui sleeps 0.1s after every call by default
+        pyautogui.PAUSE = 0
+
+    def press(self, key):
+        pyautogui.press(key, _pause=False)
+
+# virtual key codes of the hotkey names used in the setup screen
+VK_NAMES = {'enter': 0x0D, 'esc': 0x1B, 'space': 0x20, 'tab': 0x09, 'backspace': 0x08,
+            'pageup': 0x21, 'pagedown': 0x22, 'end': 0x23, 'home': 0x24, 'insert': 0x2D, 'delete': 0x2E}
+
+def virtual_key(key):
+    key = key.lower()
+    if key in VK_NAMES:
+        return VK_NAMES[key]
+    if len(key) > 1 and key[0] == 'f' and key[1:].isdigit():
+        return 0x6F + int(key[1:])
+    if len(key) == 1 and key.isalnum():
+        return ord(key.upper())
+    raise Exception('Unknown hotkey: {}'.format(key))
+
+class KEYBDINPUT(ctypes.Structure):
+    _fields_ = [('wVk', ctypes.c_ushort), ('wScan', ctypes.c_ushort), ('dwFlags', ctypes.c_ulong),
+                ('time', ctypes.c_ulong), ('dwExtraInfo', ctypes.c_size_t)]
+
+class MOUSEINPUT(ctypes.Structure):
+    # only here so the union has the size SendInput expects
+    _fields_ = [('dx', ctypes.c_long), ('dy', ctypes.c_long), ('mouseData', ctypes.c_ulong),
+                ('dwFlags', ctypes.c_ulong), ('time', ctypes.c_ulong), ('dwExtraInfo', ctypes.c_size_t)]
+
+class INPUTUNION(ctypes.Union):
+    _fields_ = [('ki', KEYBDINPUT), ('mi', MOUSEINPUT)]
+
+class INPUT(ctypes.Structure):
+    _fields_ = [('type', ctypes.c_ulong), ('u', INPUTUNION)]
+
+class SendInputBackend(InputBackend):
+
+    name = 'sendinput'
+    INPUT_KEYBOARD = 1
+    KEYEVENTF_KEYUP = 0x2
+
+    # constructor
+    def __init__(self):
+        self.user32 = ctypes.windll.user32
+        self.user32.SendInput.argtypes = [ctypes.c_uint, ctypes.c_void_p, ctypes.c_int]
+        # down and up go in one call so nothing gets between them
+        self.events = (INPUT * 2)()
+
+    def press(self, key):
+        vk = virtual_key(key)
+        scan = self.user32.MapVirtualKeyW(vk, 0)
+        for event, flags in zip(self.events, (0, self.KEYEVENTF_KEYUP)):
+            event.type = self.INPUT_KEYBOARD
+            event.u.ki = KEYBDINPUT(vk, scan, flags, 0, 0)
+        self.user32.SendInput(2, self.events, ctypes.sizeof(INPUT))
+
+class PostMessageInput(InputBackend):
+
+    name = 'postmessage'
+    WM_KEYDOWN = 0x0100
+    WM_KEYUP = 0x0101
+
+    # constructor
+    def __init__(self, hwnd):
+        # the keys go to this window even when it is in the background,
+        # so every client of a MultiHealer gets its own
+        self.hwnd = hwnd
+        self.user32 = ctypes.windll.user32
+
+    def press(self, key):
+        vk = virtual_key(key)
+        scan = self.user32.MapVirtualKeyW(vk, 0)
+        # repeat count 1 and the scan code, key up also sets the previous state and transition bits
+        self.user32.PostMessageW(self.hwnd, self.WM_KEYDOWN, vk, 1 | scan << 16)
+        self.user32.PostMessageW(self.hwnd, self.WM_KEYUP, vk, 1 | scan << 16 | 0xC0000000)
+
+class XInput(InputBackend):
+
+    # display connection and key codes of the X backends
+
+    # constructor
+    def __init__(self):
+        self.xlib = ctypes.CDLL(ctypes.util.find_library('X11'))
+        self.xlib.XOpenDisplay.restype = ctypes.c_void_p
+        self.xlib.XOpenDisplay.argtypes = [ctypes.c_char_p]
+        self.xlib.XStringToKeysym.restype = ctypes.c_ulong
+        self.xlib.XStringToKeysym.argtypes = [ctypes.c_char_p]
+        self.xlib.XKeysymToKeycode.restype = ctypes.c_ubyte
+        self.xlib.XKeysymToKeycode.argtypes = [ctypes.c_void_p, ctypes.c_ulong]
+        self.xlib.XFlush.argtypes = [ctypes.c_void_p]
+        self.xlib.XCloseDisplay.argtypes = [ctypes.c_void_p]
+        # a connection of our own, the capture one belongs to another thread
+        self.display = self.xlib.XOpenDisplay(None)
+        if not self.display:
+            raise Exception('Could not open the X display: {}'.format(os.environ.get('DISPLAY')))
+        self.keycodes = {}
+
+    # keysym names are case sensitive: F1, Return, a
+    KEYSYMS = {'enter': 'Return', 'esc': 'Escape', 'space': 'space', 'tab': 'Tab', 'backspace': 'BackSpace',
+               'pageup': 'Prior', 'pagedown': 'Next', 'end': 'End', 'home': 'Home', 'insert': 'Insert', 'delete': 'Delete'}
+
+    def keycode(self, key):
+        if key not in self.keycodes:
+            name = key.lower()
+            if name in self.KEYSYMS:
+                name = self.KEYSYMS[name]
+            elif len(name) > 1 and name[0] == 'f' and name[1:].isdigit():
+                name = name.upper()
+            keysym = self.xlib.XStringToKeysym(name.encode())
+            code = self.xlib.XKeysymToKeycode(self.display, keysym) if keysym else 0
+            if not code:
+                raise Exception('Unknown hotkey: {}'.format(key))
+            self.keycodes[key] = code
+        return self.keycodes[key]
+
+    def release(self):
+        if self.display:
+            self.xlib.XCloseDisplay(self.display)
+            self.display = None
+
+class XTestInput(XInput):
+
+    name = 'xtest'
+
+    # constructor
+    def __init__(self):
+        super().__init__()
+        self.xtst = ctypes.CDLL(ctypes.util.find_library('Xtst'))
+        self.xtst.XTestFakeKeyEvent.argtypes = [ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_ulong]
+
+    # the keys go to the window with the focus
+    def press(self, key):
+        code = self.keycode(key)
+        self.xtst.XTestFakeKeyEvent(self.display, code, True, 0)
+        self.xtst.XTestFakeKeyEvent(self.display, code, False, 0)
+        self.xlib.XFlush(self.display)
+
+class XKeyEvent(ctypes.Structure):
+    _fields_ = [('type', ctypes.c_int), ('serial', ctypes.c_ulong), ('send_event', ctypes.c_int),
+                ('display', ctypes.c_void_p), ('window', ctypes.c_ulong), ('root', ctypes.c_ulong),
+                ('subwindow', ctypes.c_ulong), ('time', ctypes.c_ulong), ('x', ctypes.c_int), ('y', ctypes.c_int),
+                ('x_root', ctypes.c_int), ('y_root', ctypes.c_int), ('state', ctypes.c_uint),
+                ('keycode', ctypes.c_uint), ('same_screen', ctypes.c_int)]
+
+class XEvent(ctypes.Union):
+    # XEvent is padded to 24 longs
+    _fields_ = [('xkey', XKeyEvent), ('pad', ctypes.c_long * 24)]
+
+class XSendEventInput(XInput):
+
+    name = 'xsendevent'
+    KeyPress = 2
+    KeyRelease = 3
+    KeyPressMask = 1
+    KeyReleaseMask = 2
+
+    # constructor
+    def __init__(self, window):
+        # the keys go to this window even when it is in the background,
+        # so every client of a MultiHealer gets its own. They are marked as
+        # sent by a client, a program may ignore them
+        super().__init__()
+        self.window = window
+        self.xlib.XDefaultRootWindow.restype = ctypes.c_ulong
+        self.xlib.XDefaultRootWindow.argtypes = [ctypes.c_void_p]
+        self.xlib.XSendEvent.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.c_int, ctypes.c_long, ctypes.c_void_p]
+        self.event = XEvent()
+        key = self.event.xkey
+        key.display = self.display
+        key.window = window
+        key.root = self.xlib.XDefaultRootWindow(self.display)
+        key.same_screen = 1
+
+    def press(self, key):
+        event = self.event.xkey
+        event.keycode = self.keycode(key)
+        for kind, mask in ((self.KeyPress, self.KeyPressMask), (self.KeyRelease, self.KeyReleaseMask)):
+            event.type = kind
+            self.xlib.XSendEvent(self.display, self.window, True, mask, ctypes.byref(self.event))
+        self.xlib.XFlush(self.display)
+
+class RecordingInput(InputBackend):
+
+    name = 'recording'
+
+    # constructor
+    def __init__(self, clock=time.perf_counter):
+        # (time, key) of every press, nothing reaches the client
+        self.presses = []
+        self.clock = clock
+
+    def press(self, key):
+        self.presses.append((self.clock(), key))
+
+# pick the fastest backend of the platform, PostMessage or XSendEvent when
+# the keys must reach a window that is not in the foreground. window is the
+# handle of the client, taken from the capture when not given
+def create_input(capture=None, background=False, window=None):
+    if window is None:
+        window = getattr(capture, 'hwnd', None) or getattr(capture, 'window', None)
+    if sys.platform == 'win32':
+        if background and window:
+            return PostMessageInput(window)
+        return SendInputBackend()
+    if background and window and os.environ.get('DISPLAY'):
+        return XSendEventInput(window)
+    if ctypes.util.find_library('Xtst') and os.environ.get('DISPLAY'):
+        return XTestInput()
+    return PyAutoGuiInput()
+
+class InputDispatcher:
+
+    # threading properties
+    stopped = True
+    lock = None
+    thread = None
+
+    # session recorder of the delivered keys, None records nothing
+    recorder = None
+
+    # constructor, without a thread the keys are sent inside send
+    def __init__(self, backend, threaded=True, clock=time.perf_counter):
+        self.lock = Lock()
+        self.ready = Condition(self.lock)
+        self.backend = backend
+        self.threaded = threaded
+        self.clock = clock
+        # (key, enqueue time, frame time) waiting for the worker
+        self.queue = []
+        # key -> time it was last queued, repeats inside the window are dropped
+        self.last_queued = {}
+        self.coalesced = 0
+        # age of the frame behind the last delivered key in seconds
+        self.last_frame_age = 0
+
+    # queue a keypress and return right away, False when it was coalesced
+    # with the same key queued less than window seconds ago
+    def send(self, key, window=0, frame_ts=None):
+        now = self.clock()
+        self.lock.acquire()
+        if now - self.last_queued.get(key, -window - 1) < window or any(item[0] == key for item in self.queue):
+            self.coalesced += 1
+            self.lock.release()
+            return False
+        self.last_queued[key] = now
+        if not self.threaded:
+            self.lock.release()
+            self.deliver(key, now, frame_ts)
+            return True
+        self.queue.append((key, now, frame_ts))
+        self.ready.notify()
+        self.lock.release()
+        return True
+
+    def deliver(self, key, t_queued, frame_ts):
+        self.backend.press(key)
+        t_end = self.clock()
+        metrics.record('input_delivery', t_end - t_queued)
+        metrics.record(f'input_delivery:{key}', t_end - t_queued)
+        if self.recorder is not None:
+            self.recorder.key(key, t_end)
+        if frame_ts is not None:
+            self.last_frame_age = t_end - frame_ts
+            metrics.record('frame_age_at_keypress', self.last_frame_age)
+
+    def start(self):
+        self.stopped = False
+        self.thread = Thread(target=self.run, name='input')
+        self.thread.start()
+
+    def stop(self):
+        self.lock.acquire()
+        self.stopped = True
+        self.ready.notify()
+        self.lock.release()
+
+    def run(self):
+        self.lock.acquire()
         while not self.stopped:
-            if self.state == BotState.INICIADO:
-                # do object detection
-                if self.wincap.screenshot is None:
-                    continue
-                # give a new screenshot to detection
-                self.screenshot = self.wincap.screenshot
-                # updade screenshot
-                self.update(self.screenshot)
-                #check life
-                estado_life_vermelha = self.bar_state(self.plx_strong_heal, "life")
-                if estado_life_vermelha:
-                    self.state_life = BotState.life_RED
-                #check life
-                estado_life_amarela = self.bar_state(self.plx_medium_heal, "life")
-                if estado_life_amarela:
-                    self.state_life = BotState.life_YELLOW
-                #check life
-                estado_life_verde = self.bar_state(self.plx_low_heal, "life")
-                if estado_life_verde:
-                    self.state_life = BotState.life_GREEN
-                else:
-                    self.state_life = BotState.life_FULL
-                #check mana
-                estado_mana = self.bar_state(self.plx_mana, "mana")
-                if estado_mana:
-                    self.state_mana = BotState.MANA_LOW
-                else:
-                    self.state_mana = BotState.MANA_FULL
-                #check food
-                estado_food = self.status_state("food")
-                if estado_food:
-                    self.state_food = BotState.FOOD_LOW
-                else:
-                    self.state_food = BotState.FOOD_FULL
-                #check hast
-                estado_hast = self.status_state("hast")
-                if estado_hast:
-                    self.state_hast = BotState.HASTED
-                else:
-                    self.state_hast = BotState.NO_HAST
+            if not self.queue:
+                self.ready.wait()
+                continue
+            key, t_queued, frame_ts = self.queue.pop(0)
+            # the backend may block, keep the lock free for send meanwhile
+            self.lock.release()
+            self.deliver(key, t_queued, frame_ts)
+            self.lock.acquire()
+        self.lock.release()
+        self.backend.release()
 
 class Healer():
     # threading properties
     stopped = True
     lock = None
-    def __init__(self,char_name, p_low_heal, p_medium_heal, p_strong_heal, p_mana, label_text, hk_cura_menor, hk_cura_media, hk_cura_maior, hk_cura_mana, hk_food, cb_food, hk_hast, cb_hast):
+    thread = None
+    # cooldown of each group of rules in seconds
+    COOLDOWNS = {'potion': 1, 'skill': 1, 'hast': 2}
+    detector = None
+    # time of the cooldowns, a replay runs them on the recorded clock
+    clock = time.perf_counter
+    # the replay sends the keys without the dispatcher thread
+    input_threaded = True
+    # frame source of the detection, None opens the client window
+    capture = None
+    # session recorder, None records nothing
+    recorder = None
+    # capture rate, with min_fps it goes down to it while the bars are full and still
+    min_fps = None
+    max_fps = 60
+    # the predictive mode never looks further ahead than this, in seconds
+    MAX_LEAD = 0.5
+    def __init__(self,char_name, p_low_heal, p_medium_heal, p_strong_heal, p_mana, label_text, hk_cura_menor, hk_cura_media, hk_cura_maior, hk_cura_mana, hk_food, cb_food, hk_hast, cb_hast, predictive=False, isolated=False, party=None, cooldowns=None):
         self.label_text = label_text
         self.char_name = char_name
         # hotkey
@@ -329,317 +2827,697 @@ class Healer():
         # check box
         self.cb_food = cb_food
         self.cb_hast = hk_hast
-        # % of heals
+        # % of heals, or points like '1200hp'
         self.p_low_heal = p_low_heal
         self.p_medium_heal = p_medium_heal
         self.p_strong_heal = p_strong_heal
         self.p_mana = p_mana
-        # used potion cooldown
-        self.t_cd_pot_used = 0
-        # potion cooldown
-        self.t_cd_pot= 0
-        # used skill cooldown
-        self.t_cd_skill_used = 0
-        # skill cooldown
-        self.t_cd_skill= 0
-        # used hast cooldown
-        self.t_cd_hast_used = 0
-        # hast cooldown
-        self.t_cd_hast= 0
-        # actions calls
-        self.mana_low_call = False
-        self.mana_full_call = False
-        self.life_low_call = False
-        self.life_med_call = False
-        self.life_high_call = False
-        self.life_full_call = False
+        # settings of the PartyDetector and the heal: one hotkey, or hotkeys
+        # with one per row of the panel. None heals only us
+        self.party = party
+        # settings of the CooldownDetector, None keeps the fixed COOLDOWNS timers
+        self.cooldowns = cooldowns
+        # decision table and cooldowns
+        self.rules = RuleTable(self.default_rules())
+        self.scheduler = CooldownScheduler(dict(self.COOLDOWNS))
+        # rules that matched the last decision, their messages are shown once
+        self.active = frozenset()
+        # keys go through a queue so a slow backend does not hold the decisions,
+        # input_backend replaces the platform one, background sends to the window
+        self.input_backend = None
+        self.background = False
+        self.input = None
+        # heal when the bar will be in a tier once the key lands, instead of
+        # when it already is
+        self.predictive = predictive
+        # capture and detection in a process of their own, away from the GIL of the UI
+        self.isolated = isolated
+
+    # the heals of the setup screen
+    def default_rules(self):
+        life_not_red = (None, BotState.life_FULL, BotState.life_GREEN, BotState.life_YELLOW)
+        rules = []
+        # the party heal shares the cooldown of our own spell, which goes first
+        if self.party is not None and (self.party.get('hotkey') or self.party.get('hotkeys')):
+            rules.append(HealRule('cura_party', self.party.get('hotkey') or self.party['hotkeys'][0], 'skill', 5,
+                                  f"Curar party {self.party.get('threshold', 70)} %", state_party=BotState.PARTY_LOW))
+        return rules + [HealRule('cura_maior', self.cura_maior, 'potion', 30, f"Curar life {threshold_label(self.p_strong_heal)}", state_life=BotState.life_RED),
+                HealRule('cura_media', self.cura_media, 'potion', 20, f"Curar life {threshold_label(self.p_medium_heal)}", state_life=BotState.life_YELLOW),
+                HealRule('cura_mana', self.cura_mana, 'potion', 10, f"Curar mana {threshold_label(self.p_mana)}", state_mana=BotState.MANA_LOW, state_life=life_not_red),
+                HealRule('cura_menor', self.cura_menor, 'skill', 10, f"Curar life {threshold_label(self.p_low_heal)}", state_life=BotState.life_GREEN),
+                HealRule('hast', self.hk_hast, 'hast', 10, f" Usando Hast %", state_hast=BotState.NO_HAST),
+                HealRule('life_full', None, None, 0, f"life 100 %", state_life=BotState.life_FULL),
+                HealRule('mana_full', None, None, 0, f"Mana 100 %", state_mana=BotState.MANA_FULL)]
+
+    # queue a hotkey, the dispatcher records the delivery and frame age.
+    # False when the key was dropped as a repeat
+    def press(self, key, group=None):
+        t_start = time.perf_counter()
+        # with the cooldowns read on screen the scheduler knows better than
+        # a fixed window, a group shown ready early must go out
+        window = self.scheduler.cooldowns.get(group, 0) if self.cooldowns is None else 0
+        sent = self.input.send(key, window, self.detector.frame_ts)
+        metrics.record('press', time.perf_counter() - t_start)
+        return sent
+
+    # hotkey of a rule. With one hotkey per party row, each one a heal on
+    # that member, the party heal goes to the most hurt one
+    def rule_key(self, rule):
+        if rule.name == 'cura_party' and self.party.get('hotkeys'):
+            row = self.detector.party_target
+            if row is not None and row < len(self.party['hotkeys']):
+                return self.party['hotkeys'][row]
+        return rule.key
+
+    # act on the current states, returns how long until the next cooldown
+    # ends or None if none is running
+    def step(self):
+        t_start = time.perf_counter()
+        if self.predictive:
+            # the frame age of the last key is the whole capture, detection
+            # and input latency, read the tiers that far ahead
+            self.detector.set_lead(min(self.input.last_frame_age, self.MAX_LEAD))
+        # the cooldowns read on screen correct the timers
+        for group, ready_at in self.detector.cooldown_ready.items():
+            self.scheduler.observe(group, ready_at, self.detector.frame_ts)
+        actions, active = self.rules.decide(self.rules.key(self.detector))
+        for rule in actions:
+            if self.scheduler.ready(rule.group, self.clock()) and self.press(self.rule_key(rule), rule.group):
+                self.scheduler.use(rule.group, self.clock())
+        # show the message of the rules that just started to match
+        if active is not self.active:
+            for name in sorted(active - self.active, key=self.rules.order.get):
+                if self.rules.labels[name]:
+                    self.label_text['text'] = self.rules.labels[name]
+            self.active = active
+        metrics.record('decision', time.perf_counter() - t_start)
+        return self.scheduler.next_wakeup(self.clock())
+
+    # values of the live panel, read by the ui thread
+    def telemetry(self):
+        if self.detector is None:
+            return None
+        if self.isolated:
+            self.detector.read()
+        latency = self.input.last_frame_age if self.input is not None else 0
+        cpu = self.detector.cpu if self.isolated else self.detector.cpu + self.detector.wincap.cpu
+        return {'steps': self.detector.steps, 'life': self.detector.life_pct,
+                'mana': self.detector.mana_pct, 'latency': latency, 'cpu': cpu,
+                'life_value': self.detector.life_value, 'mana_value': self.detector.mana_value,
+                'life_eta': self.detector.life_eta}
+
+    # calibrate the detection, True if the status bars were found
+    def setup(self):
+        # start detectador class
+        t_start = time.perf_counter()
+        rate = RateController(self.min_fps, self.max_fps) if self.min_fps is not None else None
+        party = None
+        if self.party is not None:
+            party = PartyDetector(**{key: value for key, value in self.party.items() if key not in ('hotkey', 'hotkeys')})
+        cooldowns = None
+        if self.cooldowns is not None:
+            cooldowns = CooldownDetector(cooldowns=self.COOLDOWNS, **self.cooldowns)
+        if self.isolated:
+            self.detector = RemoteDetector(self.char_name, self.label_text, self.p_strong_heal, self.p_medium_heal, self.p_low_heal, self.p_mana, rate=rate, party=party, cooldowns=cooldowns, max_fps=self.max_fps)
+        else:
+            self.detector = Detection(self.char_name, self.label_text, self.p_strong_heal, self.p_medium_heal, self.p_low_heal, self.p_mana, capture=self.capture, party=party, cooldowns=cooldowns)
+            self.detector.rate = rate
+            self.detector.wincap.max_fps = self.max_fps
+        startup.durations.setdefault('calibration', time.perf_counter() - t_start)
+        backend = self.input_backend or create_input(self.detector.wincap, self.background, getattr(self.detector, 'window', None))
+        self.input = InputDispatcher(backend, self.input_threaded, self.clock)
+        if self.input_threaded:
+            self.input.start()
+        # the frames of an isolated detection stay in its process
+        if self.recorder is not None:
+            self.detector.recorder = self.recorder
+            self.input.recorder = self.recorder
+        return self.detector.state == BotState.INICIADO
+
+    # setup that shows the error instead of raising it, False if the healer can't run
+    def safe_setup(self):
+        try:
+            return self.setup()
+        except Exception as e:
+            self.label_text['text'] = f'Erro: {e}'
+            return False
 
     def run(self):
 
-        # start detectador class
-        self.detector = Detection(self.char_name, self.label_text, self.p_strong_heal, self.p_medium_heal, self.p_low_heal, self.p_mana)
+        # without a window or the status bars there is nothing to do
+        if not self.safe_setup():
+            self.stop()
+            return
         # start thread
         self.detector.start()
 
+        state_seq = 0
+        timeout = None
         while not self.stopped:
-            # start status check
-            self.t_cd_pot = time.perf_counter()
-            if self.detector.state_life == BotState.life_RED:
-                self.life_high_call = False
-                self.life_med_call = False
-                self.life_full_call = False
-                if self.t_cd_pot - self.t_cd_pot_used >= 1:
-                    life_high_call = False
-                    pyautogui.press(self.cura_maior)
-                    self.t_cd_pot_used = time.perf_counter()
-                    if self.life_low_call == False:
-                        self.life_low_call = True
-                        self.label_text['text'] = f"Curar life {self.p_strong_heal} %"
-
-            if self.detector.state_life == BotState.life_YELLOW:
-                self.life_high_call = False
-                self.life_low_call = False
-                self.life_full_call = False
-                if self.t_cd_pot - self.t_cd_pot_used >= 1:
-                    pyautogui.press(self.cura_media)
-                    self.t_cd_pot_used = time.perf_counter()
-                    if self.life_med_call == False:
-                        self.life_med_call = True
-                        self.label_text['text'] = f"Curar life {self.p_medium_heal} %"
-
-            self.t_cd_skill = time.perf_counter()
-            if self.detector.state_life == BotState.life_GREEN:
-                self.life_med_call = False
-                self.life_low_call = False
-                self.life_full_call = False
-                if self.t_cd_skill - self.t_cd_skill_used >= 1:
-                    pyautogui.press(self.cura_menor)
-                    self.t_cd_skill_used = time.perf_counter()
-                    if self.life_high_call == False:
-                        self.life_high_call = True
-                        self.label_text['text'] = f"Curar life {self.p_low_heal} %"
-
-            if self.detector.state_life == BotState.life_FULL:
-                self.life_med_call = False
-                self.life_low_call = False
-                self.life_high_call = False
-                if self.life_full_call == False:
-                    self.life_full_call = True
-                    self.label_text['text'] = f"life 100 %"
-
-            if self.detector.state_mana == BotState.MANA_FULL:
-                self.mana_low_call = False
-                if self.mana_full_call == False:
-                    self.mana_full_call = True
-                    self.label_text['text'] = f"Mana 100 %"
-
-            self.t_cd_pot = time.perf_counter()
-
-            if self.detector.state_mana == BotState.MANA_LOW and self.detector.state_life != BotState.life_RED:
-                self.mana_full_call = False
-                if self.t_cd_pot - self.t_cd_pot_used >= 1:
-                    pyautogui.press(self.cura_mana)
-                    self.t_cd_pot_used = time.perf_counter()
-                    if self.mana_low_call == False:
-                        self.mana_low_call = True
-                        self.label_text['text'] = f"Curar mana {self.p_mana} %"
-            '''#usar Food
-            if self.detector.state_food == BotState.FOOD_LOW:
-                pyautogui.press(self.hk_food)
-                self.label_text['text'] = f" Usando Food %"'''
-
-            print("Check hast")
-            self.t_cd_hast = time.perf_counter()
-            print(self.detector.state_hast)
-            if self.detector.state_hast == BotState.NO_HAST:
-                if self.t_cd_hast - self.t_cd_hast_used >= 2:
-                    pyautogui.press(self.hk_hast)
-                    self.label_text['text'] = f" Usando Hast %"
-                    self.t_cd_hast_used = time.perf_counter()
+            # sleep until detection publishes new states or a cooldown is over
+            state_seq = self.detector.wait_state(state_seq, timeout)
+            if self.stopped:
+                break
+            timeout = self.step()
 
     def start(self):
         # Avisa a thread para inicar a função
         self.stopped = False
-        t = Thread(target=self.run)
-        t.start()
+        self.thread = Thread(target=self.run, name='healer')
+        self.thread.start()
 
     def stop(self):
         #Avisa a thread para Parar
         self.stopped = True
-        self.detector.wincap.stop()
+        if self.detector is None:
+            return
+        if self.detector.wincap is not None:
+            self.detector.wincap.stop()
         self.detector.stop()
+        if self.input is not None:
+            self.input.stop()
+
+    # wait for the threads of a stopped healer, after it nothing writes to
+    # the recorder anymore
+    def join(self):
+        threads = [self.thread]
+        if self.detector is not None:
+            threads.append(self.detector.thread)
+        if self.input is not None:
+            threads.append(self.input.thread)
+        for thread in threads:
+            if thread is not None:
+                thread.join()
+
+class MultiHealer:
 
-class App(tk.Tk):
-    def __init__(self):
-        super().__init__()
-        #setup
-        self.title('Healer')
-        self.iconbitmap(r'logo.ico')
-        self.geometry("300x300")
-        self.wm_attributes("-topmost", True)
-        #widgets
-        self.Tabs = Notebook(self)
-        self.nameMenu = Menu(self.Tabs.tab1)
-        self.healerSetup = HealerSetup(self.Tabs.tab1)
-        self.buttonMenu = ButtonMenu(self.Tabs.tab1, self.start, self.stop)
-        self.textMenu = TextMenu(self.Tabs.tab1)
-        self.suportSetup = SuportSetup(self.Tabs.tab2)
-        self.stopped_macro = False
-        #run
-        self.mainloop()
+    # threading properties
+    stopped = True
+    lock = None
+    thread = None
 
-    def start(self):
+    # share of a core used by the whole process
+    cpu = 0
+
+    # constructor
+    def __init__(self, healers, workers=4, max_fps=30):
+        # create a thread lock object, the scheduler waits on it for finished ticks.
+        # A tick that already ended runs its callback in the scheduler, which holds it
+        self.lock = RLock()
+        self.tick_done = Condition(self.lock)
+        # one Healer per character, each one keeps its own hotkeys and cooldowns
+        self.healers = healers
+        # size of the worker pool shared by all the characters
+        self.workers = workers
+        # ticks per second of each character
+        self.max_fps = max_fps
+        # characters with a tick running or queued in the pool
+        self.busy = set()
+        # time each character is due for its next tick
+        self.due = {}
+        # characters whose tick raised, they are dropped
+        self.failed = set()
+
+    # capture, detect and act for one character, runs in the pool
+    def tick(self, healer):
+        try:
+            # the pool drives the grabs, it follows the window too
+            healer.detector.wincap.poll_geometry(time.perf_counter())
+            healer.detector.wincap.grab()
+            # a skipped grab leaves the frame the detector already saw
+            frame = healer.detector.wincap.frames.latest()
+            if frame is not None and frame.seq != healer.detector.frame_seq:
+                healer.detector.step(frame)
+            healer.step()
+        finally:
+            self.lock.acquire()
+            self.busy.discard(healer)
+            # the rate controller of a calm character lowers its rate
+            self.due[healer] = time.perf_counter() + 1 / min(self.max_fps, healer.detector.wincap.max_fps)
+            self.tick_done.notify()
+            self.lock.release()
+
+    # a tick that raised drops its character, the others go on
+    def check_tick(self, healer, future):
+        error = future.exception()
+        if error is None:
+            return
+        healer.label_text['text'] = f'Erro: {healer.char_name}: {error}'
+        self.lock.acquire()
+        self.failed.add(healer)
+        self.tick_done.notify()
+        self.lock.release()
+
+    # the panel shows the most hurt character, the rate is the sum of all
+    def telemetry(self):
+        values = [healer.telemetry() for healer in self.healers]
+        values = [value for value in values if value is not None]
+        if not values:
+            return None
+        worst = dict(min(values, key=lambda value: value['life']))
+        worst['steps'] = sum(value['steps'] for value in values)
+        worst['cpu'] = self.cpu
+        return worst
 
-        self.healer = Healer(self.nameMenu.e_0.get(), self.healerSetup.e_3.get(), self.healerSetup.e_2.get(), self.healerSetup.e_1.get(),
-        self.healerSetup.e_4.get(), self.textMenu.l_5, self.healerSetup.e_3_1.get(), self.healerSetup.e_2_1.get(), self.healerSetup.e_1_1.get(), self.healerSetup.e_4_1.get(), self.suportSetup.e_hk_food, self.suportSetup.cb_food_var, self.suportSetup.e_hk_hast, self.suportSetup.cb_hast_var)
-        self.healer.start()
+    def start(self):
+        self.stopped = False
+        self.thread = Thread(target=self.run, name='multihealer')
+        self.thread.start()
 
     def stop(self):
-        self.textMenu.l_5['text'] = f"Macro Parado"
-        self.healer.stop()
-
-class Notebook(ttk.Notebook):
-    def __init__(self, parent):
-        super().__init__(parent)
-
-        self.tab1 = ttk.Frame(self)
-        self.tab2 = ttk.Frame(self)
-        self.add(self.tab1, text = 'Healer Setup')
-        self.add(self.tab2, text = 'Suport Setup')
-        self.pack(fill = 'both', expand = True, padx = 5, pady = 5)
-
-class Menu(ttk.Frame):
-    def __init__(self, parent):
-        super().__init__(parent)
-        self.pack(fill = 'both', expand = True, padx = 5, pady = 5)
-        self.create_widgets()
-
-    def create_widgets(self):
-        #Texto nome do char
-        self.l_0 = ttk.Label(self, text="Nome do Char:")
-        self.l_0.pack(side = 'left', fill = 'both', expand = True)
-        #Entrada do char
-        self.e_0 = ttk.Entry(self, width = 20)
-        self.e_0.insert(0,'Royal John')
-        self.e_0.pack(side = 'left', fill = 'x', expand = True)
-
-class HealerSetup(ttk.Frame):
-    def __init__(self, parent):
-        super().__init__(parent)
-        self.pack(fill = 'both', expand = True, padx = 5, pady = 0)
-        self.cura_maior_frame = ttk.Frame(self)
-        self.cura_maior_frame.pack(fill = 'both', expand = True, padx = 5, pady = 0)
-        self.cura_media_frame = ttk.Frame(self)
-        self.cura_media_frame.pack(fill = 'both', expand = True, padx = 5, pady = 0)
-        self.cura_menor_frame = ttk.Frame(self)
-        self.cura_menor_frame.pack(fill = 'both', expand = True, padx = 5, pady = 0)
-        self.cura_mana_frame = ttk.Frame(self)
-        self.cura_mana_frame.pack(fill = 'both', expand = True, padx = 5, pady = 0)
-        self.create_widgets()
-
-    def create_widgets(self):
-        #Texto cura maior ----------------------------------------------
-        self.l_1 = ttk.Label(self.cura_maior_frame, text="Curar Maior:")
-        self.l_1.pack(side = 'left', fill = 'x', expand = False)
-        #Entrada cura maior
-        self.e_1 = ttk.Entry(self.cura_maior_frame, width = 2)
-        self.e_1.pack(side = 'left', fill = 'x', expand = False)
-        self.e_1.insert(0,'20')
-        #Texto porcentagem
-        self.l_1_1 = ttk.Label(self.cura_maior_frame, text="%")
-        self.l_1_1.pack(side = 'left', fill = 'x', expand = False)
-        #Texto hotkey
-        self.l_1_2 = ttk.Label(self.cura_maior_frame, text="HotKey:")
-        self.l_1_2.pack(side = 'left', fill = 'x', expand = False)
-        #Entrada hotkey cura maior
-        self.e_1_1 = ttk.Entry(self.cura_maior_frame, width = 2)
-        self.e_1_1.pack(side = 'left', fill = 'x', expand = False)
-        self.e_1_1.insert(0,'f4')
-        #Texto cura media ----------------------------------------------
-        self.label_text = ttk.Label(self.cura_media_frame, text="Curar Media:")
-        self.label_text.pack(side = 'left', fill = 'x', expand = False)
-        #Entrada cura media
-        self.e_2 = ttk.Entry(self.cura_media_frame, width = 2)
-        self.e_2.pack(side = 'left', fill = 'x', expand = False)
-        self.e_2.insert(0,'50')
-        #Texto porcentagem media
-        self.label_text_1 = ttk.Label(self.cura_media_frame, text="%")
-        self.label_text_1.pack(side = 'left', fill = 'x', expand = False)
-        #Texto hotkey
-        self.label_text_2 = ttk.Label(self.cura_media_frame, text="HotKey:")
-        self.label_text_2.pack(side = 'left', fill = 'x', expand = False)
-        #Entrada hotkey cura maior
-        self.e_2_1 = ttk.Entry(self.cura_media_frame, width = 2)
-        self.e_2_1.pack(side = 'left', fill = 'x', expand = False)
-        self.e_2_1.insert(0,'f3')
-        #Texto cura menor ----------------------------------------------
-        self.l_3 = ttk.Label(self.cura_menor_frame,text="Curar Menor:")
-        self.l_3.pack(side = 'left', fill = 'x', expand = False)
-        #Entrada cura menor
-        self.e_3 = ttk.Entry(self.cura_menor_frame, width = 2)
-        self.e_3.pack(side = 'left', fill = 'x', expand = False)
-        self.e_3.insert(0,'90')
-        #Texto porcentagem
-        self.l_3_1 = ttk.Label(self.cura_menor_frame,text="%")
-        self.l_3_1.pack(side = 'left', fill = 'x', expand = False)
-        #Texto hotkey
-        self.l_3_2 = ttk.Label(self.cura_menor_frame, text="HotKey:")
-        self.l_3_2.pack(side = 'left', fill = 'x', expand = False)
-        #Entrada hotkey cura maior
-        self.e_3_1 = ttk.Entry(self.cura_menor_frame, width = 2)
-        self.e_3_1.pack(side = 'left', fill = 'x', expand = False)
-        self.e_3_1.insert(0,'f1')
-        #Texto cura mana ----------------------------------------------
-        self.l_4 = ttk.Label(self.cura_mana_frame,text="Curar Mana:")
-        self.l_4.pack(side = 'left', fill = 'x', expand = False)
-        #Entrada cura mana
-        self.e_4 = ttk.Entry(self.cura_mana_frame, width = 2)
-        self.e_4.pack(side = 'left', fill = 'x', expand = False)
-        self.e_4.insert(0,'20')
-        #Texto porcentagem
-        self.l_4_1 = ttk.Label(self.cura_mana_frame, text="%")
-        self.l_4_1.pack(side = 'left', fill = 'x', expand = False)
-        #Texto hotkey
-        self.l_4_2 = ttk.Label(self.cura_mana_frame, text="HotKey:")
-        self.l_4_2.pack(side = 'left', fill = 'x', expand = False)
-        #Entrada hotkey cura maior
-        self.e_4_1 = ttk.Entry(self.cura_mana_frame, width = 2)
-        self.e_4_1.pack(side = 'left', fill = 'x', expand = False)
-        self.e_4_1.insert(0,'f2')
-
-class ButtonMenu(ttk.Frame):
-    def __init__(self, parent, bt1_func, bt2_func):
-        super().__init__(parent)
-        self.pack(fill = 'both', expand = True, padx = 5, pady = 0)
-        self.create_widgets(bt1_func, bt2_func)
-
-    def create_widgets(self,bt1_func, bt2_func):
-        #Cria botão Iniciar
-        self.b_1 = ttk.Button(self, text="Iniciar Macro", command = bt1_func)
-        self.b_1.pack(side = 'left', fill = 'x', expand = True)
-        #Cria botão Parar
-        self.b_2 = ttk.Button(self, text="Parar Macro", command = bt2_func)
-        self.b_2.pack(side = 'left', fill = 'x', expand = True)
-
-class TextMenu(ttk.Frame):
-    def __init__(self, parent):
-        super().__init__(parent)
-        self.pack(fill = 'both', expand = True, padx = 5, pady = 5)
-        self.create_widgets()
-
-
-    def create_widgets(self):
-        self.l_5 = ttk.Label(self,text=" Bem vindo ao macro!")
-        self.l_5.pack(side = 'left', fill = 'x', expand = True)
-
-class SuportSetup(ttk.Frame):
-    def __init__(self, parent):
-        super().__init__(parent)
-        self.pack(fill = 'both', expand = True, padx = 5, pady = 5)
-        self.create_widgets()
-
-    def create_widgets(self):
-        #Texto Hast -------------------------------------------------
-        self.l_hast = ttk.Label(self, text="Hast:")
-        self.l_hast.pack(side = 'left', fill = 'x')
-        #Entrada hotkey hast
-        self.e_hk_hast = ttk.Entry(self, width = 2)
-        self.e_hk_hast.pack(side = 'left', fill = 'x', expand = False)
-        self.e_hk_hast.insert(0,'f6')
-        #check box
-        self.cb_hast_var = tk.IntVar()
-        self.cb_hast = tk.Checkbutton(self, variable = self.cb_hast_var, onvalue=1, offvalue=0)
-        self.cb_hast.pack(side = 'left')
-        #Texto Food -------------------------------------------------
-        self.l_food = ttk.Label(self, text="Food:")
-        self.l_food.pack(side = 'left', fill = 'x')
-        #Entrada hotkey food
-        self.e_hk_food = ttk.Entry(self, width = 2)
-        self.e_hk_food.pack(side = 'left', fill = 'x', expand = False)
-        self.e_hk_food.insert(0,'f5')
-        #check box
-        self.cb_food_var = tk.IntVar()
-        self.cb_food = tk.Checkbutton(self, variable = self.cb_food_var, onvalue=1, offvalue=0)
-        self.cb_food.pack(side = 'left')
-
-App()
+        self.lock.acquire()
+        self.stopped = True
+        self.tick_done.notify()
+        self.lock.release()
+
+    # wait for the scheduler, it stops the pool and the inputs on its way out
+    def join(self):
+        if self.thread is not None:
+            self.thread.join()
+        for healer in self.healers:
+            healer.join()
+
+    def run(self):
+
+        # calibrate every character, the ones without status bars are left out.
+        # the keys are posted to each window since only one can have the focus
+        # the pool ticks the detectors itself, so they stay in this process
+        for healer in self.healers:
+            healer.background = True
+            healer.isolated = False
+        started = [healer for healer in self.healers if healer.safe_setup()]
+        clients = list(started)
+        for healer in clients:
+            self.due[healer] = 0
+        executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='tick')
+        meter = CpuMeter()
+        self.lock.acquire()
+        while not self.stopped and clients:
+            if meter.update():
+                self.cpu = meter.process
+                metrics.gauge('cpu_process', self.cpu)
+            now = time.perf_counter()
+            # fairness: a character has at most one tick in the pool and the
+            # one waiting the longest goes first, so a slow client only delays itself
+            ready = sorted((self.due[healer], i) for i, healer in enumerate(clients)
+                           if healer not in self.busy and self.due[healer] <= now)
+            free = self.workers - len(self.busy)
+            for due, i in ready[:free]:
+                self.busy.add(clients[i])
+                future = executor.submit(self.tick, clients[i])
+                future.add_done_callback(lambda future, healer=clients[i]: self.check_tick(healer, future))
+            # sleep until a tick ends or the next character is due
+            timeout = None
+            if len(self.busy) < self.workers:
+                pending = [self.due[healer] for healer in clients if healer not in self.busy]
+                if pending:
+                    timeout = max(min(pending) - time.perf_counter(), 0)
+            self.tick_done.wait(timeout)
+            clients = [healer for healer in clients if healer not in self.failed]
+        self.lock.release()
+        executor.shutdown(wait=True)
+        for healer in self.healers:
+            if healer.input is not None:
+                healer.input.stop()
+        for healer in started:
+            healer.detector.wincap.release()
+
+class SessionRecorder:
+
+    # file magic and the start of every chunk
+    MAGIC = b'HLOG2\n'
+    CHUNK = struct.Struct('<4sII')
+    CHUNK_MAGIC = b'HLCK'
+    # type, time, payload size of a record
+    RECORD = struct.Struct('<BdI')
+    META, FRAME, STATE, KEY, REGION = 1, 2, 3, 4, 5
+    # keyframe flag, h, w, the grab rect of a frame and the window size
+    FRAME_HEADER = struct.Struct('<BHH4iHH')
+    # name, h, w and the rect of a region grabbed with the frame
+    REGION_HEADER = struct.Struct('<16sHH4i')
+    # frame seq, life %, mana % and the four states
+    STATE_RECORD = struct.Struct('<Idd4b')
+    # records are written in chunks of about this many bytes
+    CHUNK_SIZE = 1 << 16
+    # a whole frame every this many frames, the others are xor deltas
+    KEYFRAME_INTERVAL = 300
+
+    # constructor
+    def __init__(self, path, meta=None):
+        # detection and the input dispatcher write from their own threads
+        self.lock = Lock()
+        self.file = open(path, 'wb')
+        self.file.write(self.MAGIC)
+        self.chunk = bytearray()
+        self.count = 0
+        self.previous = None
+        self.frames = 0
+        if meta is not None:
+            self.meta(meta)
+
+    def add(self, kind, ts, payload):
+        self.lock.acquire()
+        self.chunk += self.RECORD.pack(kind, ts, len(payload))
+        self.chunk += payload
+        self.count += 1
+        if len(self.chunk) >= self.CHUNK_SIZE:
+            self.write_chunk()
+        self.lock.release()
+
+    # a chunk is only read back once it is complete, so a crash loses at
+    # most the last one
+    def write_chunk(self):
+        if not self.count:
+            return
+        self.file.write(self.CHUNK.pack(self.CHUNK_MAGIC, len(self.chunk), self.count))
+        self.file.write(self.chunk)
+        self.file.flush()
+        self.chunk = bytearray()
+        self.count = 0
+
+    # settings of the recorded session
+    def meta(self, values):
+        self.add(self.META, time.perf_counter(), json.dumps(values).encode())
+
+    # the region of interest, xor with the previous frame so the pixels that
+    # did not change are zeros and compress to almost nothing. The regions
+    # are small, they go whole and before the frame they belong to
+    def frame(self, frame, size):
+        for name, (region, rect) in frame.regions.items():
+            region = np.ascontiguousarray(region)
+            header = self.REGION_HEADER.pack(name.encode(), region.shape[0], region.shape[1], *rect)
+            self.add(self.REGION, frame.ts, header + zlib.compress(region.tobytes(), 1))
+        img = np.ascontiguousarray(frame.img)
+        h, w = img.shape[:2]
+        keyframe = (self.previous is None or self.previous.shape != img.shape
+                    or self.frames % self.KEYFRAME_INTERVAL == 0)
+        data = img if keyframe else np.bitwise_xor(img, self.previous)
+        payload = self.FRAME_HEADER.pack(keyframe, h, w, *frame.rect, *size) + zlib.compress(data.tobytes(), 1)
+        # the capture grabs the next frames into the same buffer
+        self.previous = img.copy() if np.shares_memory(img, frame.img) else img
+        self.frames += 1
+        self.add(self.FRAME, frame.ts, payload)
+
+    def state(self, detector):
+        self.add(self.STATE, detector.frame_ts, self.STATE_RECORD.pack(
+            detector.frame_seq, detector.life_pct, detector.mana_pct,
+            encode_state(detector.state_life), encode_state(detector.state_mana),
+            encode_state(detector.state_food), encode_state(detector.state_hast)))
+
+    def key(self, key, ts):
+        self.add(self.KEY, ts, key.encode())
+
+    def close(self):
+        self.lock.acquire()
+        self.write_chunk()
+        self.file.close()
+        self.lock.release()
+
+class SessionLog:
+
+    # constructor, the log is memory mapped and read in place
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(SessionRecorder.MAGIC)] != SessionRecorder.MAGIC:
+            raise Exception('Not a session log: {}'.format(path))
+
+    # (kind, time, value) of every record: the settings dict, a (img, rect,
+    # window size) frame, a (frame seq, life %, mana %, states) tuple, a key
+    # or a (name, img, rect) region
+    def records(self):
+        offset = len(SessionRecorder.MAGIC)
+        previous = None
+        chunk = SessionRecorder.CHUNK
+        record = SessionRecorder.RECORD
+        while offset + chunk.size <= len(self.data):
+            magic, size, count = chunk.unpack_from(self.data, offset)
+            offset += chunk.size
+            # the last chunk of a crashed session may be cut
+            if magic != SessionRecorder.CHUNK_MAGIC or offset + size > len(self.data):
+                return
+            end = offset + size
+            while offset < end:
+                kind, ts, length = record.unpack_from(self.data, offset)
+                offset += record.size
+                payload = memoryview(self.data)[offset:offset + length]
+                offset += length
+                if kind == SessionRecorder.META:
+                    yield kind, ts, json.loads(bytes(payload))
+                elif kind == SessionRecorder.FRAME:
+                    header = SessionRecorder.FRAME_HEADER
+                    keyframe, h, w, x, y, rw, rh, window_w, window_h = header.unpack_from(payload)
+                    img = np.frombuffer(zlib.decompress(payload[header.size:]), dtype='uint8').reshape(h, w, 3)
+                    if not keyframe:
+                        img = np.bitwise_xor(img, previous)
+                    previous = img
+                    yield kind, ts, (img, (x, y, rw, rh), (window_w, window_h))
+                elif kind == SessionRecorder.REGION:
+                    header = SessionRecorder.REGION_HEADER
+                    name, h, w, x, y, rw, rh = header.unpack_from(payload)
+                    img = np.frombuffer(zlib.decompress(payload[header.size:]), dtype='uint8').reshape(h, w, 3)
+                    yield kind, ts, (name.rstrip(b'\0').decode(), img, (x, y, rw, rh))
+                elif kind == SessionRecorder.STATE:
+                    values = SessionRecorder.STATE_RECORD.unpack(payload)
+                    yield kind, ts, values[:3] + tuple(decode_state(state) for state in values[3:])
+                elif kind == SessionRecorder.KEY:
+                    yield kind, ts, bytes(payload).decode()
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+class VirtualClock:
+
+    # time of the replay, moved to each recorded frame
+    now = 0
+
+    def __call__(self):
+        return self.now
+
+# put the recorded frame and its regions at their place of the window
+def paint(window, img, rect, regions):
+    x, y, w, h = rect
+    window[y:y+h, x:x+w] = img
+    for name, region, (x, y, w, h) in regions:
+        window[y:y+h, x:x+w] = region
+
+# run a recorded session through a Healer as fast as it goes: no threads, the
+# cooldowns on the recorded clock and the keys kept by a RecordingInput.
+# settings replace the recorded ones, to try other thresholds or hotkeys
+def replay(path, settings=None):
+    log = SessionLog(path)
+    clock = VirtualClock()
+    backend = RecordingInput(clock)
+    healer = None
+    source = None
+    # regions of the next frame
+    regions = []
+    recorded_keys = []
+    mismatches = 0
+    frames = 0
+    state_seq = 0
+    t_wakeup = None
+    t_start = time.perf_counter()
+    first_ts = last_ts = None
+    for kind, ts, value in log.records():
+        if kind == SessionRecorder.META:
+            meta = dict(DEFAULTS)
+            meta.update(value)
+            meta.update(settings or {})
+            # one character per log, detected in this process
+            meta['isolated'] = False
+            healer = create_healers(meta, StatusChannel())[0]
+            healer.clock = clock
+            healer.input_threaded = False
+            healer.input_backend = backend
+        elif kind == SessionRecorder.FRAME:
+            if healer is None:
+                raise Exception('The log has no settings record')
+            img, rect, (w, h) = value
+            clock.now = ts
+            first_ts = ts if first_ts is None else first_ts
+            last_ts = ts
+            # the recorded pixels go back at their window position, the
+            # party and cooldown detectors read window coordinates. The
+            # detection calibrates again when the window size changes
+            calibrate = source is None or source.img.shape[:2] != (h, w)
+            if calibrate:
+                source = ArraySource(np.zeros((h, w, 3), dtype='uint8'))
+                source.clock = clock
+                healer.capture = source
+            paint(source.img, img, rect, regions)
+            regions = []
+            if calibrate:
+                healer.setup()
+                state_seq = 0
+            source.grab()
+            healer.detector.step(source.frames.latest())
+            frames += 1
+            # wake the healer like Healer.run does: new states or a cooldown over
+            if healer.detector.state_seq != state_seq or (t_wakeup is not None and ts >= t_wakeup):
+                state_seq = healer.detector.state_seq
+                timeout = healer.step()
+                t_wakeup = None if timeout is None else ts + timeout
+        elif kind == SessionRecorder.STATE:
+            # the state recorded right after the frame just replayed
+            detector = healer.detector
+            replayed = (detector.state_life, detector.state_mana, detector.state_food, detector.state_hast)
+            if frames and value[3:] != replayed:
+                mismatches += 1
+        elif kind == SessionRecorder.KEY:
+            recorded_keys.append((ts, value))
+        elif kind == SessionRecorder.REGION:
+            regions.append(value)
+    log.close()
+    elapsed = time.perf_counter() - t_start
+    session = (last_ts - first_ts) if frames else 0
+    return {'frames': frames, 'state_mismatches': mismatches,
+            'recorded_keys': recorded_keys, 'replayed_keys': backend.presses,
+            'seconds': elapsed, 'speedup': session / elapsed if elapsed else 0}
+
+startup.mark('module')
+
+# settings of the setup screen, a config file and the flags replace them
+DEFAULTS = {'chars': 'Royal John', 'low': 90, 'medium': 50, 'strong': 20, 'mana': 20,
+            'hk_low': 'f1', 'hk_medium': 'f3', 'hk_strong': 'f4', 'hk_mana': 'f2', 'hk_food': 'f5', 'hk_hast': 'f6',
+            'food': False, 'hast': False, 'predictive': False, 'isolated': False, 'min_fps': None, 'max_fps': 60,
+            'party': None, 'cooldowns': None, 'metrics_file': METRICS_FILE, 'metrics_port': METRICS_PORT}
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Healer. Without --headless or --config the setup window opens')
+    parser.add_argument('--headless', action='store_true', help='run without the window')
+    parser.add_argument('--config', help='json file with the settings, the flags take precedence')
+    parser.add_argument('--chars', help='character names separated by commas')
+    for name in ('low', 'medium', 'strong', 'mana'):
+        parser.add_argument(f'--{name}', help=f'%% of the {name} heal, or points like 1200hp')
+    for name in ('low', 'medium', 'strong', 'mana', 'food', 'hast'):
+        parser.add_argument(f'--hk-{name}', dest=f'hk_{name}', help=f'hotkey of the {name} heal')
+    for name in ('food', 'hast', 'predictive', 'isolated'):
+        parser.add_argument(f'--{name}', action='store_true', default=None)
+    parser.add_argument('--min-fps', type=int, help='adaptive capture rate: floor while the bars are full and still')
+    parser.add_argument('--max-fps', type=int, help='capture rate ceiling')
+    parser.add_argument('--metrics-file', help='json or csv file the metrics are written to')
+    parser.add_argument('--metrics-port', type=int, help='port of the prometheus endpoint')
+    parser.add_argument('--report', action='store_true', help='print the start-up report after the first frame')
+    parser.add_argument('--exit-after-first-frame', action='store_true', help='stop after the first analysed frame')
+    parser.add_argument('--profile', type=float, help='profile the threads for this many seconds after the first frame')
+    parser.add_argument('--profile-hotkey', default=PROFILE_HOTKEY, help='hotkey that starts and stops the profiler')
+    parser.add_argument('--record', help='write the frames, states and keys of the session to this log')
+    parser.add_argument('--replay', help='run a recorded log through the detection and the healer and exit')
+    return parser.parse_args(argv)
+
+def load_settings(args):
+    settings = dict(DEFAULTS)
+    if args.config is not None:
+        with open(args.config) as f:
+            settings.update(json.load(f))
+    for key in DEFAULTS:
+        value = getattr(args, key, None)
+        if value is not None:
+            settings[key] = value
+    return settings
+
+def create_healers(settings, label_text):
+    names = settings['chars']
+    if isinstance(names, str):
+        names = names.split(',')
+    healers = [Healer(name.strip(), settings['low'], settings['medium'], settings['strong'], settings['mana'], label_text,
+                   settings['hk_low'], settings['hk_medium'], settings['hk_strong'], settings['hk_mana'],
+                   settings['hk_food'], settings['food'], settings['hk_hast'], settings['hast'],
+                   settings['predictive'], settings['isolated'], settings['party'], settings['cooldowns'])
+               for name in names if name.strip()]
+    for healer in healers:
+        healer.min_fps = settings['min_fps']
+        healer.max_fps = settings['max_fps']
+    return healers
+
+# drive the healers from the console, the status lines go to stdout
+def run_headless(settings, report=False, exit_after_first_frame=False, record=None, profile=None, profile_hotkey=PROFILE_HOTKEY):
+    status = StatusChannel()
+    profiler = Profiler(profile or 10, label_text=status)
+    register_profile_hotkey(profiler, profile_hotkey)
+    healers = create_healers(settings, status)
+    # one log per character, name.log becomes name-Char.log with several
+    recorders = []
+    if record is not None:
+        for healer in healers:
+            path = record
+            if len(healers) > 1:
+                root, ext = os.path.splitext(record)
+                path = f'{root}-{healer.char_name}{ext}'
+            healer.recorder = SessionRecorder(path, dict(settings, chars=healer.char_name))
+            recorders.append(healer.recorder)
+    healer = healers[0] if len(healers) == 1 else MultiHealer(healers)
+    exporter = MetricsExporter(metrics, settings['metrics_file'], settings['metrics_port'])
+    if settings['metrics_file'] is not None or settings['metrics_port'] is not None:
+        exporter.start()
+    healer.start()
+    reported = False
+    code = 0
+    try:
+        while True:
+            # the healer thread only ends on its own when it could not start
+            # (no window, no status bars) or crashed
+            alive = healer.thread.is_alive()
+            changes = status.changes()
+            if 'text' in changes:
+                print(changes['text'], flush=True)
+            if not alive:
+                code = 1
+                break
+            if 'first_frame' in startup.marks and not reported:
+                reported = True
+                if profile is not None:
+                    profiler.start()
+                if report:
+                    print('\n'.join(startup.lines()), flush=True)
+                if exit_after_first_frame:
+                    break
+            time.sleep(0.1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        healer.stop()
+        exporter.stop()
+        profiler.stop()
+        # a late frame or key must not reach a closed log
+        healer.join()
+        for recorder in recorders:
+            recorder.close()
+        if report:
+            print(f'cpu time: {time.process_time():.2f}s in {time.perf_counter() - T_START:.2f}s', flush=True)
+    return code
+
+def print_replay(result):
+    print(f"{result['frames']} frames in {result['seconds']:.2f}s, {result['speedup']:.0f}x real time")
+    print(f"{result['state_mismatches']} states differ from the recorded ones")
+    recorded = [key for ts, key in result['recorded_keys']]
+    replayed = [key for ts, key in result['replayed_keys']]
+    print(f'{len(recorded)} keys recorded, {len(replayed)} keys replayed')
+    for i, (a, b) in enumerate(zip(recorded, replayed)):
+        if a != b:
+            print(f'first different key: #{i} recorded {a} replayed {b}')
+            break
+
+def main(argv=None):
+    # the detection process of a frozen build starts here too
+    multiprocessing.freeze_support()
+    args = parse_args(argv)
+    if args.replay is not None:
+        # only the flags given replace the recorded settings
+        overrides = {key: getattr(args, key, None) for key in DEFAULTS if getattr(args, key, None) is not None}
+        # the calibration of the recorded regions does not belong in the cache of the real windows
+        Detection.CALIBRATION_FILE = os.path.join(tempfile.gettempdir(), 'healer_replay_calibration.json')
+        print_replay(replay(args.replay, overrides))
+        return
+    settings = load_settings(args)
+    if args.headless or args.config is not None:
+        return run_headless(settings, args.report, args.exit_after_first_frame, args.record, args.profile, args.profile_hotkey)
+    # the window imports this module as healer, let it find the one running
+    sys.modules.setdefault('healer', sys.modules[__name__])
+    import gui
+    gui.App()
+
+if __name__ == '__main__':
+    sys.exit(main())
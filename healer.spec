@@ -9,7 +9,7 @@ a = Analysis(
     pathex=[],
     binaries=[],
     datas=[],
-    hiddenimports=[],
+    hiddenimports=['gui', 'cv2', 'numpy', 'pyautogui', 'keyboard', 'http.server', 'win32gui', 'win32ui', 'win32con'],
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
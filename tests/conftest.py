@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import healer
+
+
+# the images are loaded from the working directory like in the app, the
+# calibration goes to a temporary file
+@pytest.fixture(autouse=True)
+def repo_dir(monkeypatch, tmp_path):
+    monkeypatch.chdir(ROOT)
+    monkeypatch.setattr(healer.Detection, 'CALIBRATION_FILE', str(tmp_path / 'calibration.json'))
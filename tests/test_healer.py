@@ -0,0 +1,542 @@
+import json
+import time
+import itertools
+import multiprocessing
+from threading import Thread
+
+import numpy as np
+import pytest
+
+import healer as healer_module
+
+from benchmark import party_frame, synthetic_atlas, synthetic_frame
+from healer import (ArraySource, BotState, ConditionClassifier, CooldownDetector, Detection, Frame, GlyphDecoder, Healer,
+                    InputDispatcher, MultiHealer, PartyDetector, RateController, RecordingInput, RuleTable, SessionLog, SessionRecorder,
+                    SharedSnapshot, StatusChannel, VirtualClock, X11Capture, load_settings, parse_args, parse_threshold, replay,
+                    run_headless)
+
+
+def detection(frame):
+    source = ArraySource(frame)
+    return source, Detection('test', StatusChannel(), 20, 50, 90, 20, capture=source)
+
+
+def step(source, detector, frame):
+    source.set_frame(frame)
+    source.grab()
+    detector.step(source.frames.latest())
+
+
+def test_conditions_full_strip():
+    frame = synthetic_frame(1280, 720, 100, 100)
+    source, detector = detection(frame)
+    step(source, detector, frame)
+    assert detector.classifier.aligned()
+    assert detector.conditions == {'hast', 'food'}
+
+
+def test_conditions_empty_strip():
+    source, detector = detection(synthetic_frame(1280, 720, 100, 100))
+    step(source, detector, synthetic_frame(1280, 720, 100, 100))
+    step(source, detector, synthetic_frame(1280, 720, 100, 100, icons=()))
+    assert detector.conditions == frozenset()
+    assert detector.state_hast is not None
+
+
+def test_classifier_flat_slots():
+    classifier = ConditionClassifier(Detection.CONDITIONS)
+    classifier.align((2, 2))
+    strip = np.full((14, 108, 3), 30, dtype='uint8')
+    assert classifier.classify(strip) == frozenset()
+
+
+def test_classifier_realigns_on_unknown_slots():
+    classifier = ConditionClassifier(Detection.CONDITIONS)
+    # a grid off by half a slot sees only pieces of icons
+    classifier.align((7, 2))
+    frame = synthetic_frame(1280, 720, 100, 100)
+    source, detector = detection(frame)
+    step(source, detector, frame)
+    x, y, w, h = detector.strip_rect()
+    strip_img = detector.screenshot[y:y+h, x:x+w]
+    for i in range(classifier.max_misses):
+        assert classifier.classify(strip_img) == frozenset()
+    assert not classifier.aligned()
+
+
+def test_party_region_outside_roi():
+    frame = synthetic_frame(1280, 720, 100, 100)
+    frame[300:500, 100:300] = party_frame(200, 200, 40, 30, [90, 20, 55])
+    source = ArraySource(frame)
+    detector = Detection('test', StatusChannel(), 20, 50, 90, 20, capture=source, party=PartyDetector(140, 330, 4))
+    step(source, detector, frame)
+    # the panel is grabbed on its own, the region of interest stays on the bars
+    assert source.roi[0] > 300
+    assert [row for row, pct in detector.party.most_hurt()] == [1, 2, 0]
+    assert detector.state_party == BotState.PARTY_LOW
+    assert detector.party_target == 1
+
+
+def test_cooldown_icons_outside_roi():
+    frame = synthetic_frame(1280, 720, 100, 100)
+    icon = np.random.default_rng(3).integers(100, 250, (20, 20, 3), dtype='uint8')
+    slots = {'skill': [600, 650], 'hast': [622, 650]}
+    for x, y in slots.values():
+        frame[y:y + 20, x:x + 20] = icon
+    source = ArraySource(frame)
+    cooldowns = CooldownDetector(slots, Healer.COOLDOWNS)
+    detector = Detection('test', StatusChannel(), 20, 50, 90, 20, capture=source, cooldowns=cooldowns)
+    step(source, detector, frame)
+    assert source.roi[0] > 700
+    assert cooldowns.ready() == {'skill', 'hast'}
+    # the overlay over half of the skill icon
+    dimmed = frame.copy()
+    dimmed[650:670, 600:610] //= 3
+    step(source, detector, dimmed)
+    assert cooldowns.ready() == {'hast'}
+    assert detector.cooldown_ready['skill'] - source.frames.latest().ts == pytest.approx(0.5)
+
+
+class FakeDetector:
+
+    state_life = BotState.life_RED
+    state_mana = BotState.MANA_FULL
+    state_food = BotState.FOOD_FULL
+    state_hast = BotState.HASTED
+    state_party = None
+    frame_ts = 0
+    cooldown_ready = {}
+    party_target = None
+    lead = 0
+
+
+def healer(cooldowns=None, party=None):
+    clock = VirtualClock()
+    h = Healer('test', 90, 50, 20, 20, StatusChannel(), 'f1', 'f3', 'f4', 'f2', 'f5', False, 'f6', False,
+               party=party, cooldowns=cooldowns)
+    h.clock = clock
+    h.detector = FakeDetector()
+    h.input = InputDispatcher(RecordingInput(clock), threaded=False, clock=clock)
+    return h, clock
+
+
+def run(h, clock, frames):
+    # frames is a list of (time, {group: ready_at read on screen})
+    for ts, ready in frames:
+        clock.now = ts
+        h.detector.frame_ts = ts
+        h.detector.cooldown_ready = ready
+        h.step()
+    return h.input.backend.presses
+
+
+def test_fixed_cooldown_timers():
+    h, clock = healer()
+    presses = run(h, clock, [(0, {}), (0.5, {}), (0.96, {}), (1.0, {})])
+    assert presses == [(0, 'f4'), (1.0, 'f4')]
+
+
+def test_cooldown_read_ready_early():
+    h, clock = healer({'slots': {}})
+    # the overlay shows up, then the group is shown ready before the second
+    presses = run(h, clock, [(0, {}), (0.5, {'potion': 0.9}), (0.96, {'potion': 0.96})])
+    assert presses == [(0, 'f4'), (0.96, 'f4')]
+
+
+def test_cooldown_ready_ignored_before_overlay():
+    h, clock = healer({'slots': {}})
+    # the client did not show the cooldown of the press yet
+    presses = run(h, clock, [(0, {}), (0.1, {'potion': 0.1}), (1.0, {'potion': 1.0})])
+    assert presses == [(0, 'f4'), (1.0, 'f4')]
+
+
+def test_cooldown_busy_on_screen_delays():
+    h, clock = healer({'slots': {}})
+    presses = run(h, clock, [(0, {}), (0.5, {'potion': 1.4}), (1.0, {'potion': 1.4}), (1.4, {'potion': 1.4})])
+    assert presses == [(0, 'f4'), (1.4, 'f4')]
+
+
+def test_dropped_key_does_not_restart_cooldown():
+    h, clock = healer()
+    h.input.send('f4')
+    assert run(h, clock, [(0, {})]) == [(0, 'f4')]
+    assert h.scheduler.ready('potion', 0)
+
+
+def old_decision(life, mana, hast):
+    # the if-chain the rule table replaced, with every cooldown ready:
+    # the potion pressed first holds the others back for a second
+    keys = []
+    if life == BotState.life_RED:
+        keys.append('f4')
+    elif life == BotState.life_YELLOW:
+        keys.append('f3')
+    elif mana == BotState.MANA_LOW:
+        keys.append('f2')
+    if life == BotState.life_GREEN:
+        keys.append('f1')
+    if hast == BotState.NO_HAST:
+        keys.append('f6')
+    return sorted(keys)
+
+
+def test_rule_table_matches_old_decisions():
+    h, clock = healer()
+    for state in itertools.product(*RuleTable.DOMAINS):
+        actions, active = h.rules.decide(state)
+        life, mana, food, hast, party = state
+        assert sorted(rule.key for rule in actions) == old_decision(life, mana, hast), state
+        assert ('life_full' in active) == (life == BotState.life_FULL)
+        assert ('mana_full' in active) == (mana == BotState.MANA_FULL)
+
+
+def test_session_log_round_trip(tmp_path, monkeypatch):
+    # a keyframe every other frame and small chunks, so the log has deltas
+    # and records split over several chunks
+    monkeypatch.setattr(SessionRecorder, 'KEYFRAME_INTERVAL', 2)
+    monkeypatch.setattr(SessionRecorder, 'CHUNK_SIZE', 256)
+    rng = np.random.default_rng(5)
+    images = [rng.integers(0, 256, (30, 40, 3), dtype='uint8') for i in range(3)]
+    path = tmp_path / 'session.hlog'
+    recorder = SessionRecorder(path, {'low': '90', 'hotkeys': ['f1']})
+    for i, img in enumerate(images):
+        frame = Frame(None)
+        frame.img = img
+        frame.rect = (10, 20, 40, 30)
+        frame.ts = i * 0.1
+        frame.regions = {'party': (img[:5, :8], (100, 200, 8, 5))}
+        recorder.frame(frame, (640, 480))
+        detector = FakeDetector()
+        detector.frame_ts = i * 0.1
+        detector.frame_seq = i
+        detector.life_pct = 30.5 + i
+        detector.mana_pct = 100
+        detector.state_hast = None
+        recorder.state(detector)
+    recorder.key('f4', 0.25)
+    recorder.close()
+
+    log = SessionLog(path)
+    records = list(log.records())
+    log.close()
+    assert [kind for kind, ts, value in records] == ([SessionRecorder.META]
+                                                     + [SessionRecorder.REGION, SessionRecorder.FRAME, SessionRecorder.STATE] * 3
+                                                     + [SessionRecorder.KEY])
+    assert records[0][2] == {'low': '90', 'hotkeys': ['f1']}
+    frames = [value for kind, ts, value in records if kind == SessionRecorder.FRAME]
+    regions = [value for kind, ts, value in records if kind == SessionRecorder.REGION]
+    for (img, rect, size), (name, region, region_rect), expected in zip(frames, regions, images):
+        assert np.array_equal(img, expected)
+        assert rect == (10, 20, 40, 30)
+        assert size == (640, 480)
+        assert name == 'party'
+        assert np.array_equal(region, expected[:5, :8])
+        assert region_rect == (100, 200, 8, 5)
+    states = [(ts, value) for kind, ts, value in records if kind == SessionRecorder.STATE]
+    assert states[2] == (pytest.approx(0.2), (2, 32.5, 100.0, BotState.life_RED, BotState.MANA_FULL, BotState.FOOD_FULL, None))
+    assert records[-1][1:] == (0.25, 'f4')
+
+
+def test_settings_without_flags(tmp_path):
+    # party has no flag, it only comes from the config
+    config = tmp_path / 'config.json'
+    config.write_text(json.dumps({'party': {'x': 10, 'y': 20, 'hotkey': 'f9'}}))
+    settings = load_settings(parse_args(['--headless', '--config', str(config), '--low', '80']))
+    assert settings['party'] == {'x': 10, 'y': 20, 'hotkey': 'f9'}
+    assert settings['low'] == '80'
+    assert load_settings(parse_args([]))['party'] is None
+
+
+def test_party_heal_on_most_hurt_member():
+    h, clock = healer(party={'x': 0, 'y': 0, 'hotkeys': ['f7', 'f8', 'f9']})
+    h.detector.state_life = BotState.life_FULL
+    h.detector.state_party = BotState.PARTY_LOW
+    h.detector.party_target = 2
+    assert run(h, clock, [(0, {})]) == [(0, 'f9')]
+
+
+def test_shared_snapshot_reads_whole_writes():
+    writer = SharedSnapshot()
+    reader = SharedSnapshot(writer.name)
+    done = []
+
+    def write():
+        for i in range(20000):
+            writer.write({'frame_seq': i, 'steps': i, 'life_pct': i})
+        done.append(True)
+
+    t = Thread(target=write)
+    t.start()
+    # a read never mixes two writes
+    while not done:
+        seq, values = reader.read()
+        assert seq % 2 == 0
+        assert values['frame_seq'] == values['steps'] == values['life_pct']
+    t.join()
+    assert reader.read()[1]['steps'] == 19999
+    reader.close()
+    writer.close()
+
+
+def test_headless_exits_without_status_bars(monkeypatch):
+    # a new process, no frame analysed yet
+    monkeypatch.setattr(healer_module.startup, 'marks', {})
+    monkeypatch.setattr(healer_module, 'create_capture', lambda name=None: ArraySource(np.zeros((720, 1280, 3), 'uint8')))
+    settings = load_settings(parse_args(['--headless']))
+    assert run_headless(settings, exit_after_first_frame=True) == 1
+
+
+def test_time_to_strong_heal():
+    frame = synthetic_frame(1280, 720, 100, 100)
+    source, detector = detection(frame)
+    for i, pct in enumerate((100, 90, 80, 70)):
+        detector.life_trend.add(i * 0.1, pct)
+    # 100 % per second down from 70 %, the strong heal is at 20 %
+    assert detector.life_trend.time_to(20) == pytest.approx(0.5)
+    source.clock = lambda: 0.4
+    step(source, detector, synthetic_frame(1280, 720, 60, 100))
+    assert detector.life_eta == pytest.approx(0.4, abs=0.05)
+
+
+
+def test_lead_from_shared_value():
+    frame = synthetic_frame(1280, 720, 100, 100)
+    source, detector = detection(frame)
+    for i, pct in enumerate((100, 90, 80, 70)):
+        detector.life_trend.add(i * 0.1, pct)
+    # the lead a predictive Healer writes in the other process
+    detector.shared_lead = multiprocessing.Value('d', 0, lock=False)
+    source.clock = lambda: 0.4
+    step(source, detector, synthetic_frame(1280, 720, 60, 100))
+    assert detector.state_life == BotState.life_GREEN
+    detector.shared_lead.value = 0.5
+    source.clock = lambda: 0.5
+    step(source, detector, synthetic_frame(1280, 720, 50, 100))
+    # 50 % falling 100 % per second is below the strong heal half a second ahead
+    assert detector.lead == 0.5
+    assert detector.state_life == BotState.life_RED
+
+def test_skipped_regions_gauges():
+    frame = synthetic_frame(1280, 720, 100, 100)
+    source, detector = detection(frame)
+    for i in range(Detection.FINGERPRINT_GAUGES):
+        step(source, detector, frame)
+    # only the first frame reads the regions
+    assert healer_module.metrics.gauges['skipped_life'] == pytest.approx(1 - 1 / Detection.FINGERPRINT_GAUGES)
+    assert healer_module.metrics.gauges['skipped_strip'] == pytest.approx(1 - 1 / Detection.FINGERPRINT_GAUGES)
+
+
+def test_parse_threshold():
+    assert parse_threshold(20) == (20, False)
+    assert parse_threshold(' 1200HP ') == (1200, True)
+    assert parse_threshold('300mp') == (300, True)
+
+
+def test_mixed_thresholds_most_severe_first():
+    frame = synthetic_frame(1280, 720, 100, 100)
+    source = ArraySource(frame)
+    detector = Detection('test', StatusChannel(), 20, 50, '3000hp', 20, capture=source)
+    tiers = detector.life_tiers
+    # near death is a strong heal even with the weak one in points
+    assert detector.tier(5, 150, tiers, BotState.life_FULL) == BotState.life_RED
+    assert detector.tier(40, 2000, tiers, BotState.life_FULL) == BotState.life_YELLOW
+    assert detector.tier(80, 2000, tiers, BotState.life_FULL) == BotState.life_GREEN
+    assert detector.tier(80, 4000, tiers, BotState.life_FULL) == BotState.life_FULL
+    # no number read, the tier in points is skipped
+    assert detector.tier(80, None, tiers, BotState.life_FULL) == BotState.life_FULL
+
+
+def test_glyph_decoder(tmp_path):
+    path = str(tmp_path / 'digits.png')
+    atlas = synthetic_atlas(path)
+    decoder = GlyphDecoder(path)
+
+    def field(*digits):
+        img = np.zeros((9, 30, 3), dtype='uint8')
+        for i, digit in enumerate(digits):
+            if digit is not None:
+                img[:, i * 6:(i + 1) * 6] = atlas[:, digit * 6:(digit + 1) * 6]
+        return img
+
+    assert decoder.decode(field(1, 2, 3, 4, 5), 0, 0) == 12345
+    # short numbers are right aligned after blank cells
+    assert decoder.decode(field(None, None, 9, 0, 7), 0, 0) == 907
+    assert decoder.decode(field(None, None, None, None, None), 0, 0) is None
+    # a blank inside the number is not a number
+    assert decoder.decode(field(None, 4, None, 0, 7), 0, 0) is None
+    unknown = field(None, None, 1, 2, 3)
+    unknown[:, 12:18] = 255
+    assert decoder.decode(unknown, 0, 0) is None
+    # the field must fit in the image
+    assert decoder.decode(field(1, 2, 3, 4, 5), 1, 0) is None
+
+
+def test_multi_healer_follows_resized_window():
+    frame = synthetic_frame(1280, 720, 100, 100)
+    source, detector = detection(frame)
+    h, clock = healer()
+    h.detector = detector
+    multi = MultiHealer([h])
+    source.geometry_interval = 0
+    source.set_frame(synthetic_frame(1600, 900, 100, 100))
+    multi.tick(h)
+    assert (source.w, source.h) == (1600, 900)
+    assert source.spare.buf.size >= 1600 * 900 * 4
+
+
+def test_grab_off_the_root_window_is_skipped():
+    capture = X11Capture.__new__(X11Capture)
+    capture.root_w, capture.root_h = 1920, 1080
+    capture.offset_x, capture.offset_y = 1800, 100
+    # half of the client is past the right edge of the screen
+    assert capture.grab_into(Frame(None), (0, 0, 200, 100)) is False
+    frame = synthetic_frame(1280, 720, 100, 100)
+    source = ArraySource(frame)
+    source.grab()
+    seq = source.frames.latest().seq
+    source.grab_into = lambda frame, rect: False
+    source.grab()
+    assert source.frames.latest().seq == seq
+
+
+def test_replay_party_session(tmp_path):
+    party = {'x': 140, 'y': 330, 'rows': 4, 'hotkey': 'f9'}
+    frame = synthetic_frame(1280, 720, 100, 100)
+    frame[300:500, 100:300] = party_frame(200, 200, 40, 30, [90, 20, 55])
+    source = ArraySource(frame)
+    detector = Detection('test', StatusChannel(), 20, 50, 90, 20, capture=source, party=PartyDetector(140, 330, 4))
+    path = tmp_path / 'party.hlog'
+    detector.recorder = SessionRecorder(path, dict(load_settings(parse_args([])), chars='test', party=party))
+    for i in range(3):
+        source.clock = lambda: i * 0.5
+        step(source, detector, frame)
+    detector.recorder.close()
+    result = replay(path)
+    # the panel is outside the region of interest, it comes back from its region
+    assert result['state_mismatches'] == 0
+    assert [key for ts, key in result['replayed_keys']] == ['f9', 'f9']
+
+
+class BrokenHealer(Healer):
+
+    ticks = 0
+
+    def step(self):
+        self.ticks += 1
+        raise Exception('quebrado')
+
+
+def client(name, life, cls=Healer):
+    h = cls(name, 90, 50, 20, 20, StatusChannel(), 'f1', 'f3', 'f4', 'f2', 'f5', False, 'f6', False)
+    h.capture = ArraySource(synthetic_frame(1280, 720, life, 100))
+    h.input_backend = RecordingInput()
+    h.input_threaded = False
+    return h
+
+
+def test_multi_healer_fair_ticks_and_failed_client():
+    hurt, calm, broken = client('a', 15), client('b', 100), client('c', 100, BrokenHealer)
+    multi = MultiHealer([hurt, calm, broken], workers=2, max_fps=50)
+    multi.start()
+    deadline = time.perf_counter() + 5
+    # the clients calibrate first, then tick until the calm one saw 20 frames
+    while time.perf_counter() < deadline and (calm.detector is None or calm.detector.steps < 20):
+        time.sleep(0.01)
+    multi.stop()
+    multi.thread.join()
+    # a raising client is dropped after its first tick and its error shown
+    assert broken in multi.failed
+    assert broken.ticks == 1
+    assert broken.label_text['text'] == 'Erro: c: quebrado'
+    # the two others shared the pool evenly
+    assert hurt.detector.steps >= 10 and calm.detector.steps >= 10
+    assert abs(hurt.detector.steps - calm.detector.steps) <= 3
+    assert {key for ts, key in hurt.input.backend.presses} == {'f4'}
+    assert calm.input.backend.presses == []
+
+
+def test_session_log_frames_grabbed_in_place(tmp_path):
+    # the frame image is a contiguous buffer the capture overwrites
+    buf = np.zeros((10, 12, 3), dtype='uint8')
+    frame = Frame(None)
+    frame.img = buf
+    frame.rect = (0, 0, 12, 10)
+    path = tmp_path / 'session.hlog'
+    recorder = SessionRecorder(path)
+    images = []
+    for i in range(3):
+        buf[:] = i * 40 + 1
+        buf[i, i] = 255
+        images.append(buf.copy())
+        frame.ts = i
+        recorder.frame(frame, (12, 10))
+    recorder.close()
+    log = SessionLog(path)
+    frames = [value[0] for kind, ts, value in log.records() if kind == SessionRecorder.FRAME]
+    log.close()
+    assert all(np.array_equal(img, expected) for img, expected in zip(frames, images))
+
+
+def test_healer_join_before_closing_the_log(tmp_path):
+    h = client('a', 15)
+    h.input_threaded = True
+    h.recorder = SessionRecorder(tmp_path / 'session.hlog')
+    h.start()
+    deadline = time.perf_counter() + 5
+    while time.perf_counter() < deadline and (h.detector is None or h.detector.steps < 3):
+        time.sleep(0.01)
+    h.stop()
+    h.join()
+    assert not h.thread.is_alive()
+    assert not h.detector.thread.is_alive()
+    assert not h.input.thread.is_alive()
+    h.recorder.close()
+
+
+def test_rate_controller_floor_and_ceiling():
+    full = synthetic_frame(1280, 720, 100, 100)
+    source, detector = detection(full)
+    detector.rate = RateController(5, 60, settle=3)
+
+    def at(ts, frame):
+        source.clock = lambda: ts
+        step(source, detector, frame)
+        return source.max_fps
+
+    # full and still bars for settle seconds go down to the floor
+    assert [at(ts, full) for ts in (0, 1, 2, 2.9, 3)] == [60, 60, 60, 60, 5]
+    # a bar that moves is back at the ceiling at once
+    assert at(3.5, synthetic_frame(1280, 720, 80, 100)) == 60
+    assert at(4, full) == 60
+    assert [at(ts, full) for ts in (6.5, 7, 10)] == [60, 60, 5]
+    # a harmful condition or a cooldown running keeps it up too
+    detector.conditions = frozenset(('poison',))
+    assert detector.rate.update(detector, 11) == 60
+    detector.conditions = frozenset()
+    assert detector.rate.update(detector, 14) == 5
+    detector.cooldown_ready = {'potion': 14.5}
+    assert detector.rate.update(detector, 14.2) == 60
+
+
+def test_calibration_cache(monkeypatch):
+    frame = synthetic_frame(1280, 720, 100, 100)
+    source, first = detection(frame)
+    assert first.state == BotState.INICIADO
+    x, y, w, h = source.roi
+    with open(Detection.CALIBRATION_FILE) as f:
+        assert list(json.load(f)) == ['test|1280x720']
+    searches = []
+    find_loc = healer_module.Vision.findLoc
+    monkeypatch.setattr(healer_module.Vision, 'findLoc', lambda *args: searches.append(args) or find_loc(*args))
+    # a second run reuses the anchors without a full frame search
+    source, second = detection(frame)
+    assert second.state == BotState.INICIADO
+    assert searches == []
+    assert second.loc_life == first.loc_life
+    assert source.roi is not None
+    # the client moved its panel, the samples don't match and the whole window is searched
+    moved = np.roll(frame, (10, -20), axis=(0, 1))
+    source, third = detection(moved)
+    assert len(searches) == 1
+    assert third.state == BotState.INICIADO
+    assert source.roi == (x - 20, y + 10, w, h)